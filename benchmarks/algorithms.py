@@ -0,0 +1,27 @@
+"""
+分片键的分布，以及增加一个分表后移动的比例:
+python -m benchmarks.algorithms [分表数]
+"""
+import sys
+import time
+
+from pidal.lib.algorithms.factory import Factory
+
+
+def benchmark(n: int = 8):
+    keys = ["order-{:08d}".format(i) for i in range(200000)]
+    for name in ("crc32", "hash_ring"):
+        route = Factory.bind(name, [n])
+        start = time.perf_counter()
+        before = [route(k) for k in keys]
+        cost = time.perf_counter() - start
+        route = Factory.bind(name, [n + 1])
+        after = [route(k) for k in keys]
+        counts = [before.count(i) for i in range(n)]
+        moved = sum(a != b for a, b in zip(before, after)) / len(keys)
+        print("{:<10} {:>6.2f}us/key  min/max {}/{}  moved {:.1%}".format(
+            name, cost / len(keys) * 1e6, min(counts), max(counts), moved))
+
+
+if __name__ == "__main__":
+    benchmark(*(int(i) for i in sys.argv[1:2]))
@@ -0,0 +1,57 @@
+"""
+逐行合并和按列合并的对比:
+python -m benchmarks.columnar [分表数] [每个分表的分组数]
+"""
+import random
+import sys
+import time
+
+from decimal import Decimal
+
+from pidal.dservice.sqlparse.paser import Parser
+from pidal.dservice.table import aggregate as agg
+from pidal.dservice.table.columnar import available
+from pidal.node.result import result
+
+
+def benchmark(shards: int = 64, groups: int = 50000):
+    sql = Parser.parse("SELECT g, COUNT(*), SUM(v), MIN(v), MAX(v), AVG(v) "
+                       "FROM t GROUP BY g")[0]
+    aggregate = agg.Aggregate.new(sql)
+    descriptions = [
+            result.ResultDescription(None, None, None, None, i, i, 33, 0, 8,
+                                     0, s)
+            for i, s in (("g", 0), ("count", 0), ("sum", 2), ("min", 2),
+                         ("max", 2), ("avg", 2), ("count_v", 0))]
+    random.seed(1)
+    data = []
+    for i in range(shards):
+        # 每个分表都有全部的分组，顺序不同
+        for g in random.sample(range(groups), groups):
+            v = Decimal(random.randint(-10 ** 6, 10 ** 6)).scaleb(-2)
+            data.append((g, 3, v * 3, v, v, v * 3, 3))
+    r = result.ResultSet(len(descriptions), descriptions, data)
+    print("{} shards x {} groups, {} rows".format(shards, groups, len(data)))
+
+    rows = agg.COLUMNAR_ROWS
+    try:
+        agg.COLUMNAR_ROWS = len(data) + 1
+        start = time.perf_counter()
+        a = aggregate.combine(r)  # type: ignore
+        print("{:<10} {:>8.2f}s".format(
+            "python", time.perf_counter() - start))
+        if not available():
+            print("numpy is not installed.")
+            return
+        agg.COLUMNAR_ROWS = 0
+        start = time.perf_counter()
+        b = aggregate.combine(r)  # type: ignore
+        print("{:<10} {:>8.2f}s".format(
+            "numpy", time.perf_counter() - start))
+        assert a.rows == b.rows
+    finally:
+        agg.COLUMNAR_ROWS = rows
+
+
+if __name__ == "__main__":
+    benchmark(*(int(i) for i in sys.argv[1:3]))
@@ -0,0 +1,33 @@
+"""
+Lexer 与 sqlparse 的速度对比: python -m benchmarks.lexer
+结果一致的检查在 tests/test_lexer.py 中
+"""
+import time
+
+from pidal.dservice.sqlparse.lexer import parse
+from pidal.dservice.sqlparse.paser import Parser
+
+QUERIES = [
+    "select id, name from a where id = {} and name = 'n{}'",
+    "update a set `name` = \"dd{}\", age = age + 1 where id = {}",
+    "insert into a (id, name) values ({}, 'x{}')",
+    "insert into a (id, name) values ({0}, 'x'), ({1}, \"y{0}\")",
+    "delete from a where id = {} and status = {}",
+    "SELECT * FROM a WHERE id = {} AND name = \"{}\" FOR UPDATE",
+    "select * from a where b = {} limit {}",
+    "select * from a limit {}, {} for update",
+    "select * from a where id = {} limit 10 offset {}",
+]
+
+
+def benchmark(n: int = 5000):
+    for name, p in (("sqlparse", Parser.parse), ("lexer", parse)):
+        start = time.perf_counter()
+        for i in range(n):
+            p(QUERIES[i % len(QUERIES)].format(i, i))
+        print("{:<10} {:>8.0f} statements/sec".format(
+            name, n / (time.perf_counter() - start)))
+
+
+if __name__ == "__main__":
+    benchmark()
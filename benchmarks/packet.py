@@ -0,0 +1,90 @@
+"""
+结果集编码和转发的 rows/sec 对比: python -m benchmarks.packet
+大 packet 的拆分与重组在 tests/test_packet.py 中
+"""
+import asyncio
+import time
+
+from pidal.protocol.mysql.packet import PacketBytesReader, \
+        PacketBytesWriter, PacketHeader, PacketWriter, ResultSet, TextRow
+from pidal.stream import Stream
+
+
+class NullStream(Stream):
+    """ 只计数的 stream，benchmark 中不会读取 """
+
+    def __init__(self):
+        self.writes = 0
+
+    async def read_bytes(self, num_bytes: int) -> bytes:
+        return bytes(num_bytes)
+
+    async def write(self, data: bytes):
+        self.writes += 1
+
+
+async def per_row_encode(rs: ResultSet, stream: Stream):
+    """ 之前的实现：每行拼接一次 bytes，调用一次 stream.write """
+    packet_number = 0
+    for row in rs.rows:
+        r = bytes()
+        for i in row:
+            if i is not None and not isinstance(i, (str, bytes)):
+                i = str(i)
+            r += PacketBytesWriter.write_length_coded_string(i)
+        header = PacketHeader.new(len(r), packet_number).encode()
+        await stream.write(header + r)
+        packet_number += 1
+
+
+async def buffered_encode(rs: ResultSet, stream: Stream):
+    writer = PacketWriter(stream)
+    for row in rs.rows:
+        await writer.write_row(row)
+    await writer.flush()
+
+
+async def benchmark():
+    rs = ResultSet()
+    rs.field_count = 5
+    rs.rows = [(i, "user_{}".format(i), i * 7, None, "2021-02-08")
+               for i in range(200000)]
+    for name, f in (("per row write", per_row_encode),
+                    ("PacketWriter", buffered_encode)):
+        stream = NullStream()
+        start = time.perf_counter()
+        await f(rs, stream)
+        cost = time.perf_counter() - start
+        print("{:<14} {:>10.0f} rows/sec, {} writes".format(
+            name, len(rs.rows) / cost, stream.writes))
+
+    # backend 读到的行直接转发：逐列解码成 tuple 与 TextRow 对比
+    payloads = []
+    for row in rs.rows:
+        writer = PacketWriter(NullStream())
+        writer.append_row(row)
+        payloads.append(bytes(writer._buffer[4:]))
+
+    def decode_tuple(payload: bytes):
+        p_reader = PacketBytesReader(payload)
+        return tuple(p_reader.read_length_coded_string()
+                     for _ in range(rs.field_count))
+
+    def decode_lazy(payload: bytes):
+        return TextRow(payload, rs.field_count)
+
+    for name, decode in (("decode tuple", decode_tuple),
+                         ("TextRow", decode_lazy)):
+        stream = NullStream()
+        start = time.perf_counter()
+        writer = PacketWriter(stream)
+        for payload in payloads:
+            await writer.write_row(decode(payload))
+        await writer.flush()
+        cost = time.perf_counter() - start
+        print("{:<14} {:>10.0f} rows/sec relay".format(
+            name, len(payloads) / cost))
+
+
+if __name__ == "__main__":
+    asyncio.run(benchmark())
@@ -0,0 +1,32 @@
+"""
+命中 PlanCache 和直接解析的速度对比: python -m benchmarks.plan_cache
+结果一致的检查在 tests/test_plan.py 中
+"""
+import time
+
+from pidal.dservice.sqlparse.cache import PlanCache
+from pidal.dservice.sqlparse.paser import Parser
+
+QUERIES = [
+    "select id, name from a where id = {} and name = 'n{}'",
+    "update a set `name` = \"dd{}\", age = age + 1 where id = {}",
+    "insert into a (id, name) values ({}, 'x{}')",
+    "insert into a (id, name) values ({0}, 'x'), ({1}, \"y{0}\")",
+    "delete from a where id = {} and status = {}",
+    "SELECT * FROM a WHERE id = {} AND name = \"{}\" FOR UPDATE",
+]
+
+
+def benchmark(n: int = 5000):
+    cache = PlanCache(16)
+    for name, parse in (("sqlparse", Parser.parse), ("cache", cache.parse)):
+        start = time.perf_counter()
+        for i in range(n):
+            parse(QUERIES[i % len(QUERIES)].format(i, i))
+        print("{:<10} {:>8.0f} statements/sec".format(
+            name, n / (time.perf_counter() - start)))
+    print(cache.stats())
+
+
+if __name__ == "__main__":
+    benchmark()
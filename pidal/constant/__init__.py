@@ -1,2 +1,2 @@
-from .db import DBNodeType, DBTableType
+from .db import DBNodeType, DBTableType, ResultMode
 from .common import RuleStatus
@@ -49,3 +49,10 @@ class TransStatus(enum.IntFlag):
     COMMITING = 8  # 提交中
     ROLLBACKING = 16  # 回滚中
     END = 32  # 事务已经结束
+
+
+@enum.unique
+class ResultMode(enum.IntEnum):
+    BUFFERED = 1  # 结果集全部读取到内存后再返回
+    STREAM = 2  # 结果集边从 backend 读取边写给客户端
+    RAW = 3  # backend 返回的 packet 不解码，只修改序号直接转发给客户端
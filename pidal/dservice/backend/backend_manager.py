@@ -1,8 +1,20 @@
+import asyncio
+import math
+import time
+
 from pidal.meta.model import DBNode
 from pidal.node.pool import Pool
-from typing import Dict, Optional
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import pidal.node.result as result
 
+from pidal.constant.db import DBNodeType, ResultMode
 from pidal.node.connection import Connection
+from pidal.dservice.backend.balancer import Balancer, BalancerFactory
+from pidal.dservice.backend.gtid import Fence, GtidSet, read_fences, \
+        written_nodes
+from pidal.dservice.backend.lag import LagMonitor
+from pidal.lib.metrics import Metrics
 
 
 class BackendManager(object):
@@ -25,7 +37,20 @@ class BackendManager(object):
     def __init__(self):
         # 事务中使用到的 node 保持
         self.trans: Dict[int, Dict[str, Connection]] = {}
+        # 第一次在 node 上取得连接时先执行 BEGIN 的事务
+        self.lazy_begin: Set[int] = set()
         self.backends: Dict[str, Pool] = {}
+        # source node -> 跟随它的 replica node，开启读写分离后才有
+        self.replicas: Dict[str, List[str]] = {}
+        self.balancer: Optional[Balancer] = None
+        # 延迟过大或者不可用，暂时不执行只读查询的 replica
+        self.excluded: Set[str] = set()
+        self.lag_monitor: Optional[LagMonitor] = None
+        # 每个 node 上事务外正在执行的查询数
+        self.outstanding: Dict[str, int] = {}
+        # 因为会话刚写入过改在 source 上执行的只读查询数
+        self.fenced_reads = Metrics.get_instance().counter(
+                "replica.fenced_reads")
 
     def add_backend(self, node: DBNode):
         if node.name in self.backends:
@@ -34,7 +59,58 @@ class BackendManager(object):
                                         node.maximum_pool_size,
                                         node.dsn,
                                         node.acquire_timeout,
-                                        node.wait_time)
+                                        node.wait_time,
+                                        name=node.name)
+
+    def enable_replicas(self, nodes: Iterable[DBNode], algorithm: str,
+                        max_lag: float = 0, interval: float = 1,
+                        algorithm_args: Optional[List[Any]] = None):
+        """
+        读写分离，事务外的只读查询按 algorithm 选择一个 replica 执行，
+        algorithm_args 为 algorithm 的参数。
+        max_lag 大于 0 时在后台检查复制延迟，排除延迟超过 max_lag 秒的 replica，
+        同时会话写入后的读只会在已经执行了写入的 replica 上执行；
+        否则会话写入后的读都在 source 上执行。
+        """
+        nodes = list(nodes)
+        sources = {i.name for i in nodes if i.type is DBNodeType.SOURCE}
+        replicas: Dict[str, List[str]] = {}
+        for i in nodes:
+            if i.type is not DBNodeType.REPLICA:
+                continue
+            if i.follow not in sources:
+                raise Exception("replica [{}] follow unknown source [{}]."
+                                .format(i.name, i.follow))
+            replicas.setdefault(i.follow, []).append(i.name)  # type: ignore
+        self.balancer = BalancerFactory.new(algorithm, algorithm_args)
+        self.replicas = replicas
+        if self.lag_monitor is not None:
+            self.lag_monitor.stop()
+            self.lag_monitor = None
+        self.excluded = set()
+        if max_lag > 0 and replicas:
+            self.excluded = {j for i in replicas.values() for j in i}
+            self.lag_monitor = LagMonitor.new(self, max_lag, interval)
+            self.lag_monitor.start()
+
+    def read_node(self, node: str,
+                  fences: Optional[Dict[str, Fence]] = None) -> str:
+        """
+        执行只读查询的 node，没有 replica 时为 node 本身。
+        fences 为会话的读条件，只选择满足条件的 replica
+        """
+        replicas = self.replicas.get(node, None)
+        if replicas and self.excluded:
+            replicas = [i for i in replicas if i not in self.excluded]
+        fence = fences.get(node, None) if fences else None
+        if replicas and fence is not None:
+            gtids = self.lag_monitor.gtids if self.lag_monitor else {}
+            replicas = [i for i in replicas if fence.is_passed(gtids.get(i))]
+            if not replicas:
+                self.fenced_reads.inc()
+        if not replicas or self.balancer is None:
+            return node
+        return self.balancer.choose(node, replicas, self.outstanding)
 
     async def get_backend(self, node: str, trans_id: int = 0) -> Connection:
         if trans_id:
@@ -51,6 +127,130 @@ class BackendManager(object):
     def release(self, node: str, conn: Connection):
         self.backends.get(node).release(conn)
 
+    async def query(self, node: str, sql: str, trans_id: int = 0,
+                    mode: ResultMode = ResultMode.BUFFERED,
+                    read: bool = False) -> result.Result:
+        """
+        在 node 上执行 sql，非事务中执行完成后连接会还给 Pool。
+        流式结果集和原始结果在 close 之后才会归还连接。
+        read 为 True 并且不在事务中时，在 node 的 replica 上执行。
+        """
+        if trans_id:
+            conn = await self.get_backend_by_trans(node, trans_id)
+            r = await self._execute(conn, sql, mode)
+            if isinstance(r, result.StreamResult):
+                r.add_done_callback(lambda: self._check_drained(r, conn))
+            return r
+
+        written = None
+        if read and node in self.replicas:
+            node = self.read_node(node, read_fences.get())
+        else:
+            written = written_nodes.get()
+            if written is not None and mode is ResultMode.RAW:
+                # 需要从 OK 中读取提交的 GTID，不能直接转发
+                mode = ResultMode.BUFFERED
+        self.outstanding[node] = self.outstanding.get(node, 0) + 1
+        try:
+            conn = await self._acquiring_conn(node)
+        except BaseException:
+            self._done(node)
+            raise
+        try:
+            r = await self._execute(conn, sql, mode)
+        except BaseException:
+            self._done(node, conn)
+            raise
+        if written is not None:
+            self._record_gtids(written, node, conn.take_gtids())
+        if isinstance(r, result.StreamResult):
+            r.add_done_callback(lambda: self._done(node, conn, r))
+        else:
+            self._done(node, conn)
+        return r
+
+    async def prepare(self, node: str, sql: str) -> result.Result:
+        """ 在 node 上 prepare sql，得到参数和结果集的列 """
+        conn = await self._acquiring_conn(node)
+        try:
+            return await conn.prepare(sql)
+        finally:
+            self.release(node, conn)
+
+    @staticmethod
+    async def _execute(conn: Connection, sql: str,
+                       mode: ResultMode) -> result.Result:
+        if mode is ResultMode.RAW:
+            return await conn.query_raw(sql)
+        elif mode is ResultMode.STREAM:
+            return await conn.query_stream(sql)
+        return await conn.query(sql)
+
+    @staticmethod
+    def _check_drained(r: result.StreamResult, conn: Connection):
+        """ 没有读完的连接关闭，事务中之后的查询会返回错误 """
+        if not r.drained:
+            conn.close()
+
+    def _done(self, node: str, conn: Optional[Connection] = None,
+              r: Optional[result.StreamResult] = None):
+        self.outstanding[node] -= 1
+        if conn is not None:
+            if r is not None:
+                # 关闭的连接 Pool 不会再使用
+                self._check_drained(r, conn)
+            # 没有取走的 GTID 不再需要，避免在 Pool 的连接上累积
+            conn.take_gtids()
+            self.release(node, conn)
+
+    @staticmethod
+    def _record_gtids(written: Dict[str, Optional[str]], node: str,
+                      gtids: Optional[str]):
+        """ 同一个 node 写入多次时合并，有一次不知道 GTID 时为 None """
+        if gtids is None or (node in written and written[node] is None):
+            written[node] = None
+        elif written.get(node):
+            written[node] = written[node] + "," + gtids  # type: ignore
+        else:
+            written[node] = gtids
+
+    async def fence(self, written: Dict[str, Optional[str]]) -> \
+            Dict[str, Fence]:
+        """
+        写入并且提交后的读条件，written 为 node -> 提交的 GTID：replica
+        执行了这些 GTID 之后才能读。GTID 为空字符串时没有提交新的事务，
+        不需要条件；为 None 时（连接不支持 session_track_gtids）使用 source
+        当前的 gtid_executed。
+        没有开启 GTID 时只能等待 max_lag 加上检查间隔。
+        没有检查复制延迟时无法确定 replica 的进度，之后的读都在 source 上执行。
+        """
+        nodes = [i for i, g in written.items()
+                 if i in self.replicas and g != ""]
+        if not nodes:
+            return {}
+        monitor = self.lag_monitor
+        if monitor is None:
+            return {i: Fence(GtidSet({}), math.inf) for i in nodes}
+        deadline = time.monotonic() + monitor.max_lag + monitor.interval
+
+        async def _gtids(node: str) -> GtidSet:
+            gtids = written[node]
+            if gtids is None:
+                return await self._gtid_executed(node)
+            return GtidSet.parse(gtids)
+
+        gtids = await asyncio.gather(*[_gtids(i) for i in nodes])
+        return {n: Fence(g, deadline) for n, g in zip(nodes, gtids)}
+
+    async def _gtid_executed(self, node: str) -> GtidSet:
+        try:
+            r = await self.query(node, "SELECT @@GLOBAL.gtid_executed")
+        except Exception:
+            return GtidSet({})
+        if not isinstance(r, result.ResultSet) or not r.rows:
+            return GtidSet({})
+        return GtidSet.parse(r.rows[0][0])
+
     async def get_backend_by_trans(self, node: str,
                                    trans_id: int) -> Connection:
         trans = self.trans.get(trans_id, None)
@@ -60,13 +260,25 @@ class BackendManager(object):
         if node in trans.keys():
             return trans[node]
         conn = await self._acquiring_conn(node)
+        if trans_id in self.lazy_begin:
+            try:
+                await conn.begin()
+            except BaseException:
+                self.release(node, conn)
+                raise
         trans[node] = conn
         return conn
 
     def free_trans(self, trans_id: int):
+        self.lazy_begin.discard(trans_id)
         trans = self.trans.get(trans_id)
         if not trans:
             return
+        # 提交时由 DSession 设置，记录每个连接提交的 GTID
+        written = written_nodes.get()
         for node, conn in trans.items():
+            gtids = conn.take_gtids()
+            if written is not None:
+                self._record_gtids(written, node, gtids)
             self.backends[node].release(conn)
         del(self.trans[trans_id])
@@ -0,0 +1,104 @@
+import abc
+import random
+
+from typing import Any, Dict, List, Optional
+
+
+class Balancer(metaclass=abc.ABCMeta):
+    """ 从 source node 的 replica 中选择执行只读查询的 node """
+
+    def __init__(self, args: Optional[List[Any]] = None):
+        """ args 为 source_replica.algorithm_args """
+        pass
+
+    @abc.abstractmethod
+    def choose(self, source: str, replicas: List[str],
+               outstanding: Dict[str, int]) -> str:
+        """ replicas 不为空，outstanding 为每个 node 上正在执行的查询数 """
+        pass
+
+
+class RandomBalancer(Balancer):
+
+    def choose(self, source: str, replicas: List[str],
+               outstanding: Dict[str, int]) -> str:
+        return random.choice(replicas)
+
+
+class RoundRobinBalancer(Balancer):
+
+    def __init__(self, args: Optional[List[Any]] = None):
+        self.next: Dict[str, int] = {}
+
+    def choose(self, source: str, replicas: List[str],
+               outstanding: Dict[str, int]) -> str:
+        n = self.next.get(source, 0)
+        self.next[source] = n + 1
+        return replicas[n % len(replicas)]
+
+
+class LeastOutstandingBalancer(Balancer):
+    """ 正在执行的查询最少的 replica，相同时从随机的位置开始选择 """
+
+    def choose(self, source: str, replicas: List[str],
+               outstanding: Dict[str, int]) -> str:
+        start = random.randrange(len(replicas))
+        best = replicas[start]
+        least = outstanding.get(best, 0)
+        for i in range(1, len(replicas)):
+            node = replicas[(start + i) % len(replicas)]
+            n = outstanding.get(node, 0)
+            if n < least:
+                best, least = node, n
+        return best
+
+
+class WeightedBalancer(Balancer):
+    """
+    平滑的加权轮询。args 为 [[replica, 权重], ...]，没有配置的 replica 权重
+    为 1，权重为 0 的 replica 不执行只读查询，除非其余的都被排除了
+    """
+
+    def __init__(self, args: Optional[List[Any]] = None):
+        self.weights: Dict[str, int] = {}
+        for name, weight in args or []:
+            if int(weight) < 0:
+                raise Exception("replica [{}] weight must be >= 0.".format(
+                    name))
+            self.weights[name] = int(weight)
+        # source -> replica 的当前权重
+        self.current: Dict[str, Dict[str, int]] = {}
+
+    def choose(self, source: str, replicas: List[str],
+               outstanding: Dict[str, int]) -> str:
+        weights = [self.weights.get(i, 1) for i in replicas]
+        total = sum(weights)
+        if not total:
+            weights = [1] * len(replicas)
+            total = len(replicas)
+        current = self.current.setdefault(source, {})
+        best = None
+        for node, weight in zip(replicas, weights):
+            current[node] = current.get(node, 0) + weight
+            if best is None or current[node] > current[best]:
+                best = node
+        current[best] -= total  # type: ignore
+        return best  # type: ignore
+
+
+class BalancerFactory(object):
+    balancers = {
+            "random": RandomBalancer,
+            "round_robin": RoundRobinBalancer,
+            "least_outstanding": LeastOutstandingBalancer,
+            "weighted": WeightedBalancer,
+            }
+
+    @classmethod
+    def new(cls, algorithm: str,
+            args: Optional[List[Any]] = None) -> Balancer:
+        b = cls.balancers.get(algorithm, None)
+        if not b:
+            raise Exception("unknown source replica algorithm [{}].".format(
+                algorithm))
+        return b(args)
@@ -0,0 +1,88 @@
+import time
+
+from bisect import bisect_right
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple, Union
+
+
+class GtidSet(object):
+    """
+    MySQL 的 GTID 集合，如 `uuid:1-5:7,uuid2:1-3`，每个 uuid 的区间从小到大
+    排列并且不重叠（与 gtid_executed 一致）。
+    """
+
+    __slots__ = ("intervals",)
+
+    def __init__(self, intervals: Dict[str, List[Tuple[int, int]]]):
+        # uuid -> [(开始, 结束)]，包含结束
+        self.intervals: Dict[str, List[Tuple[int, int]]] = intervals
+
+    @classmethod
+    def parse(cls, text: Union[str, bytes, None]) -> 'GtidSet':
+        if isinstance(text, (bytes, bytearray)):
+            text = text.decode("ascii")
+        intervals: Dict[str, List[Tuple[int, int]]] = {}
+        for item in (text or "").replace("\n", "").split(","):
+            parts = item.strip().split(":")
+            if len(parts) < 2:
+                continue
+            uuid = parts[0].lower()
+            for i in parts[1:]:
+                start, _, end = i.partition("-")
+                intervals.setdefault(uuid, []).append(
+                        (int(start), int(end or start)))
+        for v in intervals.values():
+            v.sort()
+        return cls(intervals)
+
+    def __bool__(self) -> bool:
+        return bool(self.intervals)
+
+    def issubset(self, other: 'GtidSet') -> bool:
+        for uuid, intervals in self.intervals.items():
+            others = other.intervals.get(uuid, None)
+            if not others:
+                return False
+            starts = [i[0] for i in others]
+            for start, end in intervals:
+                n = bisect_right(starts, start) - 1
+                if n < 0 or others[n][1] < end:
+                    return False
+        return True
+
+    def __str__(self) -> str:
+        return ",".join(
+                uuid + "".join(":{}-{}".format(*i) if i[0] != i[1]
+                               else ":{}".format(i[0]) for i in v)
+                for uuid, v in self.intervals.items())
+
+
+class Fence(object):
+    """
+    会话写入后读取的条件：replica 已经执行了 gtids，或者已经过了 deadline
+    （replica 的延迟不超过 max_lag，过了 max_lag 加上检查间隔后一定已经执行）。
+    不知道 replica 的进度时 deadline 为 inf，只能在 source 上读
+    """
+
+    __slots__ = ("gtids", "deadline")
+
+    def __init__(self, gtids: GtidSet, deadline: float):
+        self.gtids: GtidSet = gtids
+        self.deadline: float = deadline
+
+    def is_passed(self, executed: Optional[GtidSet]) -> bool:
+        if time.monotonic() >= self.deadline:
+            return True
+        return bool(self.gtids) and executed is not None and \
+            self.gtids.issubset(executed)
+
+
+# 当前会话的读条件，source node -> Fence。由 DSession 在执行时设置，
+# scatter 等创建的 task 会复制 context，不需要在每一层传递
+read_fences: ContextVar[Optional[Dict[str, Fence]]] = \
+    ContextVar("read_fences", default=None)
+
+# 事务外写入和提交事务时由 DSession 设置，BackendManager 记录执行了写入的
+# node -> 连接返回的提交的 GTID（不支持时为 None），之后计算这些 node 的读条件
+written_nodes: ContextVar[Optional[Dict[str, Optional[str]]]] = \
+    ContextVar("written_nodes", default=None)
@@ -0,0 +1,103 @@
+import asyncio
+
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from pidal.dservice.backend.gtid import GtidSet
+from pidal.lib.metrics import Metrics
+from pidal.node.result import result
+
+# 返回 replica 的复制延迟（秒），不能确定时返回 None
+Probe = Callable[[str], Awaitable[Optional[float]]]
+
+# 8.0.22 之前没有 SHOW REPLICA STATUS
+STATUS_SQLS = (("SHOW REPLICA STATUS", "Seconds_Behind_Source"),
+               ("SHOW SLAVE STATUS", "Seconds_Behind_Master"))
+
+
+class LagMonitor(object):
+    """
+    定时检查每个 replica 的复制延迟，默认使用 SHOW REPLICA STATUS。
+    延迟超过 max_lag 秒、复制已经停止或者检查失败的 replica 不再执行只读
+    查询，恢复后重新加入。第一次检查完成前 replica 都不参与读。
+
+    延迟记录在 gauge `replica.lag.<node>` 中，不能确定时为 -1。
+    同时记录 replica 已经执行的 GTID（Executed_Gtid_Set），用于会话写入后的读。
+    """
+
+    def __init__(self, backend_manager: Any, max_lag: float,
+                 interval: float = 1, probe: Optional[Probe] = None):
+        self.backend_manager = backend_manager
+        self.max_lag: float = max_lag
+        self.interval: float = interval
+        self.probe: Probe = probe or self.replica_status
+        # 最近一次检查的延迟
+        self.lags: Dict[str, Optional[float]] = {}
+        # 最近一次检查时 replica 已经执行的 GTID
+        self.gtids: Dict[str, GtidSet] = {}
+        # 不支持 SHOW REPLICA STATUS 的 node
+        self._legacy: Set[str] = set()
+        self._task: Optional[asyncio.Future] = None
+        self.metrics = Metrics.get_instance()
+
+    @classmethod
+    def new(cls, backend_manager: Any, max_lag: float, interval: float = 1,
+            probe: Optional[Probe] = None) -> 'LagMonitor':
+        return cls(backend_manager, max_lag, interval, probe)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.interval)
+
+    async def check(self):
+        """ 检查一次全部的 replica，更新 backend_manager.excluded """
+        nodes = [j for i in self.backend_manager.replicas.values()
+                 for j in i]
+        lags = await asyncio.gather(*[self._measure(i) for i in nodes])
+        excluded = self.backend_manager.excluded
+        for node, lag in zip(nodes, lags):
+            self.lags[node] = lag
+            self.metrics.gauge("replica.lag." + node).set(
+                    -1 if lag is None else lag)
+            if lag is None or lag > self.max_lag:
+                excluded.add(node)
+            else:
+                excluded.discard(node)
+
+    async def _measure(self, node: str) -> Optional[float]:
+        try:
+            return await asyncio.wait_for(self.probe(node),
+                                          max(self.interval, 1))
+        except Exception:
+            return None
+
+    async def replica_status(self, node: str) -> Optional[float]:
+        for sql, column in STATUS_SQLS:
+            if node in self._legacy and column == "Seconds_Behind_Source":
+                continue
+            r = await self.backend_manager.query(node, sql)
+            if isinstance(r, result.Error):
+                self._legacy.add(node)
+                continue
+            if not isinstance(r, result.ResultSet) or not r.rows:
+                # 不是 replica
+                return None
+            names = [i.name for i in r.descriptions]
+            if column not in names:
+                return None
+            row = r.rows[0]
+            if "Executed_Gtid_Set" in names:
+                self.gtids[node] = GtidSet.parse(
+                        row[names.index("Executed_Gtid_Set")])
+            v = row[names.index(column)]
+            return None if v is None else float(v)
+        return None
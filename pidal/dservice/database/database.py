@@ -1,8 +1,10 @@
 from typing import Dict, List, Optional
 
 from pidal.node.result import result
+from pidal.constant.db import ResultMode
 from pidal.dservice.table.factory import TableFactory
 from pidal.dservice.sqlparse.paser import DML, SQL
+from pidal.dservice.sqlparse.cache import PlanCache
 from pidal.dservice.backend.backend_manager import BackendManager
 from pidal.dservice.table.table import Table
 from pidal.dservice.zone_manager import ZoneManager
@@ -17,6 +19,14 @@ class Database(object):
         self.default_trans_mod = db_config.transaction_mod
         self.idle_in_transaction_session_timeout = \
             db_config.idle_in_transaction_session_timeout
+        if db_config.raw_result:
+            self.result_mode = ResultMode.RAW
+        elif db_config.stream_result:
+            self.result_mode = ResultMode.STREAM
+        else:
+            self.result_mode = ResultMode.BUFFERED
+        self.plan_cache = PlanCache(db_config.plan_cache_size,
+                                    db_config.name)
         self.tables: Dict[str, Table] = {}
         self.create_backends()
         self.create_tables()
@@ -30,6 +40,12 @@ class Database(object):
         self.backend_manager = BackendManager.get_instance()
         for i in self.db_config.nodes.values():
             self.backend_manager.add_backend(i)
+        if self.db_config.source_replica_enable:
+            self.backend_manager.enable_replicas(
+                    self.db_config.nodes.values(), self.db_config.algorithm,
+                    self.db_config.max_lag,
+                    self.db_config.lag_check_interval,
+                    self.db_config.algorithm_args)
 
     async def execute_command(self, execute: result.Execute) -> \
             Optional[List[result.Result]]:
@@ -42,15 +58,24 @@ class Database(object):
             raise Exception("not found table [{}]".format(t))
         return table
 
-    async def execute_dml(self, sql: DML) -> result.Result:
+    async def execute_dml(self, sql: DML,
+                          mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         if not sql.has_table():
-            return await self.execute_other(sql)
+            return await self.execute_other(sql, mode)
         table = self.get_table(str(sql.table))
-        return await table.execute_dml(sql)
+        return await table.execute_dml(sql, mode=mode)
 
-    async def execute_other(self, sql: SQL) -> result.Result:
+    async def execute_other(self, sql: SQL,
+                            mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         node = list(self.backend_manager.backends.keys())[0]
-        b = await self.backend_manager.get_backend(node)
-        r = await b.query(str(sql.raw))
-        self.backend_manager.release(node, b)
-        return r
+        return await self.backend_manager.query(node, sql.to_sql(), mode=mode)
+
+    async def prepare(self, sql: SQL) -> result.Result:
+        """ 在 backend 上 prepare，sql 中的参数为 `?` """
+        if sql.has_table():
+            table = self.get_table(str(sql.table))
+            return await table.prepare(sql)  # type: ignore
+        node = list(self.backend_manager.backends.keys())[0]
+        return await self.backend_manager.prepare(node, sql.to_sql())
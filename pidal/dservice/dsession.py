@@ -1,13 +1,17 @@
 from pidal.dservice.transaction.factory import TransFactory
-from typing import List, Optional
+from typing import Any, Awaitable, Dict, List, Optional
 
 import pidal.node.result as result
 
+from pidal.dservice.backend.gtid import Fence, read_fences, written_nodes
 from pidal.dservice.database.database import Database
 from pidal.dservice.transaction.trans import Trans
-from pidal.dservice.sqlparse.paser import Parser, DML, SQL, TCL, Other
+from pidal.dservice.sqlparse.paser import DML, DMLW, SQL, TCL, Other, \
+        Select
+from pidal.dservice.sqlparse.plan import Plan, PreparedStatement
+from pidal.protocol.mysql import StmtExecute, PacketBytesReader
 from pidal.node.result.command import Command
-from pidal.constant.db import SessionStatus
+from pidal.constant.db import ResultMode, SessionStatus
 
 
 class DSession(object):
@@ -16,34 +20,123 @@ class DSession(object):
         self.status = SessionStatus.SERVING
 
         self._trans: Optional[Trans] = None
+        self._stmts: Dict[int, PreparedStatement] = {}
+        self._stmt_id: int = 0
+        # 当前事务中执行过写入
+        self._wrote: bool = False
+        # 写入后的读条件，source node -> Fence，保证读到自己的写入
+        self._fences: Dict[str, Fence] = {}
 
     def get_session_status(self) -> SessionStatus:
         return self.status
 
     async def execute(self, execute: result.Execute) -> \
             Optional[List[result.Result]]:
-        if execute.command is not Command.COM_QUERY:
-            return await self._execute_command(execute)
-        sqls = Parser.parse(execute.query)
-        r = []
-        for sql in sqls:
-            if isinstance(sql, DML):
-                r.append(await self._execute_dml(sql))
-            elif isinstance(sql, TCL):
-                r.append(await self._execute_trans(sql))
-            else:
-                r.append(await self._execute_other(sql))
-        return r
+        token = read_fences.set(self._fences)
+        try:
+            if execute.command is not Command.COM_QUERY:
+                return await self._execute_command(execute)
+            sqls = self.db.plan_cache.parse(execute.query)
+            r = []
+            for i, sql in enumerate(sqls):
+                # 多语句时只有最后一个结果可以流式返回，前面的结果需要先读完
+                # 才能在同一个 backend 上执行下一个语句
+                mode = self.db.result_mode if i == len(sqls) - 1 else \
+                    ResultMode.BUFFERED
+                r.append(await self._execute_sql(sql, mode))
+            return r
+        finally:
+            read_fences.reset(token)
+
+    async def _execute_sql(self, sql: SQL,
+                           mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
+        if isinstance(sql, DML):
+            return await self._execute_dml(sql, mode)
+        elif isinstance(sql, TCL):
+            return await self._execute_trans(sql)
+        else:
+            return await self._execute_other(sql, mode)
 
     async def _execute_command(self, execute: result.Execute) -> \
             Optional[List[result.Result]]:
         """ 处理非 Query 类型的command  """
+        command = execute.command
+        if command is Command.COM_STMT_PREPARE:
+            return [await self._prepare(execute.query)]
+        elif command is Command.COM_STMT_EXECUTE:
+            return [await self._execute_stmt(execute.args)]
+        elif command is Command.COM_STMT_SEND_LONG_DATA:
+            # 没有响应
+            p_reader = PacketBytesReader(execute.args)
+            stmt = self._stmts.get(p_reader.read_uint32(), None)
+            if stmt:
+                stmt.add_long_data(p_reader.read_uint16(), p_reader.read_all())
+            return None
+        elif command is Command.COM_STMT_CLOSE:
+            # 没有响应
+            self._stmts.pop(StmtExecute.read_statement_id(execute.args), None)
+            return None
+        elif command is Command.COM_STMT_RESET:
+            stmt = self._stmts.get(
+                    StmtExecute.read_statement_id(execute.args), None)
+            if not stmt:
+                return [self._unknown_stmt()]
+            stmt.reset()
+            return [result.OK(0, 0, 0, 0, '', False)]
         return await self.db.execute_command(execute)
 
-    async def _execute_other(self, sql: SQL) -> result.Result:
+    async def _prepare(self, query: str) -> result.Result:
+        try:
+            plan = self.db.plan_cache.compile(query)
+        except Exception as e:
+            return result.Error(1000, str(e))
+        if isinstance(plan.sql, Select) and plan.prepared is None:
+            # PREPARE_OK 需要返回结果集的列，在 backend 上 prepare 一次，
+            # 结果与 Plan 一起缓存
+            r = await self.db.prepare(
+                    plan.bind_literals(["?"] * plan.num_params))
+            if not isinstance(r, result.Prepare):
+                return r
+            plan.prepared = r
+        self._stmt_id += 1
+        self._stmts[self._stmt_id] = PreparedStatement(self._stmt_id, plan)
+        prepared = plan.prepared
+        if prepared is None:
+            return result.Prepare(self._stmt_id, plan.num_params)
+        return result.Prepare(self._stmt_id, plan.num_params,
+                              prepared.num_columns, prepared.params,
+                              prepared.columns)
+
+    async def _execute_stmt(self, args: bytes) -> result.Result:
+        stmt = self._stmts.get(StmtExecute.read_statement_id(args), None)
+        if not stmt:
+            return self._unknown_stmt()
+        try:
+            execute = StmtExecute.decode(args, stmt.num_params, stmt.types,
+                                         stmt.long_data)
+            stmt.types = execute.types
+            sql = stmt.plan.bind(execute.params)
+        except Exception as e:
+            return result.Error(1000, str(e))
+        finally:
+            stmt.reset()
+        # binary protocol 的结果集需要重新编码，不能直接转发 backend 的 packet
+        mode = self.db.result_mode
+        if mode is ResultMode.RAW:
+            mode = ResultMode.STREAM
+        return await self._execute_sql(sql, mode)
+
+    @staticmethod
+    def _unknown_stmt() -> result.Error:
+        return result.Error(1243, "Unknown prepared statement handler.")
+
+    async def _execute_other(self, sql: SQL,
+                             mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         if self._trans:
-            return await self._trans.execute_other(sql)
-        return await self.db.execute_other(sql)
+            return await self._trans.execute_other(sql, mode)
+        return await self.db.execute_other(sql, mode)
 
     async def _execute_trans(self, sql: TCL) -> result.Result:
         try:
@@ -51,19 +144,17 @@ class DSession(object):
                 if self._trans:
                     raise Exception("Transactions cannot be nested.")
                 self._trans = self._create_trans(sql.trans_args)
+                self._wrote = False
                 await self._trans.begin(sql)
                 return result.OK(0, 0, 0, 0, '', False)
             elif sql.is_commit:
                 if self._trans:
-                    await self._trans.commit(sql)
-                    await self._trans.close()
-                    self._trans = None
+                    await self._end_trans(self._trans.commit(sql))
                 return result.OK(0, 0, 0, 0, '', False)
             elif sql.is_rollback:
                 if self._trans:
-                    await self._trans.rollback(sql)
-                    await self._trans.close()
-                    self._trans = None
+                    # a2pc 的回滚会执行 undo，也是写入
+                    await self._end_trans(self._trans.rollback(sql))
                 return result.OK(0, 0, 0, 0, '', False)
             else:
                 return result.Error(1000, "unknown what to do.")
@@ -72,13 +163,51 @@ class DSession(object):
             self._trans = None
             return result.Error(1000, str(e))
 
-    async def _execute_dml(self, sql: DML) -> result.Result:
+    async def _execute_dml(self, sql: DML,
+                           mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         if self._trans:
-            return await self._trans.execute_dml(sql)
+            if isinstance(sql, DMLW):
+                self._wrote = True
+            return await self._trans.execute_dml(sql, mode)
         if not sql.has_table():
-            return await self._execute_other(sql)
+            return await self._execute_other(sql, mode)
         table = self.db.get_table(str(sql.table))
-        return await table.execute_dml(sql)
+        if not isinstance(sql, DMLW) or not self.db.backend_manager.replicas:
+            return await table.execute_dml(sql, mode=mode)
+        # 事务外的写入，完成后同样需要读到自己的写入。出错时也可能有分表
+        # 已经写入了
+        written: Dict[str, Optional[str]] = {}
+        token = written_nodes.set(written)
+        try:
+            return await table.execute_dml(sql, mode=mode)
+        finally:
+            written_nodes.reset(token)
+            await self._fence(written)
+
+    async def _end_trans(self, end: Awaitable[Any]):
+        """
+        提交或者回滚当前事务。事务写入过时，BackendManager 在释放事务的
+        连接时记录每个 node 提交的 GTID，之后计算读条件
+        """
+        written: Optional[Dict[str, Optional[str]]] = None
+        if self._wrote:
+            written = {}
+        self._wrote = False
+        token = written_nodes.set(written)
+        try:
+            await end
+            await self._trans.close()  # type: ignore
+        finally:
+            written_nodes.reset(token)
+        self._trans = None
+        if written:
+            await self._fence(written)
+
+    async def _fence(self, written: Dict[str, Optional[str]]):
+        if not written:
+            return
+        self._fences.update(await self.db.backend_manager.fence(written))
 
     def _create_trans(self, trans: Optional[List[str]]) -> Trans:
         args = []
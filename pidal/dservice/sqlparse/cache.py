@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from typing import List, Optional
+
+from pidal.lib.metrics import Metrics
+from pidal.dservice.sqlparse import lexer
+from pidal.dservice.sqlparse.fingerprint import fingerprint
+from pidal.dservice.sqlparse.paser import SQL
+from pidal.dservice.sqlparse.plan import Plan
+
+
+class PlanCache(object):
+    """
+    按去掉字面量后的 SQL 缓存 Plan（LRU）。命中时只需要取出字面量绑定到
+    Template 上，不再调用 sqlparse。
+
+    第一次遇到的 SQL 仍然直接解析（先使用 Lexer，不能识别的再使用
+    sqlparse），同时编译 Plan 并检查绑定后的结果与直接解析的一致，
+    不一致的 SQL 记录为 None，之后都直接解析。
+    """
+
+    def __init__(self, size: int = 1024, name: str = ""):
+        self.size: int = size
+        self._plans: OrderedDict[str, Optional[Plan]] = OrderedDict()
+        # COM_STMT_PREPARE 的 Plan，按 SQL 原文缓存
+        self._prepared: OrderedDict[str, Plan] = OrderedDict()
+
+        metrics = Metrics.get_instance()
+        prefix = "plan_cache.{}.".format(name) if name else "plan_cache."
+        self.hits = metrics.counter(prefix + "hits")
+        self.misses = metrics.counter(prefix + "misses")
+
+    def parse(self, sql: str) -> List[SQL]:
+        if not self.size:
+            return lexer.parse(sql)
+        fp = fingerprint(sql)
+        if fp is None:
+            self.misses.inc()
+            return lexer.parse(sql)
+        text, key, literals = fp
+
+        plans = self._plans
+        if key in plans:
+            plan = plans[key]
+            plans.move_to_end(key)
+            if plan is not None:
+                self.hits.inc()
+                return [plan.bind_literals(literals)]
+            self.misses.inc()
+            return lexer.parse(sql)
+
+        self.misses.inc()
+        sqls = lexer.parse(sql)
+        plans[key] = self._compile(text, literals, sqls)
+        if len(plans) > self.size:
+            plans.popitem(last=False)
+        return sqls
+
+    def compile(self, query: str) -> Plan:
+        """
+        COM_STMT_PREPARE 使用的 Plan，同样的 SQL 共用一个，backend 上
+        prepare 的结果也跟着缓存
+        """
+        plans = self._prepared
+        plan = plans.get(query, None)
+        if plan is not None:
+            plans.move_to_end(query)
+            self.hits.inc()
+            return plan
+        self.misses.inc()
+        plan = Plan.compile(query)
+        if self.size:
+            plans[query] = plan
+            if len(plans) > self.size:
+                plans.popitem(last=False)
+        return plan
+
+    @staticmethod
+    def _compile(text: str, literals: List[str],
+                 sqls: List[SQL]) -> Optional[Plan]:
+        if len(sqls) != 1:
+            return None
+        try:
+            plan = Plan.compile(text)
+            if plan.num_params != len(literals) or \
+                    not plan.same(plan.bind_literals(literals), sqls[0]):
+                return None
+        except Exception:
+            return None
+        return plan
+
+    def stats(self) -> dict:
+        return {"size": len(self._plans), "hits": self.hits.value,
+                "misses": self.misses.value}
+
+    def clear(self):
+        self._plans.clear()
+        self._prepared.clear()
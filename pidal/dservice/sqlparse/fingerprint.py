@@ -0,0 +1,50 @@
+import re
+
+from typing import List, Optional, Tuple
+
+# 与 sqlparse 的 lexer 切分字面量的规则保持一致（数字和字符串的正则来自
+# sqlparse.keywords.SQL_REGEX），以字母开头的单词整个跳过，避免把标识符中
+# 的数字当成字面量。
+_TOKEN = re.compile(r"""
+    (?P<skip>(?:--|\#\s)[^\r\n]*|/\*.*?\*/|\s+|`(?:``|[^`])*`
+        |(?!X')[^\W\d][$\#\w]*)
+    |(?P<placeholder>\?|%(?:\(\w+\))?s|(?<!\w)[$:]\w+)
+    |(?P<number>X'[\dA-F]*'|-?0x[\dA-F]+
+        |-?\d+(?:\.\d+)?E-?\d+
+        |(?![_A-ZÀ-Ü])-?(?:\d+(?:\.\d*)|\.\d+)(?![_A-ZÀ-Ü])
+        |(?![_A-ZÀ-Ü])-?\d+(?![_A-ZÀ-Ü]))
+    |(?P<string>'(?:''|\\'|[^'])*'|"(?:""|\\"|[^"])*")
+    |(?P<end>;)
+    """, re.IGNORECASE | re.UNICODE | re.VERBOSE | re.DOTALL)
+
+
+def fingerprint(sql: str) -> Optional[Tuple[str, str, List[str]]]:
+    """
+    把 SQL 中的数字和字符串字面量替换成 `?`。
+    返回 (替换后的 SQL, 缓存的 key, 原样的字面量)，key 中包含了每个字面量
+    是数字还是字符串，因为两者在解析时的含义不同（如 limit 只能是数字）。
+    含有占位符或者多条语句时返回 None，这些 SQL 不能使用缓存。
+    """
+    parts: List[str] = []
+    kinds: List[str] = []
+    literals: List[str] = []
+    last = 0
+    for m in _TOKEN.finditer(sql):
+        kind = m.lastgroup
+        if kind == "skip":
+            continue
+        if kind == "placeholder":
+            return None
+        if kind == "end":
+            if sql[m.end():].strip():
+                return None
+            continue
+        start = m.start()
+        parts.append(sql[last:start])
+        parts.append("?")
+        literals.append(m.group())
+        kinds.append("n" if kind == "number" else "s")
+        last = m.end()
+    parts.append(sql[last:])
+    text = "".join(parts)
+    return text, text + "\0" + "".join(kinds), literals
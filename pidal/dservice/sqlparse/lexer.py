@@ -0,0 +1,428 @@
+import re
+
+from typing import Dict, List, Optional, Tuple, Type
+
+from pidal.dservice.sqlparse.literal import decode
+from pidal.dservice.sqlparse.paser import SQL, Select, Update, Insert, \
+    Delete, Parser, AGGREGATES
+from pidal.dservice.sqlparse.template import Slot, Template
+
+# 数字的规则与 sqlparse 一致，`-1` 是一个数字，`X'4142'` 与 `0x4142` 一样是
+# 十六进制的数字
+_TOKEN = re.compile(r"""
+    (?P<space>\s+)
+    |(?P<name>`(?:``|[^`])*`|(?!X')[^\W\d][$\w]*)
+    |(?P<number>X'[\dA-F]*'|-?0x[\dA-F]+(?![\w$])|-?\d+(?:\.\d*)?(?:E-?\d+)?(?![\w$])
+        |-?\.\d+(?:E-?\d+)?(?![\w$]))
+    |(?P<string>'(?:''|\\.|[^'\\])*'|"(?:""|\\.|[^"\\])*")
+    |(?P<op><=>|<=|>=|<>|!=|[=<>])
+    |(?P<arith>[-+])
+    |(?P<punct>[(),;*.])
+    |(?P<other>--|/\*|\#|.)
+    """, re.IGNORECASE | re.UNICODE | re.VERBOSE | re.DOTALL)
+
+_SPACE = re.compile(r"\s+")
+
+# (类型, 原文, 开始位置, 结束位置)，类型为 name 时原文是大写的
+Token = Tuple[str, str, int, int]
+
+
+class Lexer(object):
+    """
+    只识别点查和简单写入的 SQL，直接生成 Select/Update/Insert/Delete，
+    不使用 sqlparse：
+
+        SELECT ... FROM t [WHERE c = v [AND c = v]...] [FOR UPDATE] [LIMIT n]
+        UPDATE t SET c = v[, c = v]... WHERE c = v [AND c = v]... [LIMIT n]
+        INSERT [INTO] t (c[, c]...) VALUES (v[, v]...)[, (v[, v]...)]...
+        DELETE FROM t WHERE c = v [AND c = v]... [LIMIT n]
+
+    其他的 SQL 返回 None，由 sqlparse 解析。
+    """
+
+    __slots__ = ("sql", "tokens", "pos")
+
+    def __init__(self, sql: str):
+        self.sql: str = sql
+        self.tokens: List[Token] = []
+        self.pos: int = 0
+
+    @classmethod
+    def parse(cls, sql: str) -> Optional[SQL]:
+        lexer = cls(sql)
+        if not lexer.tokenize():
+            return None
+        first = lexer.peek_word()
+        if first == "SELECT":
+            return lexer.parse_select()
+        elif first == "UPDATE":
+            return lexer.parse_update()
+        elif first == "INSERT":
+            return lexer.parse_insert()
+        elif first == "DELETE":
+            return lexer.parse_delete()
+        return None
+
+    def tokenize(self) -> bool:
+        tokens = self.tokens
+        for m in _TOKEN.finditer(self.sql):
+            kind = m.lastgroup
+            if kind == "space":
+                continue
+            if kind == "other":
+                # 注释、变量等都交给 sqlparse
+                return False
+            value = m.group()
+            if kind == "name" and value[0] != "`":
+                value = value.upper()
+            tokens.append((kind, value, m.start(), m.end()))  # type: ignore
+        # 结尾的分号
+        while tokens and tokens[-1][1] == ";":
+            tokens.pop()
+        for t in tokens:
+            if t[1] == ";":
+                return False
+        return bool(tokens)
+
+    def peek(self) -> Optional[Token]:
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def peek_word(self) -> Optional[str]:
+        t = self.peek()
+        if t is None or t[0] != "name":
+            return None
+        return t[1]
+
+    def accept(self, word: str) -> Optional[Token]:
+        t = self.peek()
+        if t is not None and t[0] == "name" and t[1] == word:
+            self.pos += 1
+            return t
+        return None
+
+    def at_end(self) -> bool:
+        return self.pos >= len(self.tokens)
+
+    def text(self, start: int, end: int) -> str:
+        """ 原文，连续的空白合并成一个空格，与 sqlparse.format 一致 """
+        return _SPACE.sub(" ", self.sql[start:end])
+
+    def source(self, t: Token) -> str:
+        return self.sql[t[2]:t[3]]
+
+    def table(self) -> Optional[Token]:
+        t = self.peek()
+        if t is None or t[0] != "name" or t[1] in _KEYWORDS:
+            return None
+        self.pos += 1
+        # db.table 交给 sqlparse
+        n = self.peek()
+        if n is not None and n[1] == ".":
+            return None
+        return t
+
+    def column(self) -> Optional[str]:
+        t = self.peek()
+        if t is None or t[0] != "name" or t[1] in _KEYWORDS:
+            return None
+        self.pos += 1
+        return self.source(t)
+
+    def literal(self) -> Optional[Token]:
+        t = self.peek()
+        if t is None:
+            return None
+        if t[0] in ("number", "string") or (t[0] == "name" and
+                                             t[1] == "NULL"):
+            self.pos += 1
+            return t
+        return None
+
+    def value(self) -> Optional[Token]:
+        """ 字面量、列或者 `列 +/- 数字`，返回最后一个 token """
+        v = self.literal()
+        if v is not None:
+            return v
+        if self.column() is None:
+            return None
+        end = self.tokens[self.pos - 1]
+        t = self.peek()
+        if t is not None and t[0] == "arith":
+            self.pos += 1
+            t = self.peek()
+            if t is None or t[0] != "number":
+                return None
+            self.pos += 1
+            end = t
+        elif t is not None and t[0] == "number" and t[1][0] == "-":
+            # `v -1` 在 sqlparse 中也是列和一个负数
+            self.pos += 1
+            end = t
+        return end
+
+    def where(self) -> Optional[Tuple[Dict[str, str], Dict[str, str]]]:
+        """ c = v [AND c = v]...，返回 (column, raw_where) """
+        column: Dict[str, str] = {}
+        raw_where: Dict[str, str] = {}
+        while True:
+            name = self.column()
+            if name is None:
+                return None
+            op = self.peek()
+            if op is None or op[1] != "=":
+                return None
+            self.pos += 1
+            v = self.literal()
+            if v is None:
+                return None
+            value = self.source(v)
+            raw_where[name] = value
+            if v[0] == "number" or (v[0] == "string" and value[0] == "'"):
+                column[name] = decode(value)
+            if not self.accept("AND"):
+                return column, raw_where
+
+    def limit(self) -> bool:
+        if self.accept("LIMIT"):
+            t = self.peek()
+            if t is None or t[0] != "number":
+                return False
+            self.pos += 1
+        return self.at_end()
+
+    def parse_select(self) -> Optional[SQL]:
+        self.pos += 1
+        distinct = self.peek_word() in ("DISTINCT", "DISTINCTROW")
+        depth = 0
+        # select 的列中不能有子查询
+        while True:
+            t = self.peek()
+            if t is None:
+                return None
+            if t[1] == "(":
+                depth += 1
+            elif t[1] == ")":
+                depth -= 1
+            elif t[0] == "name" and t[1] == "SELECT":
+                return None
+            elif t[0] == "name" and t[1].upper() in AGGREGATES:
+                # 聚合需要解析 select 的列，使用 sqlparse
+                return None
+            elif depth == 0 and t[0] == "name" and t[1] == "FROM":
+                break
+            self.pos += 1
+        self.pos += 1
+        table = self.table()
+        if table is None:
+            return None
+        sql = self.new(Select, table)
+        sql.distinct = distinct
+        w = self.peek()
+        if self.accept("WHERE"):
+            r = self.where()
+            if r is None:
+                return None
+            sql.column, sql.raw_where = r
+        limit = None
+        t = self.accept("LIMIT")
+        if t is not None:
+            limit = self.select_limit()
+            if limit is None:
+                return None
+            sql.limit = limit[0]
+            limit = (t[2], limit[2])
+        if self.accept("FOR"):
+            if not self.accept("UPDATE"):
+                return None
+            sql.for_update = True
+        if not self.at_end():
+            return None
+        self.set_template(sql, table, w if w and w[1] == "WHERE" else None,
+                          limit=limit)
+        return sql
+
+    def select_limit(self) -> Optional[Tuple[Tuple[str, str], int, int]]:
+        """
+        LIMIT 之后的 `n`、`o, n` 和 `n OFFSET o`，
+        返回 ((offset, count), 开始位置, 结束位置)
+        """
+        first = self.peek()
+        if first is None or first[0] != "number" or not first[1].isdigit():
+            return None
+        self.pos += 1
+        last = first
+        if self.punct(",") or self.accept("OFFSET"):
+            last = self.peek()
+            if last is None or last[0] != "number" or \
+                    not last[1].isdigit():
+                return None
+            self.pos += 1
+            if self.tokens[self.pos - 2][1] == ",":
+                return (first[1], last[1]), first[2], last[3]
+            return (last[1], first[1]), first[2], last[3]
+        return ("0", first[1]), first[2], first[3]
+
+    def parse_update(self) -> Optional[SQL]:
+        self.pos += 1
+        table = self.table()
+        if table is None or not self.accept("SET"):
+            return None
+        sql = self.new(Update, table)
+        while True:
+            name = self.column()
+            op = self.peek()
+            if name is None or op is None or op[1] != "=":
+                return None
+            self.pos += 1
+            end = self.value()
+            if end is None:
+                return None
+            sql.new_value[name] = decode(self.text(op[3], end[3]).strip())
+            if not self.punct(","):
+                break
+        w = self.accept("WHERE")
+        if w is None:
+            return None
+        r = self.where()
+        if r is None or not self.limit():
+            return None
+        sql.column, sql.raw_where = r
+        self.set_template(sql, table, w, pidal=True)
+        return sql
+
+    def parse_delete(self) -> Optional[SQL]:
+        self.pos += 1
+        if not self.accept("FROM"):
+            return None
+        table = self.table()
+        if table is None:
+            return None
+        sql = self.new(Delete, table)
+        w = self.accept("WHERE")
+        if w is None:
+            return None
+        r = self.where()
+        if r is None or not self.limit():
+            return None
+        sql.column, sql.raw_where = r
+        self.set_template(sql, table, w, pidal=True)
+        return sql
+
+    def parse_insert(self) -> Optional[SQL]:
+        self.pos += 1
+        self.accept("INTO")
+        table = self.table()
+        if table is None or not self.punct("("):
+            return None
+        columns = []
+        while True:
+            name = self.column()
+            if name is None:
+                return None
+            columns.append(name)
+            if not self.punct(","):
+                break
+        column_end = self.peek()
+        if not self.punct(")") or not self.accept("VALUES"):
+            return None
+        rows = []
+        row_texts = []
+        rows_start = self.peek()
+        while True:
+            row_start = self.peek()
+            if not self.punct("("):
+                return None
+            values = []
+            while True:
+                v = self.literal()
+                if v is None:
+                    return None
+                values.append(decode(self.source(v)))
+                if not self.punct(","):
+                    break
+            value_end = self.peek()
+            if not self.punct(")") or len(columns) != len(values):
+                return None
+            rows.append(dict(zip(columns, values)))
+            row_texts.append(self.text(row_start[3], value_end[2]))  # type: ignore # noqa
+            if not self.punct(","):
+                break
+        if not self.at_end():
+            return None
+        sql = self.new(Insert, table)
+        sql.rows = rows
+        sql.row_texts = row_texts
+        sql.multi_row = len(rows) > 1
+        sql.new_value = rows[0]
+        sql.column = dict(rows[0])
+        points = [(table[2], table[3], Slot.TABLE),
+                  (column_end[2], column_end[2], Slot.PIDAL_COLUMN)]  # type: ignore # noqa
+        if sql.multi_row:
+            points.append((rows_start[2], value_end[3], Slot.ROWS))  # type: ignore # noqa
+        else:
+            points.append((value_end[2], value_end[2], Slot.PIDAL_VALUE))  # type: ignore # noqa
+        sql.template = self.build(points)
+        return sql
+
+    def punct(self, p: str) -> bool:
+        t = self.peek()
+        if t is not None and t[1] == p and t[0] == "punct":
+            self.pos += 1
+            return True
+        return False
+
+    def new(self, cls: Type[SQL], table: Token) -> SQL:
+        sql = cls.__new__(cls)
+        sql.raw = None
+        sql.init_attrs()
+        sql.table = self.source(table)  # type: ignore
+        return sql
+
+    def set_template(self, sql: SQL, table: Token, where: Optional[Token],
+                     pidal: bool = False,
+                     limit: Optional[Tuple[int, int]] = None):
+        points = [(table[2], table[3], Slot.TABLE)]
+        if where is not None:
+            s = where[2]
+            if pidal:
+                points.append((s, s, Slot.PIDAL_SET if isinstance(
+                    sql, Update) else None))
+            points.append((s, s, Slot.WHERE))
+            if pidal:
+                points.append((where[3], where[3], Slot.PIDAL_WHERE))
+        if limit:
+            points.append((limit[0], limit[1], Slot.LIMIT))
+        sql.template = self.build([i for i in points if i[2] is not None])
+
+    def build(self, points: List[Tuple[int, int, Slot]]) -> Template:
+        """ points: (开始位置, 结束位置, slot)，开始和结束之间的原文被替换 """
+        parts = []
+        slots = []
+        where = None
+        last = 0
+        for start, end, slot in points:
+            parts.append(self.sql[last:start])
+            if slot is Slot.WHERE:
+                where = len(slots)
+            slots.append((slot, 0))
+            last = end
+        parts.append(self.sql[last:])
+        return Template(parts, slots, where)
+
+
+def parse(sql: str) -> List[SQL]:
+    """ 先使用 Lexer 解析，不能识别的 SQL 再使用 sqlparse """
+    s = Lexer.parse(sql)
+    if s is not None:
+        return [s]
+    return Parser.parse(sql)
+
+
+_KEYWORDS = frozenset(("SELECT", "FROM", "WHERE", "AND", "OR", "NOT", "SET",
+                       "VALUES", "INTO", "LIMIT", "FOR", "UPDATE", "DELETE",
+                       "INSERT", "NULL", "ORDER", "GROUP", "HAVING", "JOIN",
+                       "AS", "ON", "IN", "IS", "LIKE", "BETWEEN", "UNION",
+                       "LOCK", "USING", "DUAL", "INNER", "LEFT", "RIGHT",
+                       "OFFSET"))
@@ -0,0 +1,31 @@
+import re
+
+# MySQL 字符串中反斜杠转义的字符，`\%` 和 `\_` 保留反斜杠，其他的去掉反斜杠
+_ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t",
+            "Z": "\x1a", "%": "\\%", "_": "\\_"}
+
+# 引号 -> 匹配转义和连续两个同样的引号
+_QUOTED = {q: re.compile(r"\\(.)|" + q + q, re.DOTALL) for q in "'\""}
+
+# `0x4142` 和 `X'4142'`，规则与 lexer 一致
+_HEX = re.compile(r"0x([\dA-F]+)|X'([\dA-F]*)'", re.IGNORECASE)
+
+
+def decode(literal: str) -> str:
+    """
+    SQL 中的字面量转换成它表示的值，用于计算分片：字符串去掉引号并处理转义，
+    十六进制按它表示的字符串（与 prepare 时 bytes 类型的参数一致），
+    其他的（数字、NULL、表达式等）原样返回。
+    """
+    quote = literal[:1]
+    if quote in ("'", '"') and len(literal) > 1 and literal[-1] == quote:
+        return _QUOTED[quote].sub(
+                lambda m: quote if m.group(1) is None else
+                _ESCAPES.get(m.group(1), m.group(1)), literal[1:-1])
+    m = _HEX.fullmatch(literal)
+    if m is not None:
+        h = m.group(1) if m.group(1) is not None else m.group(2)
+        if len(h) % 2:
+            h = "0" + h
+        return bytes.fromhex(h).decode("utf8", "surrogateescape")
+    return literal
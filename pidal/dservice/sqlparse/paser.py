@@ -1,17 +1,63 @@
-from typing import List, Optional, Dict
+import copy
+import re
+
+from typing import List, Optional, Dict, Tuple
 
 import sqlparse
+from sqlparse import keywords
+from sqlparse.engine import grouping
+from sqlparse.engine.statement_splitter import StatementSplitter
+from sqlparse.exceptions import SQLParseError
+from sqlparse.lexer import Lexer
 from sqlparse.sql import IdentifierList, Identifier, Where, Comparison, Token,\
         Parenthesis, Function, Values
 import sqlparse.tokens as token
 from sqlparse.sql import Statement
 
+from pidal.dservice.sqlparse.literal import decode
+from pidal.dservice.sqlparse.template import Mark, Marks, Slot, Template, \
+        PIDAL_VALUE
+
+
+# from 之后表名结束的关键字
+TABLE_END_KEYWORDS = frozenset(("ORDER BY", "GROUP BY", "HAVING", "LIMIT",
+                                "FOR", "UNION", "LOCK"))
+
+# 可以在分表上部分聚合再合并的函数
+AGGREGATES = frozenset(("COUNT", "SUM", "MIN", "MAX", "AVG"))
+_AGGREGATE_CALL = re.compile(r"\b(COUNT|SUM|MIN|MAX|AVG)\s*\(", re.I)
+
+# 范围条件的比较符，以及 column 在右边时换成的比较符
+_REVERSED = {"<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+# sqlparse 不识别 `X'4142'`，`0x4142` 的类型 Hexadecimal 也不会被分组到比较、
+# 列表中。两种十六进制都作为 Number，与其他数字一样分组，值由 decode 转换。
+# 使用自己的 Lexer，不修改 sqlparse 默认的 Lexer
+_LEXER = Lexer()
+_LEXER.default_initialization()
+_LEXER.set_SQL_REGEX(
+        [(r"-?0x[\dA-F]+|X'[\dA-F]*'", token.Number)] + keywords.SQL_REGEX)
+
 
 class SQL(object):
+
     def __init__(self, raw: Statement):
         self.raw = raw
+        self.init_attrs()
+
+    def init_attrs(self):
+        """ 解析前每个实例的属性，Lexer 创建时不调用 __init__，只调用这里 """
         self.raw_where = {}
         self.new_value = {}
+        # 改写表名、pidal_c 时使用 template 渲染，不会修改 raw 再转换成字符串
+        self.template: Optional[Template] = None
+        self.params: List[str] = []
+        # where 中的 `column IN (...)`: (column, 值的字面量)，字符串带引号
+        self.in_lists: List[Tuple[str, List[str]]] = []
+        # where 中的范围条件 `column > 1`、`column BETWEEN 1 AND 9`:
+        # (column, 比较符, 值的字面量)，between 拆成 >= 和 <=
+        self.ranges: List[Tuple[str, str, str]] = []
+        self._in_tokens: List[Parenthesis] = []
 
     def has_table(self) -> bool:
         return hasattr(self, "table")
@@ -19,6 +65,63 @@ class SQL(object):
     def add_pidal(self, _: int):  # type: ignore
         pass
 
+    def to_sql(self) -> str:
+        if self.template is None:
+            return str(self.raw)
+        table = str(self.table) if self.has_table() else None
+        return self.template.render(self.params, table,
+                                    getattr(self, "pidal_c", None),
+                                    in_lists=self.in_lists,
+                                    limit=getattr(self, "limit", None),
+                                    columns=getattr(self, "select_list",
+                                                    None))
+
+    def split_in(self, index: int, values: List[str]) -> 'SQL':
+        """ 把第 index 个 in 的值换成 values，用于按分片拆分 in 查询 """
+        self.compile_template()
+        sql = copy.copy(self)
+        column = self.in_lists[index][0]
+        sql.in_lists = list(self.in_lists)
+        sql.in_lists[index] = (column, values)
+        sql.column = dict(getattr(self, "column", None) or {})
+        sql.column[column] = decode(values[0])
+        return sql
+
+    def compile_template(self):
+        """ 第一次改写前编译 Template，之后的改写只是替换 slot 的值 """
+        if self.template is None:
+            self.template = Template.compile(self.raw, self.template_marks())
+
+    def template_marks(self) -> Marks:
+        """ 编译 Template 时需要改写的位置，key 为 token 的 id """
+        marks: Marks = {}
+        if self.has_table():
+            self._add_mark(marks, self._first_leaf(self.table), Mark.REPLACE,
+                           Slot.TABLE)
+        for n, i in enumerate(self._in_tokens):
+            leaves = list(i.flatten())
+            self._add_mark(marks, leaves[0], Mark.REPLACE, Slot.IN_LIST, n)
+            for j in leaves[1:]:
+                self._add_mark(marks, j, Mark.DROP, Slot.IN_LIST)
+        return marks
+
+    @staticmethod
+    def _add_mark(marks: Marks, t: Token, position: Mark, kind: Slot,
+                  arg: int = 0):
+        marks.setdefault(id(t), []).append((position, kind, arg))
+
+    @staticmethod
+    def _first_leaf(t: Token) -> Token:
+        if t.is_group:
+            return next(t.flatten())
+        return t
+
+    @staticmethod
+    def _last_leaf(t: Token) -> Token:
+        if t.is_group:
+            return list(t.flatten())[-1]
+        return t
+
     def parse_table_name(self):
         fl = self._get_from_part()
         if not fl:
@@ -30,21 +133,44 @@ class SQL(object):
 
     def parse_where(self, where) -> Dict[str, int]:
         column = {}
-        for i in where[1:]:
-            if isinstance(i, Token) and i.ttype is token.Whitespace:
-                continue
+        tokens = [i for i in where[1:] if not (
+            isinstance(i, Token) and i.ttype is token.Whitespace)]
+        for n, i in enumerate(tokens):
             if isinstance(i, Comparison):
                 r = self._parse_comparison(i)
                 if r:
                     column[r[0]] = r[1]
                 continue
             elif isinstance(i, Parenthesis):
+                if n > 1 and tokens[n - 1].ttype is token.Keyword and \
+                        tokens[n - 1].normalized == "IN" and \
+                        isinstance(tokens[n - 2], Identifier):
+                    self._parse_in(tokens[n - 2].value, i)
+                    continue
                 column.update(self.parse_where(i.tokens))
                 continue
         return column
 
+    def _parse_in(self, column: str, s: Parenthesis):
+        """ 只记录值全部是字面量的 in """
+        values = []
+        for i in s.tokens[1:-1]:
+            items = i.tokens if isinstance(i, IdentifierList) else [i]
+            for j in items:
+                if j.ttype in (token.Whitespace, token.Punctuation):
+                    continue
+                if j.ttype not in token.Number and \
+                        j.ttype not in token.String:
+                    return
+                values.append(j.value)
+        if not values:
+            return
+        self.in_lists = self.in_lists + [(column, values)]
+        self._in_tokens = self._in_tokens + [s]
+
     def modify_table(self, name: str):
-        self.table[0].value = name
+        self.compile_template()
+        self.table = name
 
     def _parse_comparison(self, s: Comparison):
         column = None
@@ -60,8 +186,9 @@ class SQL(object):
                 if i.value != "=":
                     return
             self.raw_where[column] = i.value
-            if i.ttype in token.Number:
-                return (column, i.value)
+            if i.ttype in token.Number or i.ttype in token.String.Single:
+                # 字面量转换成它表示的值作为分片键，与 insert 的值一致
+                return (column, decode(i.value))
 
     def _get_where_part(self):
         for item in self.raw.tokens:
@@ -95,6 +222,9 @@ class SQL(object):
         for item in token_stream:
             if isinstance(item, Where):
                 break
+            elif item.ttype is token.Keyword and \
+                    item.normalized in TABLE_END_KEYWORDS:
+                break
             elif isinstance(item, IdentifierList):
                 for identifier in item.get_identifiers():
                     tables.append(identifier)
@@ -104,19 +234,17 @@ class SQL(object):
 
 
 class Other(SQL):
-
-    def __init__(self, raw: Statement):
-        self.raw = raw
+    pass
 
 
 class TCL(SQL):
     def __init__(self, raw: Statement):
+        super().__init__(raw)
         self.is_commit: bool = False
         self.is_rollback: bool = False
         self.is_start: bool = False
         self.trans_args: Optional[List[str]] = None
 
-        self.raw = raw
         self.parse()
 
     def modify_table(self, name: str):  # type:ignore
@@ -148,7 +276,7 @@ class TCL(SQL):
 class DML(SQL):
 
     def __init__(self, raw: Statement):
-        self.raw = raw
+        super().__init__(raw)
         self.table: Identifier
         self.column: Dict[str, int]
 
@@ -156,51 +284,301 @@ class DML(SQL):
 class Select(DML):
 
     def __init__(self, raw: Statement):
+        super().__init__(raw)
         self.table_name: str
-        self.column: Dict[str, int]
-        self.for_update: bool = False
-        self.raw_where = {}
-        self.new_value = {}
-
-        self.raw = raw
         self.parse()
 
+    def init_attrs(self):
+        super().init_attrs()
+        self.for_update: bool = False
+        # order by 的 (column, 是否 desc)，column 为数字时是 select 中的位置
+        self.order_by: List[Tuple[str, bool]] = []
+        # limit 的 (offset, count)，原样的字面量
+        self.limit: Optional[Tuple[str, str]] = None
+        self._limit_tokens: Optional[Tuple[Token, Token]] = None
+        # 有聚合函数或者 group by 时 select 的每一列:
+        # (聚合函数, 参数, 原文, 列名)，普通列的聚合函数和参数为 None。
+        # 有不能在分表上合并的写法时为空
+        self.select_items: \
+            List[Tuple[Optional[str], Optional[str], str, str]] = []
+        self.group_by: List[str] = []
+        # 分表上执行的 select 的列，select_items 不为空时才会使用
+        self.select_list: Optional[str] = None
+        # 有聚合、group by 或者 having，但是分表的结果不能合并时为不支持的
+        # 写法，在多个分表上执行时返回错误
+        self.unsupported: Optional[str] = None
+        # select distinct，在多个分表上执行时合并后需要去重
+        self.distinct: bool = False
+        self._columns_token: Optional[Token] = None
+
     def parse(self):
         self.parse_table_name()
+        self._parse_order_by()
+        self._parse_limit()
+        self._parse_for_update()
+        self._parse_select_items()
         where = self._get_where_part()
         if not where:
             return
         self.column = self.parse_where(where)
-        self._parse_for_update(where)
+        self._parse_ranges(where)
+
+    def _parse_ranges(self, where: Where):
+        """ 只在 where 中没有 OR 时记录范围条件，用于裁剪分表 """
+        for i in where.flatten():
+            if i.ttype is token.Keyword and i.normalized in ("OR", "XOR"):
+                return
+        ranges: List[Tuple[str, str, str]] = []
+        self._collect_ranges(where.tokens[1:], ranges)
+        if ranges:
+            self.ranges = ranges
+
+    def _collect_ranges(self, tokens: List[Token],
+                        ranges: List[Tuple[str, str, str]]):
+        tokens = [i for i in tokens if not i.is_whitespace]
+        for n, i in enumerate(tokens):
+            if n and tokens[n - 1].ttype is token.Keyword and \
+                    tokens[n - 1].normalized == "NOT":
+                continue
+            if isinstance(i, Comparison):
+                r = self._parse_range(i)
+                if r:
+                    ranges.append(r)
+            elif isinstance(i, Parenthesis):
+                self._collect_ranges(i.tokens[1:-1], ranges)
+            elif i.ttype is token.Keyword and i.normalized == "BETWEEN" and \
+                    n and n + 3 < len(tokens) and \
+                    isinstance(tokens[n - 1], Identifier) and \
+                    tokens[n + 2].normalized == "AND" and \
+                    self._is_literal(tokens[n + 1]) and \
+                    self._is_literal(tokens[n + 3]):
+                column = tokens[n - 1].value
+                ranges.append((column, ">=", tokens[n + 1].value))
+                ranges.append((column, "<=", tokens[n + 3].value))
 
-    def _parse_for_update(self, where):
+    @staticmethod
+    def _is_literal(t: Token) -> bool:
+        return t.ttype in token.Number or t.ttype in token.String.Single
+
+    def _parse_range(self, s: Comparison) -> \
+            Optional[Tuple[str, str, str]]:
+        """ `column < 1` 或者 `1 > column`，值只能是数字或字符串 """
+        tokens = [i for i in s.tokens if not i.is_whitespace]
+        if len(tokens) != 3 or tokens[1].ttype is not token.Comparison:
+            return None
+        left, op, right = tokens
+        if op.value not in _REVERSED:
+            return None
+        if isinstance(left, Identifier) and self._is_literal(right):
+            return (left.value, op.value, right.value)
+        if isinstance(right, Identifier) and self._is_literal(left):
+            return (right.value, _REVERSED[op.value], left.value)
+        return None
+
+    def _parse_for_update(self):
+        # FOR UPDATE 在 where 中或者在 limit 之后
         tokens = []
-        for v in where:
+        for v in self.raw.flatten():
             if v.ttype in (token.Keyword, token.DML):
                 tokens.append(v)
         if len(tokens) < 2:
             self.for_update = False
             return
-        if tokens[-1].value == "UPDATE" and tokens[-2].value == "FOR":
+        if tokens[-1].normalized == "UPDATE" and \
+                tokens[-2].normalized == "FOR":
             self.for_update = True
 
     def is_for_update(self) -> bool:
         return self.for_update
 
+    def _parse_order_by(self):
+        seen = False
+        items: List[List[Token]] = [[]]
+        for i in self.raw.tokens:
+            if not seen:
+                seen = i.ttype is token.Keyword and i.normalized == "ORDER BY"
+                continue
+            if i.ttype is token.Keyword or i.ttype is token.Punctuation and \
+                    i.value == ";":
+                break
+            for j in (i.tokens if isinstance(i, IdentifierList) else [i]):
+                if j.ttype is token.Punctuation and j.value == ",":
+                    items.append([])
+                elif not j.is_whitespace:
+                    items[-1].append(j)
+        self.order_by = [self._parse_order_item(i) for i in items if i]
+
+    @staticmethod
+    def _parse_order_item(item: List[Token]) -> Tuple[str, bool]:
+        """ 如 `t.a DESC`、`count(*) DESC`、`2` """
+        first = item[0]
+        desc = any(i.ttype is token.Keyword.Order and i.normalized == "DESC"
+                   for j in item for i in j.flatten())
+        if isinstance(first, Identifier):
+            if first.get_ordering():
+                first = first.tokens[0]
+            if isinstance(first, Identifier):
+                return first.get_real_name().strip("`"), desc
+        return str(first).strip("`"), desc
+
+    def _parse_limit(self):
+        """ `LIMIT n`、`LIMIT o, n`、`LIMIT n OFFSET o` """
+        tokens = [i for i in self.raw.tokens if not i.is_whitespace]
+        for n, i in enumerate(tokens[:-1]):
+            if i.ttype is not token.Keyword or i.normalized != "LIMIT":
+                continue
+            start = end = tokens[n + 1]
+            if isinstance(start, IdentifierList):
+                items = list(start.get_identifiers())
+            else:
+                items = [start]
+                if n + 3 < len(tokens) and \
+                        tokens[n + 2].ttype is token.Keyword and \
+                        tokens[n + 2].normalized == "OFFSET":
+                    end = tokens[n + 3]
+                    items = [end, start]
+            if len(items) > 2 or \
+                    any(j.ttype not in token.Number.Integer for j in items):
+                return
+            offset = items[0].value if len(items) == 2 else "0"
+            self.limit = (offset, items[-1].value)
+            self._limit_tokens = (i, end)
+            return
+
+    def _parse_select_items(self):
+        tokens = [i for i in self.raw.tokens if not i.is_whitespace]
+        end = len(tokens)
+        for n, i in enumerate(tokens):
+            if i.ttype is token.Keyword and i.normalized == "FROM":
+                end = n
+                break
+        start = 1
+        if len(tokens) > 1 and tokens[1].ttype is token.Keyword and \
+                tokens[1].normalized in ("DISTINCT", "DISTINCTROW"):
+            self.distinct = True
+            start = 2
+        text = " ".join(str(i) for i in tokens[start:end])
+        group_by = self._parse_group_by()
+        if any(i.ttype is token.Keyword and i.normalized == "HAVING"
+               for i in tokens):
+            self.unsupported = "HAVING"
+            return
+        if group_by is None:
+            self.unsupported = "GROUP BY modifiers"
+            return
+        if not group_by and not _AGGREGATE_CALL.search(text):
+            return
+        # 只有每一列都是普通列或者一个聚合函数时才能合并
+        self.unsupported = "this aggregate"
+        if end != start + 1 or tokens[start].ttype is not None or \
+                "\x00" in text:
+            return
+        columns = tokens[start]
+        items = []
+        for i in (columns.get_identifiers()
+                  if isinstance(columns, IdentifierList) else [columns]):
+            item = self._parse_select_item(i)
+            if item is None:
+                return
+            items.append(item)
+        self.unsupported = None
+        self.select_items = items
+        self.group_by = group_by
+        self.select_list = text
+        self._columns_token = columns
+
+    @staticmethod
+    def _parse_select_item(item: Token) -> \
+            Optional[Tuple[Optional[str], Optional[str], str, str]]:
+        """ 如 `a`、`count(*)`、`avg(b) AS x`，不能合并时返回 None """
+        text = str(item).strip()
+        expr, alias = item, None
+        if isinstance(item, Identifier) and item.has_alias():
+            expr, alias = item.tokens[0], item.get_alias()
+        if isinstance(expr, Function):
+            name = str(expr.tokens[0]).strip("`").upper()
+            arg = str(expr.tokens[-1]).strip()[1:-1].strip()
+            if name in AGGREGATES and \
+                    not arg.upper().startswith("DISTINCT") and \
+                    not _AGGREGATE_CALL.search(arg):
+                return name, arg, text, alias or str(expr)
+        if _AGGREGATE_CALL.search(text) or \
+                any(i.ttype is token.Wildcard for i in item.flatten()):
+            return None
+        if alias is None and isinstance(item, Identifier):
+            alias = item.get_real_name()
+        return None, None, text, (alias or text).strip("`")
+
+    def _parse_group_by(self) -> Optional[List[str]]:
+        """ group by 的列，有 `WITH ROLLUP` 等时返回 None """
+        seen = False
+        items: List[str] = []
+        for i in self.raw.tokens:
+            if not seen:
+                seen = i.ttype is token.Keyword and i.normalized == "GROUP BY"
+                continue
+            if i.is_whitespace:
+                continue
+            if i.ttype is token.Keyword and \
+                    i.normalized in TABLE_END_KEYWORDS or \
+                    i.ttype is token.Punctuation and i.value == ";":
+                break
+            if i.ttype is not None and i.ttype in token.Keyword:
+                return None
+            for j in (i.get_identifiers()
+                      if isinstance(i, IdentifierList) else [i]):
+                items.append(str(j).strip("`"))
+        return items
+
+    def get_limit(self) -> Optional[Tuple[int, int]]:
+        """ (offset, count)，没有 limit 或者不是数字时返回 None """
+        if self.limit is None:
+            return None
+        try:
+            return int(self.limit[0]), int(self.limit[1])
+        except ValueError:
+            return None
+
+    def template_marks(self) -> Marks:
+        marks = super().template_marks()
+        where = self._get_where_part()
+        if where:
+            self._add_mark(marks, where.tokens[0], Mark.BEFORE, Slot.WHERE)
+        if self._columns_token is not None:
+            leaves = list(self._columns_token.flatten())
+            self._add_mark(marks, leaves[0], Mark.REPLACE, Slot.COLUMNS)
+            for i in leaves[1:]:
+                self._add_mark(marks, i, Mark.DROP, Slot.COLUMNS)
+        if self._limit_tokens is not None:
+            tokens = self.raw.tokens
+            start = tokens.index(self._limit_tokens[0])
+            end = tokens.index(self._limit_tokens[1])
+            leaves = [j for i in tokens[start:end + 1] for j in i.flatten()]
+            self._add_mark(marks, leaves[0], Mark.REPLACE, Slot.LIMIT)
+            for i in leaves[1:]:
+                self._add_mark(marks, i, Mark.DROP, Slot.LIMIT)
+        return marks
+
 
 class DMLW(DML):
-    pass
+
+    def get_where_sql(self) -> str:
+        """ where 部分的 SQL，包括已经增加的 pidal_c 条件 """
+        if self.template is not None:
+            return self.template.render_where(self.params,
+                                              getattr(self, "pidal_c", None),
+                                              self.in_lists)
+        return str(self.get_where()).rstrip("; \n")
+
+    def get_where(self):
+        return self._get_where_part()
 
 
 class Delete(DMLW):
 
     def __init__(self, raw: Statement):
+        super().__init__(raw)
         self.table_name: str
-        self.column: Dict[str, int]
-        self.raw_where = {}
-        self.new_value = {}
-
-        self.raw = raw
         self.parse()
 
     def parse(self):
@@ -208,30 +586,27 @@ class Delete(DMLW):
         where = self._get_where_part()
         self.column = self.parse_where(where)
 
-    def get_where(self):
-        return self._get_where_part()
-
-    def add_pidal(self, _: int):  # type: ignore
+    def add_pidal(self, value: int):  # type: ignore
         if getattr(self, "pidal_c", None):
             return
-        self.pidal_c = True
-        for item in self.raw.tokens:
-            if item.is_group and isinstance(item, Where):
-                c = sqlparse.parse(" pidal_c & 1 AND ")
-                c[0].tokens.reverse()
-                for v in c[0].tokens:
-                    item.insert_before(1, v)
+        self.compile_template()
+        self.pidal_c = value
+
+    def template_marks(self) -> Marks:
+        marks = super().template_marks()
+        where = self._get_where_part()
+        if where:
+            self._add_mark(marks, where.tokens[0], Mark.BEFORE, Slot.WHERE)
+            self._add_mark(marks, where.tokens[0], Mark.AFTER,
+                           Slot.PIDAL_WHERE)
+        return marks
 
 
 class Update(DMLW):
 
     def __init__(self, raw: Statement):
+        super().__init__(raw)
         self.table_name: str
-        self.column: Dict[str, int]
-        self.raw_where = {}
-        self.new_value = {}
-
-        self.raw = raw
         self.parse()
 
     def parse(self):
@@ -265,7 +640,7 @@ class Update(DMLW):
             if not isinstance(new_set[0], Identifier) or \
                     new_set[1].value != "=":
                 raise Exception("pidal  not support sql.")
-            self.new_value[new_set[0].value] = str(new_set[2]).strip("'\"")
+            self.new_value[new_set[0].value] = decode(str(new_set[2]))
 
     def _get_from_part(self):
         for i, item in enumerate(self.raw.tokens):
@@ -290,34 +665,37 @@ class Update(DMLW):
     def add_pidal(self, value: int):
         if getattr(self, "pidal_c", None):
             return
+        self.compile_template()
         self.pidal_c = value
-        where = None
-        for i, item in enumerate(self.raw.tokens):
-            if item.is_group and isinstance(item, Where):
-                where = item
-                c = sqlparse.parse(" pidal_c & 1 AND ")
-                c[0].tokens.reverse()
-                for i, v in enumerate(c[0].tokens):
-                    item.insert_before(1, v)
-        pidal_c = ", `pidal_c` = {}| CONV(RIGHT(BIN(`pidal_c`), 21), 2, 10)+2 "
-        for i in sqlparse.parse(pidal_c.format(value))[0].tokens:
-            self.raw.insert_before(where, i)
+
+    def template_marks(self) -> Marks:
+        marks = super().template_marks()
+        where = self._get_where_part()
+        if where:
+            self._add_mark(marks, where.tokens[0], Mark.BEFORE,
+                           Slot.PIDAL_SET)
+            self._add_mark(marks, where.tokens[0], Mark.BEFORE, Slot.WHERE)
+            self._add_mark(marks, where.tokens[0], Mark.AFTER,
+                           Slot.PIDAL_WHERE)
+        return marks
 
 
 class Insert(DMLW):
 
     def __init__(self, raw: Statement):
+        super().__init__(raw)
         self.table_name: str
-        self.column: Dict[str, int]
-        self.raw_where = {}
-        self.new_value = {}
-
         self.table_f: Function
         self.values: Values
-
-        self.raw = raw
         self.parse()
 
+    def init_attrs(self):
+        super().init_attrs()
+        # 每一行的值和 values 中每一行括号内的原文，多行时按行拆分
+        self.rows: List[Dict[str, str]] = []
+        self.row_texts: List[str] = []
+        self.multi_row: bool = False
+
     def parse(self):
         fl = self._get_from_part()
         for i in fl:
@@ -334,35 +712,74 @@ class Insert(DMLW):
         if not column:
             raise Exception("sql error.")
 
-        values = self._parse_values(self.values, column)
-        if not values:
+        rows = self._parse_values(self.values, column)
+        if not rows:
             return
-        self.column = {}
-        for k, v in values.items():
-            self.column[k] = v
-        self.new_value = values
+        self.rows = rows
+        self.row_texts = [str(i)[1:-1] for i in self._row_parens(self.values)]
+        self.multi_row = len(rows) > 1
+        self.column = dict(rows[0])
+        self.new_value = rows[0]
+
+    def split(self, indexes: List[int]) -> 'Insert':
+        """ 取出其中几行组成一个新的 insert，用于按分片拆分多行 insert """
+        self.compile_template()
+        sql = copy.copy(self)
+        sql.rows = [self.rows[i] for i in indexes]
+        sql.row_texts = [self.row_texts[i] for i in indexes]
+        sql.column = dict(sql.rows[0])
+        sql.new_value = sql.rows[0]
+        return sql
+
+    def to_sql(self) -> str:
+        if not self.multi_row or self.template is None:
+            return super().to_sql()
+        pidal_c = getattr(self, "pidal_c", None)
+        pidal = "" if pidal_c is None else PIDAL_VALUE.format(pidal_c)
+        rows = ", ".join("(" + i + pidal + ")" for i in self.row_texts)
+        return self.template.render(self.params, str(self.table), pidal_c,
+                                    rows=rows)
 
     def add_pidal(self, value: int):
         if getattr(self, "pidal_c", None):
             return
+        self.compile_template()
         self.pidal_c = value
-        for i in self.table_f.tokens:
-            if isinstance(i, Parenthesis):
-                for j in i.tokens:
-                    if isinstance(j, IdentifierList):
-                        j.insert_after(len(j.tokens),
-                                       Token(token.Punctuation, ","))
-                        j.insert_after(len(j.tokens),
-                                       sqlparse.parse("pidal_c")[0].tokens[0])
 
-        for i in self.values.tokens:
+    def template_marks(self) -> Marks:
+        marks = super().template_marks()
+        parens = self._row_parens(self.values)
+        if self.multi_row:
+            # 多行时整个 values 由 to_sql 按 row_texts 生成
+            start = self.values.tokens.index(parens[0])
+            end = self.values.tokens.index(parens[-1])
+            leaves = [j for i in self.values.tokens[start:end + 1]
+                      for j in i.flatten()]
+            self._add_mark(marks, leaves[0], Mark.REPLACE, Slot.ROWS)
+            for i in leaves[1:]:
+                self._add_mark(marks, i, Mark.DROP, Slot.ROWS)
+            parens = []
+        fs = [(i, Slot.PIDAL_COLUMN) for i in self.table_f.tokens
+              if isinstance(i, Parenthesis)]
+        fs.extend((i, Slot.PIDAL_VALUE) for i in parens)
+        for i, kind in fs:
+            # 在右括号之前增加 pidal_c
+            leaves = list(i.flatten())
+            if len(leaves) > 2:
+                self._add_mark(marks, leaves[-2], Mark.AFTER, kind)
+        return marks
+
+    @staticmethod
+    def _row_parens(values: Values) -> List[Parenthesis]:
+        """ values 中每一行的括号，之后的 on duplicate key update 等不算 """
+        parens = []
+        for i in values.tokens[1:]:
             if isinstance(i, Parenthesis):
-                for j in i.tokens:
-                    if isinstance(j, IdentifierList):
-                        j.insert_after(len(j.tokens),
-                                       Token(token.Punctuation, ","))
-                        j.insert_after(len(j.tokens),
-                                       Token(token.Number.Integer, value))
+                parens.append(i)
+            elif i.ttype not in (token.Whitespace, token.Newline,
+                                 token.Punctuation):
+                break
+        return parens
 
     def _parse_table(self, table: Function):
         assert isinstance(table, Function)
@@ -380,26 +797,26 @@ class Insert(DMLW):
         return column
 
     @staticmethod
-    def _parse_values(values: Values, column: List[str]):
+    def _parse_values(values: Values,
+                      column: List[str]) -> List[Dict[str, str]]:
         assert isinstance(values, Values)
-        value = None
-        for i in values.tokens:
+        rows = []
+        for i in Insert._row_parens(values):
             if isinstance(i, Parenthesis):
-                if value:
-                    raise Exception("only insert one.")
                 for j in i.tokens:
                     if isinstance(j, IdentifierList):
                         index = 0
                         value = {}
                         for k in j.tokens:
-                            t = str(k.value).strip("\"'")
-                            if not t:
+                            if k.is_whitespace:
                                 continue
-                            if t == ",":
+                            if k.ttype is token.Punctuation and \
+                                    k.value == ",":
                                 index += 1
                             else:
-                                value[column[index]] = t
-        return value
+                                value[column[index]] = decode(str(k.value))
+                        rows.append(value)
+        return rows
 
     def _get_from_part(self):
         has_seen = False
@@ -424,26 +841,33 @@ class Parser(object):
 
     @classmethod
     def parse(cls, sql: str) -> List[SQL]:
+        return [cls.to_sql(s) for s in cls.split(sql)]
+
+    @staticmethod
+    def split(sql: str) -> List[Statement]:
+        """ 与 sqlparse.parse 一样，只是使用 _LEXER """
         sql = sqlparse.format(sql, keyword_case='upper', strip_whitespace=True)
-        statements = sqlparse.parse(sql)
-        result = []
-        for s in statements:
-            s_type = s.get_type()
-            if s_type == "SELECT":
-                c = cls.to_select(s)
-            elif s_type == "INSERT":
-                c = cls.to_insert(s)
-            elif s_type == "UPDATE":
-                c = cls.to_update(s)
-            elif s_type == "DELETE":
-                c = cls.to_delete(s)
-            elif s_type in ("START", "COMMIT", "ROLLBACK"):
-                c = cls.to_tcl(s)
-            else:
-                c = cls.to_other(s)
-            result.append(c)
+        try:
+            return [grouping.group(i) for i in
+                    StatementSplitter().process(_LEXER.get_tokens(sql))]
+        except RecursionError as e:
+            raise SQLParseError("Maximum recursion depth exceeded") from e
 
-        return result
+    @classmethod
+    def to_sql(cls, s: Statement) -> SQL:
+        s_type = s.get_type()
+        if s_type == "SELECT":
+            return cls.to_select(s)
+        elif s_type == "INSERT":
+            return cls.to_insert(s)
+        elif s_type == "UPDATE":
+            return cls.to_update(s)
+        elif s_type == "DELETE":
+            return cls.to_delete(s)
+        elif s_type in ("START", "COMMIT", "ROLLBACK"):
+            return cls.to_tcl(s)
+        else:
+            return cls.to_other(s)
 
     @staticmethod
     def to_select(s: Statement) -> SQL:
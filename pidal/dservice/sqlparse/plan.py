@@ -0,0 +1,216 @@
+import copy
+import datetime
+import re
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import sqlparse.tokens as token
+
+from pidal.dservice.sqlparse.literal import decode
+from pidal.dservice.sqlparse.paser import SQL, Insert, Parser
+from pidal.dservice.sqlparse.template import Mark, Slot, Template
+from pidal.node.result import result
+from pidal.protocol.mysql.converter import escape_item
+
+# 编译时用来代替 `?` 的值，解析 SQL 后可以从 column、raw_where 等中找到参数
+PARAM_SENTINEL = "\x00?{}"
+PARAM_PATTERN = re.compile("\x00\\?(\\d+)")
+
+# SQL 中需要根据参数重新计算的属性
+ROLE_ATTRS = ("column", "raw_where", "new_value")
+
+# 检查 Plan 与直接解析的结果是否一致时需要比较的属性
+SAME_ATTRS = ROLE_ATTRS + ("rows", "in_lists", "ranges", "limit",
+                           "select_items", "group_by", "unsupported",
+                           "distinct", "for_update",
+                           "is_start", "is_commit", "is_rollback",
+                           "trans_args")
+
+
+class Plan(object):
+    """
+    prepare 时把 SQL 解析一次，编译成 Template 和参数在 column、raw_where、
+    new_value 中的位置，execute 时只需要绑定参数，不再使用 sqlparse。
+    """
+
+    def __init__(self, query: str, sql: SQL, template: Template,
+                 num_params: int,
+                 roles: List[Tuple[str, str, str, Optional[int]]]):
+        self.query: str = query
+        self.sql: SQL = sql
+        self.template: Template = template
+        self.num_params: int = num_params
+        # (属性名, key, 含有参数的值, 值就是一个参数时参数的序号)
+        self.roles: List[Tuple[str, str, str, Optional[int]]] = roles
+        # where 中比较的 column，文本 SQL 中双引号的字符串不会作为分片键
+        self.comparisons = {i[1] for i in roles if i[0] == "raw_where"}
+        self.table: Optional[str] = None
+        if sql.has_table():
+            self.table = str(SQL._first_leaf(sql.table))
+        # SELECT 在 backend 上 prepare 的结果，有参数和结果集的列
+        self.prepared: Optional[result.Prepare] = None
+
+    @classmethod
+    def compile(cls, query: str) -> 'Plan':
+        statements = Parser.split(query)
+        if len(statements) != 1:
+            raise Exception("prepared statement only support one sql.")
+        statement = statements[0]
+
+        num_params = 0
+        param_marks = {}
+        for t in statement.flatten():
+            if t.ttype is not token.Name.Placeholder:
+                continue
+            if t.value != "?":
+                raise Exception("only support [?] placeholder.")
+            # 当成数字解析，这样 where、values 中的参数和字面量的处理一样
+            t.ttype = token.Number.Integer
+            t.value = t.normalized = PARAM_SENTINEL.format(num_params)
+            param_marks[id(t)] = [(Mark.REPLACE, Slot.PARAM, num_params)]
+            num_params += 1
+
+        sql = Parser.to_sql(statement)
+        marks = sql.template_marks()
+        for k, v in param_marks.items():
+            marks.setdefault(k, []).extend(v)
+        template = Template.compile(statement, marks)
+
+        roles = []
+        for attr in ROLE_ATTRS:
+            values = getattr(sql, attr, None)
+            if not values:
+                continue
+            for k, v in values.items():
+                if isinstance(v, str) and "\x00?" in v:
+                    match = PARAM_PATTERN.fullmatch(v)
+                    index = int(match.group(1)) if match else None
+                    roles.append((attr, k, v, index))
+        return cls(query, sql, template, num_params, roles)
+
+    def bind(self, params: Sequence[Any]) -> SQL:
+        """ 绑定 COM_STMT_EXECUTE 的参数，参数需要转义 """
+        if len(params) != self.num_params:
+            raise Exception("need {} params, but got {}.".format(
+                self.num_params, len(params)))
+        literals = [escape_item(i, "utf8") for i in params]
+        texts = [self._to_text(i) for i in params]
+        return self._bind(literals, texts, [i is None for i in params])
+
+    def bind_literals(self, literals: List[str]) -> SQL:
+        """
+        绑定从 SQL 文本中取出的字面量，字面量原样使用。与直接解析 SQL 一样，
+        where 中数字和单引号的字符串会作为 column（分片键），双引号的字符串
+        在 sqlparse 中是标识符。
+        """
+        texts = [decode(i) for i in literals]
+        return self._bind(literals, texts, [i[0] == '"' for i in literals])
+
+    def _bind(self, literals: List[str], texts: List[str],
+              skip_column: List[bool]) -> SQL:
+        sql = copy.copy(self.sql)
+        sql.template = self.template
+        sql.params = literals
+        if self.table is not None:
+            sql.table = self.table  # type: ignore
+
+        limit = getattr(self.sql, "limit", None)
+        if limit is not None:
+            sql.limit = tuple(  # type: ignore
+                PARAM_PATTERN.sub(lambda m: literals[int(m.group(1))], i)
+                for i in limit)
+        if self.sql.in_lists:
+            sql.in_lists = [
+                (c, [PARAM_PATTERN.sub(lambda m: literals[int(m.group(1))], v)
+                     for v in values]) for c, values in self.sql.in_lists]
+        if self.sql.ranges:
+            sql.ranges = [
+                (c, op, PARAM_PATTERN.sub(
+                    lambda m: literals[int(m.group(1))], v))
+                for c, op, v in self.sql.ranges]
+        if not self.roles:
+            return sql
+        if isinstance(sql, Insert):
+            self._bind_rows(sql, literals, texts)
+        for attr in ROLE_ATTRS:
+            values = getattr(self.sql, attr, None)
+            if values is not None:
+                setattr(sql, attr, values.copy())
+        for attr, k, v, index in self.roles:
+            if index is None:
+                # 参数只是值的一部分，如 `age + ?`
+                getattr(sql, attr)[k] = PARAM_PATTERN.sub(
+                        lambda m: literals[int(m.group(1))], v)
+                continue
+            if attr == "raw_where":
+                getattr(sql, attr)[k] = literals[index]
+            elif attr == "column" and skip_column[index] and \
+                    k in self.comparisons:
+                del getattr(sql, attr)[k]
+            else:
+                getattr(sql, attr)[k] = texts[index]
+        if isinstance(sql, Insert) and not sql.multi_row:
+            sql.rows = [sql.new_value]
+        return sql
+
+    def _bind_rows(self, sql: Insert, literals: List[str], texts: List[str]):
+        """ insert 的每一行，多行时 column、new_value 为第一行 """
+        def literal(m):
+            return literals[int(m.group(1))]
+
+        sql.row_texts = [PARAM_PATTERN.sub(literal, i)
+                         for i in self.sql.row_texts]  # type: ignore
+        if not sql.multi_row:
+            return
+        rows = []
+        for row in self.sql.rows:  # type: ignore
+            value = {}
+            for k, v in row.items():
+                match = PARAM_PATTERN.fullmatch(v)
+                if match:
+                    value[k] = texts[int(match.group(1))]
+                else:
+                    value[k] = PARAM_PATTERN.sub(literal, v)
+            rows.append(value)
+        sql.rows = rows
+
+    def same(self, a: SQL, b: SQL) -> bool:
+        """ a 是 bind 的结果，b 是直接解析 SQL 的结果，检查解析的结果一致 """
+        if type(a) is not type(b) or a.has_table() != b.has_table():
+            return False
+        if a.has_table() and self.table != str(b.table):
+            return False
+        for i in SAME_ATTRS:
+            if getattr(a, i, None) != getattr(b, i, None):
+                return False
+        return True
+
+    @staticmethod
+    def _to_text(v: Any) -> str:
+        """ 与文本 SQL 中去掉引号后的值一致 """
+        if v is None:
+            return "NULL"
+        if isinstance(v, (bytes, bytearray)):
+            return v.decode("utf8", "surrogateescape")
+        if isinstance(v, datetime.datetime):
+            return v.isoformat(" ")
+        return str(v)
+
+
+class PreparedStatement(object):
+    """ 一个 session 中通过 COM_STMT_PREPARE 创建的 statement """
+
+    def __init__(self, statement_id: int, plan: Plan):
+        self.statement_id: int = statement_id
+        self.plan: Plan = plan
+        self.num_params: int = plan.num_params
+        # 客户端只在第一次 execute 时发送参数类型
+        self.types: Optional[List[Tuple[int, bool]]] = None
+        self.long_data: Dict[int, bytes] = {}
+
+    def add_long_data(self, index: int, data: bytes):
+        self.long_data[index] = self.long_data.get(index, b"") + data
+
+    def reset(self):
+        self.long_data = {}
+
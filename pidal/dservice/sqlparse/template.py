@@ -0,0 +1,140 @@
+import enum
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlparse.sql import Statement
+
+PIDAL_WHERE = " pidal_c & 1 AND "
+PIDAL_SET = ", `pidal_c` = {}| CONV(RIGHT(BIN(`pidal_c`), 21), 2, 10)+2 "
+PIDAL_COLUMN = ",pidal_c"
+PIDAL_VALUE = ",{}"
+
+
+class Slot(enum.IntEnum):
+    PARAM = 1  # 参数，arg 为参数的序号
+    TABLE = 2  # 表名
+    PIDAL_WHERE = 3  # where 中增加 pidal_c 的条件
+    PIDAL_SET = 4  # update 中增加 pidal_c 的赋值
+    PIDAL_COLUMN = 5  # insert 中增加 pidal_c 列
+    PIDAL_VALUE = 6  # insert 中增加 pidal_c 的值
+    WHERE = 7  # where 开始的位置，不输出任何内容
+    ROWS = 8  # 多行 insert 的 values 部分，由 Insert 按分片生成
+    IN_LIST = 9  # where 中 in 的值列表，arg 为 SQL.in_lists 的序号
+    LIMIT = 10  # 整个 limit 子句，没有 limit 时不输出
+    COLUMNS = 11  # select 的列，跨分表聚合时改写
+
+
+class Mark(enum.IntEnum):
+    BEFORE = -1
+    REPLACE = 0
+    AFTER = 1
+    DROP = 2  # 去掉这个 token，用于被 slot 替换的一段 token
+
+
+# 某个 token 上的改写点: (位置, slot 类型, 参数)
+Marks = Dict[int, List[Tuple[Mark, Slot, int]]]
+
+# where 中的 in: (column, 值的字面量)
+InLists = Sequence[Tuple[str, List[str]]]
+
+
+class Template(object):
+    """
+    把 SQL 切分成固定的文本和可以替换的位置（slot），parts 比 slots 多一个，
+    渲染的时候只需要按顺序拼接一次，不需要再修改 sqlparse 的 token。
+    """
+
+    __slots__ = ("parts", "slots", "where")
+
+    def __init__(self, parts: List[str], slots: List[Tuple[Slot, int]],
+                 where: Optional[int] = None):
+        self.parts: List[str] = parts
+        self.slots: List[Tuple[Slot, int]] = slots
+        self.where: Optional[int] = where
+
+    @classmethod
+    def compile(cls, raw: Statement, marks: Marks) -> 'Template':
+        parts: List[str] = []
+        slots: List[Tuple[Slot, int]] = []
+        where = None
+        text: List[str] = []
+
+        def add_slot(kind: Slot, arg: int):
+            nonlocal where
+            parts.append("".join(text))
+            text.clear()
+            if kind is Slot.WHERE:
+                where = len(slots)
+            slots.append((kind, arg))
+
+        for t in raw.flatten():
+            mark = marks.get(id(t), None)
+            if not mark:
+                text.append(str(t))
+                continue
+            if mark[0][0] is Mark.DROP:
+                continue
+            replaced = False
+            for position, kind, arg in mark:
+                if position is Mark.BEFORE:
+                    add_slot(kind, arg)
+            # 同一个 token 只替换一次，先加入的 mark 优先
+            for position, kind, arg in mark:
+                if position is Mark.REPLACE:
+                    add_slot(kind, arg)
+                    replaced = True
+                    break
+            if not replaced:
+                text.append(str(t))
+            for position, kind, arg in mark:
+                if position is Mark.AFTER:
+                    add_slot(kind, arg)
+        parts.append("".join(text))
+        return cls(parts, slots, where)
+
+    def render(self, params: Sequence[str], table: Optional[str] = None,
+               pidal_c: Optional[int] = None, start: int = 0,
+               rows: Optional[str] = None, in_lists: InLists = (),
+               limit: Optional[Tuple[str, str]] = None,
+               columns: Optional[str] = None) -> str:
+        parts = self.parts
+        out = [parts[start]]
+        append = out.append
+        for i in range(start, len(self.slots)):
+            kind, arg = self.slots[i]
+            if kind is Slot.PARAM:
+                append(params[arg])
+            elif kind is Slot.TABLE:
+                append(table)  # type: ignore
+            elif kind is Slot.ROWS:
+                append(rows)  # type: ignore
+            elif kind is Slot.IN_LIST:
+                append("(" + ", ".join(in_lists[arg][1]) + ")")
+            elif kind is Slot.LIMIT:
+                if limit is not None:
+                    offset, count = limit
+                    append("LIMIT " + (count if offset == "0" else
+                                       offset + ", " + count))
+            elif kind is Slot.COLUMNS:
+                append(columns)  # type: ignore
+            elif pidal_c is not None:
+                if kind is Slot.PIDAL_WHERE:
+                    append(PIDAL_WHERE)
+                elif kind is Slot.PIDAL_SET:
+                    append(PIDAL_SET.format(pidal_c))
+                elif kind is Slot.PIDAL_COLUMN:
+                    append(PIDAL_COLUMN)
+                elif kind is Slot.PIDAL_VALUE:
+                    append(PIDAL_VALUE.format(pidal_c))
+            append(parts[i + 1])
+        return "".join(out)
+
+    def render_where(self, params: Sequence[str],
+                     pidal_c: Optional[int] = None,
+                     in_lists: InLists = ()) -> str:
+        """ 只渲染 where 部分，去掉最后的分号 """
+        if self.where is None:
+            return ""
+        return self.render(params, None, pidal_c, self.where + 1,
+                           in_lists=in_lists).rstrip(
+                "; \n")
@@ -0,0 +1,183 @@
+import copy
+
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from pidal.node.result import result
+from pidal.dservice.sqlparse.paser import Select
+from pidal.dservice.table.merge import SortKey
+from pidal.dservice.table import columnar
+
+# MySQL 的 div_precision_increment，AVG 比 SUM 多的小数位数
+AVG_SCALE = 4
+# 部分聚合结果的行数不少于这个值、并且安装了 NumPy 时按列合并，
+# 行数较少时转换成数组的开销比逐行合并大
+COLUMNAR_ROWS = 200000
+
+
+def _sum(a: Any, b: Any) -> Any:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def _min(a: Any, b: Any) -> Any:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return b if b < a else a
+
+
+def _max(a: Any, b: Any) -> Any:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return b if b > a else a
+
+
+# 合并两个分表的部分聚合结果，AVG 拆成 SUM 和 COUNT 合并
+MERGES: Dict[str, Callable[[Any, Any], Any]] = {
+        "COUNT": _sum,
+        "SUM": _sum,
+        "MIN": _min,
+        "MAX": _max,
+        }
+
+
+def _quote(name: str) -> str:
+    return "`" + name.replace("`", "``") + "`"
+
+
+class Aggregate(object):
+    """
+    跨分表的聚合。分表上按原来的 group by 做部分聚合，AVG 改写成 SUM 和
+    COUNT，每个分组每个分表只返回一行；合并时按分组列做 hash 聚合，再计算
+    AVG、排序和 limit。
+
+    分组列按 Python 的规则比较，不考虑 collation。
+    """
+
+    __slots__ = ("columns", "keys", "merges", "select_list")
+
+    def __init__(self, columns: List[Tuple[Optional[str], int]],
+                 keys: List[int], select_list: str):
+        # 输出的每一列: (聚合函数, 在分表结果中的位置)
+        self.columns: List[Tuple[Optional[str], int]] = columns
+        # 分组列在分表结果中的位置
+        self.keys: List[int] = keys
+        # 需要合并的列: (在分表结果中的位置, MERGES 中的合并方式)
+        self.merges: List[Tuple[int, str]] = []
+        for func, i in columns:
+            if func == "AVG":
+                self.merges.append((i, "SUM"))
+                self.merges.append((i + 1, "COUNT"))
+            elif func is not None:
+                self.merges.append((i, func))
+        # 分表上执行的 select 的列
+        self.select_list: str = select_list
+
+    @classmethod
+    def new(cls, sql: Select) -> Optional['Aggregate']:
+        """ 不是聚合查询或者不能在分表上合并时返回 None """
+        items = sql.select_items
+        if not items:
+            return None
+        parts = []
+        columns = []
+        pos = 0
+        for func, arg, text, name in items:
+            columns.append((func, pos))
+            if func == "AVG":
+                parts.append("SUM({}) AS {}, COUNT({})".format(
+                    arg, _quote(name), arg))
+                pos += 2
+            else:
+                parts.append(text)
+                pos += 1
+
+        names = [i[3].lower() for i in items]
+        keys = []
+        for i in sql.group_by:
+            if i.isdigit():
+                n = int(i) - 1
+                if not 0 <= n < len(items) or items[n][0] is not None:
+                    return None
+                keys.append(columns[n][1])
+                continue
+            name = i.split(".")[-1].strip("`").lower()
+            for n, item in enumerate(items):
+                if item[0] is None and (names[n] == name or
+                                        item[2].lower() == i.lower()):
+                    keys.append(columns[n][1])
+                    break
+            else:
+                # 没有 select 的分组列加在最后，合并后去掉
+                parts.append(i)
+                keys.append(pos)
+                pos += 1
+        return cls(columns, keys, ", ".join(parts))
+
+    def combine(self, r: result.ResultSet,
+                order_by: Optional[List[Tuple[str, bool]]] = None) -> \
+            result.ResultSet:
+        """ r 为全部分表的部分聚合结果 """
+        values = None
+        if len(r.rows) >= COLUMNAR_ROWS and columnar.available():
+            values = columnar.combine(self, r.rows,  # type: ignore
+                                      [i.scale for i in r.descriptions])
+        if values is None:
+            values = self._combine_rows(r.rows)  # type: ignore
+        keys = self.keys
+
+        descriptions = []
+        for func, i in self.columns:
+            d = r.descriptions[i]
+            if func == "AVG":
+                d = copy.copy(d)
+                d.scale += AVG_SCALE
+            descriptions.append(d)
+
+        if not order_by and keys:
+            # 与 MySQL 5.7 一致，没有 order by 时按分组列排序
+            values.sort(key=SortKey([(i, False) for i in keys]))
+        rows = [self._finish(acc, descriptions) for acc in values]
+        if order_by:
+            rows.sort(key=SortKey.new(order_by, descriptions))
+        return result.ResultSet(len(descriptions), descriptions,
+                                rows)  # type: ignore
+
+    def _combine_rows(self, rows: List[Tuple]) -> List[Any]:
+        """ 逐行合并，返回每个分组合并后的一行，分组按第一次出现的顺序 """
+        groups: Dict[Tuple, List[Any]] = {}
+        keys = self.keys
+        merges = [(i, MERGES[func]) for i, func in self.merges]
+        for row in rows:
+            key = tuple(row[i] for i in keys)
+            acc = groups.get(key)
+            if acc is None:
+                groups[key] = list(row)
+                continue
+            for i, merge in merges:
+                acc[i] = merge(acc[i], row[i])
+        return list(groups.values())
+
+    def _finish(self, acc: Sequence[Any],
+                descriptions: List[result.ResultDescription]) -> Tuple:
+        row = []
+        for n, (func, i) in enumerate(self.columns):
+            if func != "AVG":
+                row.append(acc[i])
+                continue
+            total, count = acc[i], acc[i + 1]
+            if not count or total is None:
+                row.append(None)
+            elif isinstance(total, Decimal):
+                scale = Decimal(1).scaleb(-descriptions[n].scale)
+                row.append((total / count).quantize(scale))
+            else:
+                row.append(total / count)
+        return tuple(row)
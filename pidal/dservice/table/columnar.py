@@ -0,0 +1,158 @@
+from decimal import Decimal
+from operator import itemgetter
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# int64 累加不会溢出的上限
+_INT_LIMIT = 2 ** 62
+
+
+def available() -> bool:
+    return np is not None
+
+
+def _factorize(column: Sequence[Any]) -> Tuple[Any, int]:
+    """ 分组列转换成从 0 开始的编号，返回 (编号, 不同值的个数) """
+    if set(map(type, column)) <= {int}:
+        try:
+            values = np.fromiter(column, dtype=np.int64, count=len(column))
+        except OverflowError:
+            pass
+        else:
+            uniques, codes = np.unique(values, return_inverse=True)
+            return codes.reshape(len(column)), len(uniques)
+    # 字符串、NULL 等按 Python 的规则比较，与逐行合并一致
+    index: dict = {}
+    codes = np.fromiter((index.setdefault(i, len(index)) for i in column),
+                        dtype=np.int64, count=len(column))
+    return codes, len(index)
+
+
+def _decimal(scale: int) -> Callable[[int], Decimal]:
+    def _to_python(v: int) -> Decimal:
+        return Decimal(v).scaleb(-scale)
+    return _to_python
+
+
+def _numeric(column: Sequence[Any], scale: int) -> \
+        Optional[Tuple[Any, Any, Callable[[Any], Any]]]:
+    """
+    聚合列转换成 (数值, 是否为 NULL, 转换回 Python 值的函数)。
+    DECIMAL 按 scale 放大成整数计算，不能转换或者可能溢出时返回 None
+    """
+    n = len(column)
+    types = set(map(type, column))
+    null = None
+    if type(None) in types:
+        types.discard(type(None))
+        null = np.fromiter((i is None for i in column), dtype=np.bool_,
+                           count=n)
+        column = [0 if i is None else i for i in column]
+    if not types <= {int, float, Decimal} or \
+            Decimal in types and float in types:
+        return None
+    if float in types:
+        return np.fromiter(column, dtype=np.float64, count=n), null, float
+    to_python: Callable[[Any], Any] = int
+    try:
+        if Decimal in types:
+            # 放大后小于 2 ** 50 时通过 float 转换是精确的
+            values = np.fromiter(column, dtype=np.float64, count=n) * \
+                (10 ** scale)
+            if n and np.abs(values).max() >= 2 ** 50:
+                return None
+            values = np.rint(values).astype(np.int64)
+            to_python = _decimal(scale)
+        else:
+            values = np.fromiter(column, dtype=np.int64, count=n)
+    except OverflowError:
+        return None
+    if n and int(np.abs(values).max()) * n >= _INT_LIMIT:
+        return None
+    return values, null, to_python
+
+
+def combine(aggregate: Any, rows: Sequence[Tuple],
+            scales: List[int]) -> Optional[List[Tuple]]:
+    """
+    按列合并部分聚合结果，与 Aggregate 逐行合并的结果和分组的顺序一致，
+    返回每个分组合并后的一行。有不能转换成数值的聚合列（如字符串的 MIN）
+    时返回 None，由调用方逐行合并。
+    """
+    if np is None or not rows:
+        return None
+    n = len(rows)
+
+    def column(i: int) -> List[Any]:
+        return list(map(itemgetter(i), rows))
+
+    if aggregate.keys:
+        factors = [_factorize(column(i)) for i in aggregate.keys]
+        codes = factors[0][0]
+        size = factors[0][1]
+        for c, s in factors[1:]:
+            if size * s >= _INT_LIMIT:
+                stacked = np.stack([codes, c], axis=1)
+                _, codes = np.unique(stacked, axis=0, return_inverse=True)
+                codes = codes.reshape(n)
+                size = int(codes.max()) + 1
+            else:
+                codes = codes * s + c
+                size *= s
+        _, first, group = np.unique(codes, return_index=True,
+                                    return_inverse=True)
+        group = group.reshape(n)
+    else:
+        first = np.zeros(1, dtype=np.int64)
+        group = np.zeros(n, dtype=np.int64)
+
+    # 分组按第一次出现的顺序编号
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first, kind="stable")] = np.arange(len(first))
+    group = rank[group]
+    first = np.sort(first)
+
+    order = np.argsort(group, kind="stable")
+    starts = np.flatnonzero(np.concatenate(
+        ([True], group[order][1:] != group[order][:-1])))
+
+    merged = {}
+    for i, func in aggregate.merges:
+        converted = _numeric(column(i), scales[i])
+        if converted is None:
+            return None
+        values, null, to_python = converted
+        if null is None:
+            counts = None
+        else:
+            counts = np.add.reduceat((~null)[order].astype(np.int64), starts)
+        values = values[order]
+        if func in ("SUM", "COUNT"):
+            reduced = np.add.reduceat(values, starts)
+        elif func == "MIN":
+            if null is not None:
+                values[null[order]] = values.max()
+            reduced = np.minimum.reduceat(values, starts)
+        else:
+            if null is not None:
+                values[null[order]] = values.min()
+            reduced = np.maximum.reduceat(values, starts)
+        out = [to_python(v) for v in reduced.tolist()]
+        if counts is not None:
+            for g in np.flatnonzero(counts == 0).tolist():
+                out[g] = None
+        merged[i] = out
+
+    # 其他的列使用分组中第一行的值
+    firsts = [rows[i] for i in first.tolist()]
+    out_columns = []
+    for i in range(len(rows[0])):
+        if i in merged:
+            out_columns.append(merged[i])
+        else:
+            out_columns.append(list(map(itemgetter(i), firsts)))
+    return list(zip(*out_columns))
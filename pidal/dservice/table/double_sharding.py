@@ -1,13 +1,15 @@
 import asyncio
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 from pidal.dservice.table.tools import Tools
 from pidal.dservice.backend.backend_manager import BackendManager
 from pidal.lib.algorithms.factory import Factory as algorithms
 from pidal.dservice.table.table import Table
+from pidal.dservice.table.router import Router
+from pidal.dservice.sqlparse.literal import decode
 from pidal.dservice.sqlparse.paser import DML, DMLW, Select, Insert, Delete,\
         Update
-from pidal.constant.db import DBTableType
+from pidal.constant.db import DBTableType, ResultMode
 from pidal.constant.common import RuleStatus
 from pidal.meta.model import DBTable, DBTableStrategy, DBTableStrategyBackend
 from pidal.dservice.zone_manager import ZoneManager
@@ -31,7 +33,11 @@ class DoubleSharding(Table):
         self.zskeys = table_conf.zskeys
         self.zs_algorithm = algorithms.new(table_conf.zs_algorithm)
         self.zs_algorithm_args = table_conf.zs_algorithm_args
+        self.zone_router = Router.new(self.zskeys, table_conf.zs_algorithm,
+                                      self.zs_algorithm_args)
         self.lock_key = table_conf.lock_key
+        self.scatter_concurrency = table_conf.scatter_concurrency
+        self.spill_budget = table_conf.spill_budget
         self.backend_manager = BackendManager.get_instance()
         if not table_conf.strategies or len(table_conf.strategies) != 2:
             raise Exception("Sharding table need two strategy.")
@@ -57,6 +63,7 @@ class DoubleSharding(Table):
         self.sharding_algorithm = []
         self.sharding_algorithm_args = []
         self.backends: List[Dict[int, DBTableStrategyBackend]] = []
+        self.routers: List[Router] = []
         for index, strategy in enumerate(strategies):
             if not strategy.algorithm:
                 raise Exception("Sharding table need algorithm.")
@@ -70,6 +77,9 @@ class DoubleSharding(Table):
             self.backends.append({})
             for i in strategy.backends:
                 self.backends[index][i.number] = i  # type: ignore
+            self.routers.append(Router.new(
+                strategy.sharding_columns, strategy.algorithm,
+                strategy.algorithm_args, self.backends[index]))
 
     def get_name(self) -> str:
         return self.name
@@ -80,17 +90,34 @@ class DoubleSharding(Table):
     def get_status(self) -> RuleStatus:
         return self.status
 
-    async def execute_dml(self, sql: DML, trans_id: int = 0) -> result.Result:
+    async def execute_dml(self, sql: DML, trans_id: int = 0,
+                          mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         if not self.is_allow_write_sql(sql):
             return result.Error(
                 1034, "current zone dont allowed execute this sql{}".format(
-                    str(sql.raw)))
+                    sql.to_sql()))
+        if isinstance(sql, Insert) and sql.multi_row:
+            return await self._execute_rows(sql, trans_id)
+        if sql.in_lists:
+            r = await self._execute_in(sql, trans_id)
+            if r is not None:
+                return r
+        if isinstance(sql, Select) and not self.has_sharding_key(sql):
+            nodes = self.prune_backends(
+                    sql, self.sharding_algorithm[0],
+                    self.sharding_algorithm_args[0], self.sharding_columns[0],
+                    self.backends[0])
+            return await self.execute_scatter(sql, nodes, trans_id, mode)
         nodes = self.get_node(sql)
         if isinstance(sql, Select):
             nodes = nodes[:1]
+        else:
+            # 写入需要两边都执行完成后比对结果，不能流式返回
+            mode = ResultMode.BUFFERED
         g = []
         for node in nodes:
-            g.append(self._execute_dml(node, sql, trans_id))
+            g.append(self._execute_dml(node, sql, trans_id, mode))
         r = await asyncio.gather(*g)
         # TODO 两个之间的异常处理
         if len(r) < 2:
@@ -101,14 +128,92 @@ class DoubleSharding(Table):
                     return ri
             return r[0]
 
+    async def _execute_rows(self, sql: Insert, trans_id: int = 0) -> \
+            result.Result:
+        """
+        多行 insert 按两个策略的分表分别拆分，影响的行数只计算第一个策略的
+        """
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        for j, router in enumerate(self.routers):
+            for i, node in enumerate(router.route_many(sql.rows)):
+                groups.setdefault((j, node.number), []).append(i)
+        sqls = []
+        for (j, number), indexes in groups.items():
+            node = self.backends[j][number]
+            s = sql.split(indexes)
+            s.modify_table(node.prefix + str(node.number))
+            s.add_pidal(self.get_pidal_c_v())
+            sqls.append((node, s))
+        r = await self.execute_batch(sqls, trans_id)
+        for ri in r:
+            if not isinstance(ri, result.OK):
+                return ri
+        return self.merge_ok([ri for ri, k in zip(r, groups) if k[0] == 0])
+
+    def has_sharding_key(self, sql: DML) -> bool:
+        """ 查询只使用第一个策略 """
+        column = getattr(sql, "column", None) or {}
+        return all(column.get(i, None) for i in self.sharding_columns[0])
+
+    async def _execute_in(self, sql: DML, trans_id: int = 0) -> \
+            Optional[result.Result]:
+        """
+        按第一个策略的分片键拆分 in 的值，查询只在第一个策略上执行，写入两个
+        策略都执行，影响的行数只计算第一个策略的。第二个策略的分片键不在语句
+        中时，写入在第二个策略的全部分表上执行
+        """
+        column = getattr(sql, "column", None) or {}
+        if all(i in column for i in self.sharding_columns[0]):
+            return None
+        for index, (c, values) in enumerate(sql.in_lists):
+            if c not in self.sharding_columns[0]:
+                continue
+            rows = [{**column, c: decode(v)} for v in values]
+            count = 1 if isinstance(sql, Select) else 2
+            groups: Dict[Tuple[int, int], List[str]] = {}
+            for j, router in enumerate(self.routers[:count]):
+                if router.missing(rows[0]) is not None:
+                    # 语句中没有这个策略的分片键，在它的全部分表上执行
+                    for number in self.backends[j]:
+                        groups[(j, number)] = list(values)
+                    continue
+                for v, node in zip(values, router.route_many(rows)):
+                    groups.setdefault((j, node.number), []).append(v)
+            sqls = []
+            for (j, number), vs in groups.items():
+                node = self.backends[j][number]
+                s = sql.split_in(index, vs)
+                self.push_down(s)
+                s.modify_table(node.prefix + str(node.number))
+                if isinstance(s, DMLW):
+                    s.add_pidal(self.get_pidal_c_v())
+                sqls.append((node, s))
+            error = self.check_merge(sql, len(sqls))
+            if error is not None:
+                return error
+            r = await self.execute_batch(sqls, trans_id)  # type: ignore
+            for ri in r:
+                if isinstance(ri, result.Error):
+                    return ri
+            return self.merge_result(
+                    [ri for ri, k in zip(r, groups) if k[0] == 0], sql)
+        return None
+
     async def _execute_dml(self, node: DBTableStrategyBackend, sql: DML,
-                           trans_id: int = 0) -> result.Result:
-        backend = await self.backend_manager.get_backend(node.node, trans_id)
+                           trans_id: int = 0,
+                           mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         sql.modify_table(node.prefix + str(node.number))
         if isinstance(sql, DMLW):
             sql.add_pidal(self.get_pidal_c_v())
-        result = await backend.query(str(sql.raw))
-        return result
+        return await self.backend_manager.query(
+                node.node, sql.to_sql(), trans_id, mode,
+                self.is_replica_read(sql, trans_id))
+
+    async def prepare(self, sql: DML) -> result.Result:
+        node = list(self.backends[0].values())[0]
+        sql.modify_table(node.prefix + str(node.number))
+        return await self.backend_manager.prepare(node.node, sql.to_sql())
 
     def get_node(self, sql: DML) -> List[DBTableStrategyBackend]:
         if not sql.table or not sql.column:
@@ -116,72 +221,48 @@ class DoubleSharding(Table):
                     "SQL needs to contain the sharding fields[{}].".format(
                         ",".join(self.sharding_columns[0])))
         result = []
-        for i in range(0, 2):
-            args = []
-            if self.sharding_algorithm_args[i]:
-                args = self.sharding_algorithm_args[i].copy()
-
-            for j in self.sharding_columns[i]:
-                cv = sql.column.get(j, None)
-                if not cv:
-                    continue
-                args.append(cv)
-            sid = self.sharding_algorithm[i](*args)
-            node = self.backends[i].get(sid, None)
-            if not node:
-                raise Exception("can not get backend.")
+        for router in self.routers:
+            node = router.route(sql.column)
+            if node is None:
+                raise Exception(
+                        "SQL needs to contain the sharding fields[{}].".format(
+                            router.missing(sql.column)))
             result.append(node)
-        if not result:
-            raise Exception(
-                    "SQL needs to contain the sharding fields[{}].".format(
-                        ",".join(self.sharding_algorithm[0])))
         return result
 
     def get_real_table(self, row: Dict[str, Any]) -> List[str]:
+        return [i.prefix + str(i.number) for i in self.get_row_nodes(row)]
+
+    def get_row_nodes(self, row: Dict[str, Any], count: int = 2) -> \
+            List[DBTableStrategyBackend]:
+        """ count 为 1 时只计算第一个策略 """
         result = []
-        for i in range(0, 2):
-            args = []
-            if self.sharding_algorithm_args[i]:
-                args = self.sharding_algorithm_args[i].copy()
-
-            for j in self.sharding_columns[i]:
-                cv = row.get(j, None)
-                if not cv:
-                    continue
-                args.append(cv)
-
-            sid = self.sharding_algorithm[i](*args)
-            node = self.backends[i].get(sid, None)
-            if not node:
-                raise Exception("can not get real table.")
-            result.append(node.prefix + str(node.number))
-        if not result:
-            raise Exception(
-                    "row needs to contain the sharding fields[{}].".format(
-                        ",".join(self.sharding_algorithm[0])))
+        for router in self.routers[:count]:
+            node = router.route(row)
+            if node is None:
+                raise Exception(
+                        "row needs to contain the sharding fields[{}].".format(
+                            router.missing(row)))
+            result.append(node)
         return result
 
     def is_allow_write_zone(self, row: Dict[str, Any]) -> bool:
-        args = []
-        if self.zs_algorithm_args:
-            args = self.zs_algorithm_args.copy()
-        for i in self.zskeys:
-            cv = row.get(i, None)
-            if not cv:
-                raise Exception(
-                        "row needs to contain the zskey fields[{}].".format(
-                            i))
-            args.append(cv)
-        zsid = self.zs_algorithm(*args)
+        zsid = self.zone_router.shard(row)
+        if zsid is None:
+            raise Exception(
+                    "row needs to contain the zskey fields[{}].".format(
+                        self.zone_router.missing(row)))
         return self.zone_manager.is_allow(zsid)
 
     def is_allow_write_sql(self, sql: DML) -> bool:
         if isinstance(sql, Select):
             return True
         elif isinstance(sql, Insert):
-            return self.is_allow_write_zone(sql.new_value)
+            rows = sql.rows or [sql.new_value]
+            return all(self.is_allow_write_zone(i) for i in rows)
         elif isinstance(sql, Update) or isinstance(sql, Delete):
-            return self.is_allow_write_zone(sql.raw_where)
+            return all(self.is_allow_write_zone(i)
+                       for i in self.where_rows(sql))
         else:
             return False
 
@@ -0,0 +1,149 @@
+import heapq
+
+from typing import Any, AsyncIterator, Callable, List, Optional, Tuple
+
+from pidal.node.result import result
+
+Row = Tuple[Any, ...]
+
+
+class _Desc(object):
+    """ 倒序比较 """
+
+    __slots__ = ("v",)
+
+    def __init__(self, v: Any):
+        self.v = v
+
+    def __lt__(self, other: '_Desc') -> bool:
+        return other.v < self.v
+
+    def __eq__(self, other: object) -> bool:
+        return self.v == other.v  # type: ignore
+
+
+class SortKey(object):
+    """
+    根据 order by 和结果集的 descriptions 生成每一行排序用的 key。
+    与 MySQL 一致，NULL 比其他值都小。字符串按 Python 的规则比较，
+    不考虑 collation。
+    """
+
+    __slots__ = ("columns",)
+
+    def __init__(self, columns: List[Tuple[int, bool]]):
+        # (在行中的位置, 是否 desc)
+        self.columns: List[Tuple[int, bool]] = columns
+
+    @classmethod
+    def new(cls, order_by: List[Tuple[str, bool]],
+            descriptions: List[result.ResultDescription]) -> 'SortKey':
+        names = [(d.name or "").lower() for d in descriptions]
+        columns = []
+        for name, desc in order_by:
+            if name.isdigit() and 0 < int(name) <= len(names):
+                columns.append((int(name) - 1, desc))
+                continue
+            if name.lower() not in names:
+                raise Exception(
+                        "order by column [{}] must be selected.".format(name))
+            columns.append((names.index(name.lower()), desc))
+        return cls(columns)
+
+    def __call__(self, row: Row) -> Tuple:
+        key = []
+        for i, desc in self.columns:
+            v = row[i]
+            k = (v is not None, v)
+            key.append(_Desc(k) if desc else k)
+        return tuple(key)
+
+
+async def _next(rows: AsyncIterator[Row]) -> Optional[Row]:
+    try:
+        return await rows.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def merge(streams: List[AsyncIterator[Row]],
+                key: Callable[[Row], Any]) -> AsyncIterator[Row]:
+    """
+    多个已经排好序的流按 key 做 k 路归并，每个流只缓存当前的一行，
+    内存占用与流的个数成正比。key 相同时按流的顺序输出。
+    """
+    heap = []
+    for i, rows in enumerate(streams):
+        row = await _next(rows)
+        if row is not None:
+            heap.append((key(row), i, row))
+    heapq.heapify(heap)
+    while heap:
+        _, i, row = heap[0]
+        yield row
+        row = await _next(streams[i])
+        if row is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (key(row), i, row))
+
+
+async def limit_rows(rows: AsyncIterator[Row], offset: int,
+                     count: int) -> AsyncIterator[Row]:
+    """ 跳过 offset 行后最多输出 count 行，够了之后不再读取 rows """
+    if count <= 0:
+        return
+    n = 0
+    async for row in rows:
+        n += 1
+        if n <= offset:
+            continue
+        yield row
+        if n >= offset + count:
+            return
+
+
+async def distinct_rows(rows: AsyncIterator[Row],
+                        adjacent: bool = False) -> AsyncIterator[Row]:
+    """
+    去掉重复的行，保持第一次出现的顺序，输出过的行保存在内存中。
+    adjacent 为 True 时 rows 已经按全部的列排序，重复的行相邻，只需要
+    与上一行比较。值按 Python 的规则比较，不考虑 collation。
+    """
+    if adjacent:
+        last = None
+        async for row in rows:
+            if row != last:
+                last = row
+                yield row
+        return
+    seen = set()
+    async for row in rows:
+        if row in seen:
+            continue
+        seen.add(row)
+        yield row
+
+
+def unique_rows(rows: List[Row]) -> List[Row]:
+    """ 与 distinct_rows 一样，用于已经在内存中的行 """
+    return list(dict.fromkeys(rows))
+
+
+def merge_result_sets(results: List[result.ResultSet],
+                      order_by: List[Tuple[str, bool]]) -> result.ResultSet:
+    """ 已经在内存中的多个有序结果集归并成一个 """
+    first = results[0]
+    key = SortKey.new(order_by, first.descriptions)
+    rows = list(heapq.merge(*[i.rows for i in results], key=key))
+    return result.ResultSet(first.field_count, first.descriptions, rows)
+
+
+async def iter_rows(r: result.Result) -> AsyncIterator[Row]:
+    """ ResultSet 和 StreamResultSet 统一成行的异步迭代器 """
+    if isinstance(r, result.StreamResultSet):
+        async for row in r:
+            yield row
+        return
+    for row in r.rows:  # type: ignore
+        yield row
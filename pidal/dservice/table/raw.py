@@ -6,9 +6,10 @@ from pidal.dservice.table.tools import Tools
 from pidal.dservice.backend.backend_manager import BackendManager
 from pidal.lib.algorithms.factory import Factory as algorithms
 from pidal.dservice.table.table import Table
+from pidal.dservice.table.router import Router
 from pidal.dservice.sqlparse.paser import DML, DMLW, Delete, Insert, Select,\
         Update
-from pidal.constant.db import DBTableType
+from pidal.constant.db import DBTableType, ResultMode
 from pidal.constant.common import RuleStatus
 from pidal.meta.model import DBTable, DBTableStrategy, DBTableStrategyBackend
 from pidal.node.result import result
@@ -31,6 +32,8 @@ class Raw(Table):
         self.zskeys = table_conf.zskeys
         self.zs_algorithm = algorithms.new(table_conf.zs_algorithm)
         self.zs_algorithm_args = table_conf.zs_algorithm_args
+        self.zone_router = Router.new(self.zskeys, table_conf.zs_algorithm,
+                                      self.zs_algorithm_args)
         self.lock_key = table_conf.lock_key
         self.backend_manager = BackendManager.get_instance()
         if not table_conf.strategies or len(table_conf.strategies) != 1:
@@ -66,22 +69,26 @@ class Raw(Table):
     def get_status(self) -> RuleStatus:
         return self.status
 
-    async def execute_dml(self, sql: DML, trans_id: int = 0) -> result.Result:
+    async def execute_dml(self, sql: DML, trans_id: int = 0,
+                          mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         if not self.is_allow_write_sql(sql):
             return result.Error(
                 1034, "current zone dont allowed execute this sql{}".format(
-                    str(sql.raw)))
+                    sql.to_sql()))
         node = self.get_node(sql)[0]
-        backend = await self.backend_manager.get_backend(node.node, trans_id)
         if isinstance(sql, DMLW):
             if not trans_id:
                 return result.Error(1002,
                                     "write data must begin a transaction.")
             sql.add_pidal(self.get_pidal_c_v())
-        r = await backend.query(str(sql.raw))
-        if not trans_id:
-            self.backend_manager.release(node.node, backend)
-        return r
+        return await self.backend_manager.query(
+                node.node, sql.to_sql(), trans_id, mode,
+                self.is_replica_read(sql, trans_id))
+
+    async def prepare(self, sql: DML) -> result.Result:
+        return await self.backend_manager.prepare(
+                self.get_node(sql)[0].node, sql.to_sql())
 
     def get_node(self, sql: DML) -> List[DBTableStrategyBackend]:
         if not self.backend:
@@ -97,24 +104,20 @@ class Raw(Table):
         if isinstance(sql, Select):
             return True
         elif isinstance(sql, Insert):
-            return self.is_allow_write_zone(sql.new_value)
+            rows = sql.rows or [sql.new_value]
+            return all(self.is_allow_write_zone(i) for i in rows)
         elif isinstance(sql, Update) or isinstance(sql, Delete):
-            return self.is_allow_write_zone(sql.raw_where)
+            return all(self.is_allow_write_zone(i)
+                       for i in self.where_rows(sql))
         else:
             return False
 
     def is_allow_write_zone(self, row: Dict[str, Any]) -> bool:
-        args = []
-        if self.zs_algorithm_args:
-            args = self.zs_algorithm_args.copy()
-        for i in self.zskeys:
-            cv = row.get(i, None)
-            if not cv:
-                raise Exception(
-                        "row needs to contain the zskey fields[{}].".format(
-                            i))
-            args.append(cv)
-        zsid = self.zs_algorithm(*args)
+        zsid = self.zone_router.shard(row)
+        if zsid is None:
+            raise Exception(
+                    "row needs to contain the zskey fields[{}].".format(
+                        self.zone_router.missing(row)))
         return self.zone_manager.is_allow(zsid)
 
     def get_pidal_c_v(self) -> int:
@@ -0,0 +1,98 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from pidal.lib.algorithms.factory import Factory as algorithms
+from pidal.meta.model import DBTableStrategyBackend
+
+
+class Router(object):
+    """
+    一个分片策略编译后的路由，创建表时生成。algorithm_args 预先绑定到算法上，
+    只有一个分片键时直接取值计算，路由时不再拷贝参数、拼接列表。
+
+    backends 为 None 时只计算编号，用于 zone 的 zskeys。
+    """
+
+    __slots__ = ("columns", "backends", "_func", "_column")
+
+    def __init__(self, columns: List[str], func: Callable,
+                 backends: Optional[Dict[int, DBTableStrategyBackend]]):
+        self.columns: List[str] = list(columns)
+        self.backends: Optional[Dict[int, DBTableStrategyBackend]] = \
+            backends
+        self._func: Callable = func
+        self._column: Optional[str] = \
+            self.columns[0] if len(self.columns) == 1 else None
+
+    @classmethod
+    def new(cls, columns: List[str], algorithm: str,
+            args: Optional[List[Any]],
+            backends: Optional[Dict[int, DBTableStrategyBackend]] = None) \
+            -> 'Router':
+        return cls(columns, algorithms.bind(algorithm, args), backends)
+
+    def missing(self, values: Dict[str, Any]) -> Optional[str]:
+        """ values 中缺少的第一个分片键 """
+        for i in self.columns:
+            if not values.get(i, None):
+                return i
+        return None
+
+    def shard(self, values: Dict[str, Any]) -> Optional[int]:
+        """ 分片编号，缺少分片键时返回 None """
+        column = self._column
+        if column is not None:
+            v = values.get(column, None)
+            if not v:
+                return None
+            return self._func(v)
+        args = []
+        for i in self.columns:
+            v = values.get(i, None)
+            if not v:
+                return None
+            args.append(v)
+        return self._func(*args)
+
+    def route(self, values: Dict[str, Any]) -> \
+            Optional[DBTableStrategyBackend]:
+        """ 分表，缺少分片键时返回 None """
+        sid = self.shard(values)
+        if sid is None:
+            return None
+        node = self.backends.get(sid, None)  # type: ignore
+        if node is None:
+            raise Exception("can not get backend.")
+        return node
+
+    def route_many(self, rows: Iterable[Dict[str, Any]]) -> \
+            List[DBTableStrategyBackend]:
+        """
+        批量路由，用于多行 insert、in 的值、数据迁移等，返回每一行的分表。
+        有一行缺少分片键时抛出异常
+        """
+        column = self._column
+        if column is None:
+            nodes = []
+            for row in rows:
+                node = self.route(row)
+                if node is None:
+                    self._raise_missing(row)
+                nodes.append(node)  # type: ignore
+            return nodes
+
+        func = self._func
+        get = self.backends.get  # type: ignore
+        nodes = []
+        for row in rows:
+            v = row.get(column, None)
+            if not v:
+                self._raise_missing(row)
+            node = get(func(v), None)
+            if node is None:
+                raise Exception("can not get backend.")
+            nodes.append(node)
+        return nodes
+
+    def _raise_missing(self, row: Dict[str, Any]):
+        raise Exception("row needs to contain the sharding fields[{}].".format(
+            self.missing(row)))
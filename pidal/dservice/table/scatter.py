@@ -0,0 +1,308 @@
+import asyncio
+
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from pidal.lib.metrics import Metrics
+from pidal.node.result import result
+from pidal.constant.db import ResultMode
+from pidal.dservice.backend.backend_manager import BackendManager
+from pidal.meta.model import DBTableStrategyBackend
+from pidal.dservice.table.merge import SortKey, iter_rows, merge, \
+        limit_rows, distinct_rows, unique_rows
+from pidal.dservice.table.spill import Spill
+
+
+def _retrieve(task: asyncio.Future):
+    if not task.cancelled():
+        task.exception()
+
+
+class _ShardError(Exception):
+    """ 归并时某个分表返回了错误 """
+
+    def __init__(self, r: result.Result):
+        super().__init__("scatter query error[{}]: {}".format(
+            getattr(r, "error_code", None), getattr(r, "message", None)))
+        self.result: result.Result = r
+
+
+class Scatter(object):
+    """
+    把查询分发到多个分表并发执行，同时执行的分表不超过 concurrency 个，
+    避免分表很多时一个查询占满所有的 Pool。结果按分表完成的顺序拼接，
+    有 order by 时按 order by 归并。
+
+    事务中同一个 node 只有一个连接，同一个 node 上的分表依次执行。
+
+    有 limit 时已经取到足够的行后调用 stop，还在排队的分表不再发送查询。
+
+    order by 查询中，读取到内存的分表结果超过 spill_budget 字节后写到
+    临时文件中，spill_budget 为 0 时不限制。
+
+    distinct 为 True 时合并后去掉重复的行。
+    """
+
+    def __init__(self, sqls: List[Tuple[DBTableStrategyBackend, str]],
+                 concurrency: int, trans_id: int = 0, spill_budget: int = 0,
+                 read: bool = False, distinct: bool = False):
+        self.sqls: List[Tuple[DBTableStrategyBackend, str]] = sqls
+        self.concurrency: int = max(1, concurrency)
+        self.trans_id: int = trans_id
+        self.spill_budget: int = spill_budget
+        # 只读查询，可以在 replica 上执行
+        self.read: bool = read
+        self.distinct: bool = distinct
+        self.backend_manager = BackendManager.get_instance()
+        self._tasks: List[asyncio.Future] = []
+        self._stopped: bool = False
+
+        metrics = Metrics.get_instance()
+        self.queries = metrics.counter("scatter.queries")
+        self.skipped = metrics.counter("scatter.skipped")
+
+    @classmethod
+    def new(cls, sqls: List[Tuple[DBTableStrategyBackend, str]],
+            concurrency: int, trans_id: int = 0,
+            spill_budget: int = 0, read: bool = False,
+            distinct: bool = False) -> 'Scatter':
+        return cls(sqls, concurrency, trans_id, spill_budget, read, distinct)
+
+    def start(self, streams: int = 0, spill: Optional[Spill] = None):
+        """
+        前 streams 个分表返回流式结果集，从开始执行到 close 一直占用连接和
+        semaphore；其余的分表读取到内存（或者 spill 的临时文件）后马上归还。
+        streams 需要小于 concurrency，否则其余的分表没有机会执行
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        locks: Dict[str, asyncio.Lock] = {}
+
+        async def _stream(node: DBTableStrategyBackend, sql: str) -> \
+                result.Result:
+            await semaphore.acquire()
+            try:
+                self.queries.inc()
+                r = await self.backend_manager.query(node.node, sql, 0,
+                                                     ResultMode.STREAM,
+                                                     self.read)
+            except BaseException:
+                semaphore.release()
+                raise
+            if isinstance(r, result.StreamResult):
+                r.add_done_callback(semaphore.release)
+            else:
+                semaphore.release()
+            return r
+
+        async def _send(node: DBTableStrategyBackend, sql: str) -> \
+                Optional[result.Result]:
+            if self._stopped:
+                self.skipped.inc()
+                return None
+            self.queries.inc()
+            if spill is None:
+                return await self.backend_manager.query(
+                        node.node, sql, self.trans_id, read=self.read)
+            r = await self.backend_manager.query(node.node, sql,
+                                                 self.trans_id,
+                                                 ResultMode.STREAM, self.read)
+            if not isinstance(r, result.StreamResultSet):
+                return r
+            return await spill.read(r)
+
+        async def _query(node: DBTableStrategyBackend, sql: str) -> \
+                Optional[result.Result]:
+            async with semaphore:
+                if not self.trans_id:
+                    return await _send(node, sql)
+                lock = locks.setdefault(node.node, asyncio.Lock())
+                async with lock:
+                    return await _send(node, sql)
+
+        self._tasks = [
+                asyncio.ensure_future(
+                    _stream(node, sql) if i < streams else _query(node, sql))
+                for i, (node, sql) in enumerate(self.sqls)]
+        for i in self._tasks:
+            # 提前返回时没有等待的分表，异常在这里取出
+            i.add_done_callback(_retrieve)
+
+    def stop(self):
+        """ 还没有开始执行的分表不再发送查询，结果为 None """
+        self._stopped = True
+
+    async def wait(self):
+        """ 等待全部分表执行完成，连接都还给 Pool 后才返回 """
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def execute(self, mode: ResultMode = ResultMode.BUFFERED,
+                      limit: Optional[Tuple[int, int]] = None) -> \
+            result.Result:
+        """
+        mode 为 ResultMode.BUFFERED 时等待全部分表完成后返回 ResultSet，
+        否则第一个分表完成后就返回 StreamResultSet，之后的分表完成一个
+        返回一个。
+
+        limit 为 (offset, count)，每个分表最多返回 offset + count 行，
+        结果读取到内存，取够 offset + count 行后不再等待其余的分表。
+        """
+        self.start()
+        if limit is not None:
+            return await self._execute_limit(limit)
+        done = asyncio.as_completed(self._tasks)
+        if mode is ResultMode.BUFFERED:
+            r = self.concat([await i for i in done])
+            if self.distinct and isinstance(r, result.ResultSet):
+                r.rows = unique_rows(r.rows)  # type: ignore
+            return r
+
+        try:
+            first = await next(done)
+        except BaseException:
+            await self.wait()
+            raise
+        if not isinstance(first, result.ResultSet):
+            await self.wait()
+            return first
+
+        async def _rows() -> AsyncIterator[Tuple]:
+            for row in first.rows:
+                yield row
+            for i in done:
+                r = await i
+                if isinstance(r, result.Error):
+                    raise Exception("scatter query error[{}]: {}".format(
+                        r.error_code, r.message))
+                for row in r.rows:  # type: ignore
+                    yield row
+
+        rows = _rows()
+        if self.distinct:
+            rows = distinct_rows(rows)
+        return result.StreamResultSet(first.field_count, first.descriptions,
+                                      rows, self.wait)
+
+    async def _execute_limit(self, limit: Tuple[int, int]) -> result.Result:
+        offset, count = limit
+        first = None
+        rows: List[Tuple] = []
+        try:
+            for i in asyncio.as_completed(self._tasks):
+                r = await i
+                if r is None:
+                    continue
+                if not isinstance(r, result.ResultSet):
+                    return r
+                if first is None:
+                    first = r
+                rows.extend(r.rows)
+                if self.distinct:
+                    rows = unique_rows(rows)
+                if len(rows) >= offset + count:
+                    break
+        finally:
+            self.stop()
+            # 事务的连接还在执行时不能返回
+            if self.trans_id:
+                await self.wait()
+        if first is None:
+            # 没有分表返回结果集（如 sqls 为空）
+            return result.ResultSet(0, [], [])
+        return result.ResultSet(first.field_count, first.descriptions,
+                                rows[offset:offset + count])
+
+    async def execute_ordered(self, order_by: List[Tuple[str, bool]],
+                              mode: ResultMode = ResultMode.BUFFERED,
+                              limit: Optional[Tuple[int, int]] = None) -> \
+            result.Result:
+        """
+        每个分表的结果已经按 order by 排好序，k 路归并成全局有序的结果。
+        归并需要同时读取全部分表：分表不多于 concurrency 时全部流式读取，
+        内存只与分表数有关；否则前 concurrency - 1 个分表流式读取，其余的
+        分表用剩下的一个连接依次读取到内存。事务中全部读取到内存。
+        同时使用的连接不超过 concurrency 个。
+
+        第一个分表返回后就开始返回，归并到需要某个分表的行时才等待它。
+        流式返回时分表的错误在读取中抛出异常。
+
+        有 limit 时归并出 offset + count 行后关闭全部的流，
+        每个流剩下的行不超过 offset + count。
+
+        不是流式读取的分表的结果超过 spill_budget 后写到临时文件中，
+        临时文件中的每个分表是一个有序的 run，归并时通过 mmap 读取。
+        distinct 时 order by 包含全部的列的话，重复的行在归并后相邻，
+        不需要在内存中保存输出过的行。
+        """
+        spill = None
+        if self.spill_budget > 0:
+            spill = Spill.new(self.spill_budget)
+        streams = 0
+        if not self.trans_id:
+            streams = len(self.sqls) if len(self.sqls) <= self.concurrency \
+                    else self.concurrency - 1
+        self.start(streams, spill)
+
+        async def _close():
+            self.stop()
+            try:
+                for r in await asyncio.gather(*self._tasks,
+                                              return_exceptions=True):
+                    if isinstance(r, result.StreamResult):
+                        await r.close()
+            finally:
+                if spill is not None:
+                    spill.close()
+
+        async def _rows(task: asyncio.Future) -> AsyncIterator[Tuple]:
+            r = await task
+            if r is None:
+                return
+            if not isinstance(r, (result.ResultSet, result.StreamResultSet)):
+                raise _ShardError(r)
+            async for row in iter_rows(r):
+                yield row
+
+        if not self._tasks:
+            return result.ResultSet(0, [], [])
+        try:
+            first = await self._tasks[0]
+            if not isinstance(first, (result.ResultSet,
+                                      result.StreamResultSet)):
+                await _close()
+                return first
+            key = SortKey.new(order_by, first.descriptions)
+        except BaseException:
+            await _close()
+            raise
+        rows = merge([_rows(i) for i in self._tasks], key)
+        if self.distinct:
+            adjacent = {i for i, _ in key.columns} == \
+                    set(range(first.field_count))
+            rows = distinct_rows(rows, adjacent)
+        if limit is not None:
+            rows = limit_rows(rows, *limit)
+        if mode is not ResultMode.BUFFERED:
+            return result.StreamResultSet(first.field_count,
+                                          first.descriptions, rows, _close)
+        try:
+            merged = [row async for row in rows]
+        except _ShardError as e:
+            return e.result
+        finally:
+            await _close()
+        return result.ResultSet(first.field_count, first.descriptions,
+                                merged)
+
+    @staticmethod
+    def concat(results: List[result.Result]) -> result.Result:
+        """ 按顺序拼接结果集，有错误时返回第一个错误 """
+        for i in results:
+            if not isinstance(i, result.ResultSet):
+                return i
+        if not results:
+            return result.ResultSet(0, [], [])
+        first = results[0]
+        rows = []
+        for i in results:
+            rows.extend(i.rows)  # type: ignore
+        return result.ResultSet(first.field_count, first.descriptions, rows)
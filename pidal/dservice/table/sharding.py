@@ -1,14 +1,16 @@
 import asyncio
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 from pidal.dservice.table.tools import Tools
 from pidal.dservice.backend.backend_manager import BackendManager
 from pidal.node.result import result
 from pidal.lib.algorithms.factory import Factory as algorithms
 from pidal.dservice.table.table import Table
+from pidal.dservice.table.router import Router
+from pidal.dservice.sqlparse.literal import decode
 from pidal.dservice.sqlparse.paser import DML, DMLW, Select, Update, Insert,\
         Delete
-from pidal.constant.db import DBTableType
+from pidal.constant.db import DBTableType, ResultMode
 from pidal.constant.common import RuleStatus
 from pidal.meta.model import DBTable, DBTableStrategy, DBTableStrategyBackend
 from pidal.dservice.zone_manager import ZoneManager
@@ -30,7 +32,11 @@ class Sharding(Table):
         self.zskeys = table_conf.zskeys
         self.zs_algorithm = algorithms.new(table_conf.zs_algorithm)
         self.zs_algorithm_args = table_conf.zs_algorithm_args
+        self.zone_router = Router.new(self.zskeys, table_conf.zs_algorithm,
+                                      self.zs_algorithm_args)
         self.lock_key = table_conf.lock_key
+        self.scatter_concurrency = table_conf.scatter_concurrency
+        self.spill_budget = table_conf.spill_budget
         self.backend_manager = BackendManager.get_instance()
         if not table_conf.strategies or len(table_conf.strategies) != 1:
             raise Exception("Sharding table need one strategy.")
@@ -64,6 +70,8 @@ class Sharding(Table):
         self.backends: Dict[int, DBTableStrategyBackend] = {}
         for i in strategy.backends:
             self.backends[i.number] = i  # type: ignore
+        self.router = Router.new(self.sharding_columns, strategy.algorithm,
+                                 self.sharding_algorithm_args, self.backends)
 
     def get_name(self) -> str:
         return self.name
@@ -74,73 +82,124 @@ class Sharding(Table):
     def get_status(self) -> RuleStatus:
         return self.status
 
-    async def execute_dml(self, sql: DML, trans_id: int = 0) -> result.Result:
+    async def execute_dml(self, sql: DML, trans_id: int = 0,
+                          mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         if not self.is_allow_write_sql(sql):
             return result.Error(
                 1034, "current zone dont allowed execute this sql{}".format(
-                    str(sql.raw)))
+                    sql.to_sql()))
+        if isinstance(sql, Insert) and sql.multi_row:
+            return await self._execute_rows(sql, trans_id)
+        if sql.in_lists:
+            sqls = self._split_in(sql)
+            if sqls is not None:
+                error = self.check_merge(sql, len(sqls))
+                if error is not None:
+                    return error
+                return self.merge_result(
+                        await self.execute_batch(sqls, trans_id), sql)
+        if isinstance(sql, Select) and not self.has_sharding_key(sql):
+            nodes = self.prune_backends(
+                    sql, self.sharding_algorithm, self.sharding_algorithm_args,
+                    self.sharding_columns, self.backends)
+            return await self.execute_scatter(sql, nodes, trans_id, mode)
         node = self.get_node(sql)[0]
-        backend = await self.backend_manager.get_backend(node.node, trans_id)
         sql.modify_table(node.prefix + str(node.number))
         if isinstance(sql, DMLW):
             sql.add_pidal(self.get_pidal_c_v())
-        return await backend.query(str(sql.raw))
+        return await self.backend_manager.query(
+                node.node, sql.to_sql(), trans_id, mode,
+                self.is_replica_read(sql, trans_id))
+
+    async def _execute_rows(self, sql: Insert, trans_id: int = 0) -> \
+            result.Result:
+        """ 多行 insert 按分表拆分，每个分表执行一个多行 insert """
+        groups: Dict[int, List[int]] = {}
+        for i, node in enumerate(self.router.route_many(sql.rows)):
+            groups.setdefault(node.number, []).append(i)
+        sqls = []
+        for number, indexes in groups.items():
+            node = self.backends[number]
+            s = sql.split(indexes)
+            s.modify_table(node.prefix + str(node.number))
+            s.add_pidal(self.get_pidal_c_v())
+            sqls.append((node, s))
+        return self.merge_ok(await self.execute_batch(sqls, trans_id))
+
+    def has_sharding_key(self, sql: DML) -> bool:
+        column = getattr(sql, "column", None) or {}
+        return all(column.get(i, None) for i in self.sharding_columns)
+
+    def _split_in(self, sql: DML) -> \
+            Optional[List[Tuple[DBTableStrategyBackend, DML]]]:
+        """
+        where 中没有分片键的等值条件、只有 `分片键 IN (...)` 时，按分表拆分
+        in 的值，每个分表只查询自己的值
+        """
+        column = getattr(sql, "column", None) or {}
+        if all(i in column for i in self.sharding_columns):
+            return None
+        for index, (c, values) in enumerate(sql.in_lists):
+            if c not in self.sharding_columns:
+                continue
+            if len(self.sharding_columns) == 1:
+                rows = [{c: decode(v)} for v in values]
+            else:
+                rows = [{**column, c: decode(v)} for v in values]
+            groups: Dict[int, List[str]] = {}
+            for v, node in zip(values, self.router.route_many(rows)):
+                groups.setdefault(node.number, []).append(v)
+            sqls = []
+            for number, vs in groups.items():
+                node = self.backends[number]
+                s = sql.split_in(index, vs)
+                self.push_down(s)
+                s.modify_table(node.prefix + str(node.number))
+                if isinstance(s, DMLW):
+                    s.add_pidal(self.get_pidal_c_v())
+                sqls.append((node, s))
+            return sqls  # type: ignore
+        return None
+
+    async def prepare(self, sql: DML) -> result.Result:
+        node = list(self.backends.values())[0]
+        sql.modify_table(node.prefix + str(node.number))
+        return await self.backend_manager.prepare(node.node, sql.to_sql())
 
     def get_node(self, sql: DML) -> List[DBTableStrategyBackend]:
         if not sql.table or not sql.column:
             raise Exception(
                     "SQL needs to contain the sharding fields[{}].".format(
                         ",".join(self.sharding_columns)))
-        args = []
-        if self.sharding_algorithm_args:
-            args = self.sharding_algorithm_args.copy()
-
-        for i in self.sharding_columns:
-            cv = sql.column.get(i, None)
-            if not cv:
-                raise Exception(
-                        "SQL needs to contain the sharding fields[{}].".format(
-                            i))
-            args.append(cv)
-        sid = self.sharding_algorithm(*args)
-        node = self.backends.get(sid, None)
-        if not node:
-            raise Exception("can not get backend.")
+        node = self.router.route(sql.column)
+        if node is None:
+            raise Exception(
+                    "SQL needs to contain the sharding fields[{}].".format(
+                        self.router.missing(sql.column)))
         return [node]
 
     def get_real_table(self, row: Dict[str, Any]) -> List[str]:
-        args = []
-        if self.sharding_algorithm_args:
-            args = self.sharding_algorithm_args.copy()
-
-        for i in self.sharding_columns:
-            cv = row.get(i, None)
-            if not cv:
-                raise Exception(
-                        "row needs to contain the sharding fields[{}].".format(
-                            i))
-            args.append(cv)
-        sid = self.sharding_algorithm(*args)
-        node = self.backends.get(sid, None)
-        if not node:
-            raise Exception("can not get backend.")
+        node = self.get_row_node(row)
         return [node.prefix + str(node.number)]
 
+    def get_row_node(self, row: Dict[str, Any]) -> DBTableStrategyBackend:
+        node = self.router.route(row)
+        if node is None:
+            raise Exception(
+                    "row needs to contain the sharding fields[{}].".format(
+                        self.router.missing(row)))
+        return node
+
     def get_pidal_c_v(self) -> int:
         return self.zone_manager.get_pidal_c_v()
 
     def is_allow_write_zone(self, row: Dict[str, Any]) -> bool:
-        args = []
-        if self.zs_algorithm_args:
-            args = self.zs_algorithm_args.copy()
-        for i in self.zskeys:
-            cv = row.get(i, None)
-            if not cv:
-                raise Exception(
-                        "row needs to contain the zskey fields[{}].".format(
-                            i))
-            args.append(cv)
-        zsid = self.zs_algorithm(*args)
+        zsid = self.zone_router.shard(row)
+        if zsid is None:
+            raise Exception(
+                    "row needs to contain the zskey fields[{}].".format(
+                        self.zone_router.missing(row)))
         return self.zone_manager.is_allow(zsid)
 
     def get_lock_columns(self) -> List[str]:
@@ -150,8 +209,10 @@ class Sharding(Table):
         if isinstance(sql, Select):
             return True
         elif isinstance(sql, Insert):
-            return self.is_allow_write_zone(sql.new_value)
+            rows = sql.rows or [sql.new_value]
+            return all(self.is_allow_write_zone(i) for i in rows)
         elif isinstance(sql, Update) or isinstance(sql, Delete):
-            return self.is_allow_write_zone(sql.raw_where)
+            return all(self.is_allow_write_zone(i)
+                       for i in self.where_rows(sql))
         else:
             return False
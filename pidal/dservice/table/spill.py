@@ -0,0 +1,262 @@
+import asyncio
+import datetime
+import functools
+import mmap
+import os
+import struct
+import tempfile
+
+from decimal import Decimal
+from typing import Any, AsyncIterator, List, Optional, Tuple
+
+from pidal.lib.metrics import Metrics
+from pidal.node.result import result
+
+Row = Tuple[Any, ...]
+
+_LENGTH = struct.Struct("<I")
+_INT = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+_TIMEDELTA = struct.Struct("<iii")
+
+# run 在内存中缓存的字节数，超过后追加到临时文件
+CHUNK_SIZE = 64 * 1024
+
+
+def estimate(row: Row) -> int:
+    """ 一行在内存中占用的大小，按编码后的字节数估算 """
+    n = 4
+    for v in row:
+        if isinstance(v, (str, bytes)):
+            n += len(v) + 5
+        else:
+            n += 9
+    return n
+
+
+def encode(row: Row, out: bytearray):
+    """
+    一行编码成 `长度 + 每一列`，每一列为 1 个字节的类型加上值：
+    N: NULL；i: int64；f: double；e: timedelta 的天、秒、微秒；
+    s、b、d、I、T、D、t: 长度加上 utf8 字符串、bytes、Decimal 的字符串、
+    超过 int64 的整数的字符串、datetime、date、time 的 isoformat。
+    只支持 driver 解码出的类型，其他类型抛出异常
+    """
+    start = len(out)
+    out += b"\0\0\0\0"
+    for v in row:
+        t = type(v)
+        if v is None:
+            out += b"N"
+        elif t is int and -2 ** 63 <= v < 2 ** 63:
+            out += b"i"
+            out += _INT.pack(v)
+        elif t is float:
+            out += b"f"
+            out += _FLOAT.pack(v)
+        elif t is datetime.timedelta:
+            out += b"e"
+            out += _TIMEDELTA.pack(v.days, v.seconds, v.microseconds)
+        else:
+            if t is str:
+                tag, data = b"s", v.encode("utf8", "surrogateescape")
+            elif t is bytes:
+                tag, data = b"b", v
+            elif t is Decimal:
+                tag, data = b"d", str(v).encode()
+            elif t is int:
+                tag, data = b"I", str(v).encode()
+            elif t is datetime.datetime:
+                tag, data = b"T", v.isoformat().encode()
+            elif t is datetime.date:
+                tag, data = b"D", v.isoformat().encode()
+            elif t is datetime.time:
+                tag, data = b"t", v.isoformat().encode()
+            else:
+                raise Exception(
+                        "spill can't encode value of type {}.".format(
+                            t.__name__))
+            out += tag
+            out += _LENGTH.pack(len(data))
+            out += data
+    _LENGTH.pack_into(out, start, len(out) - start - 4)
+
+
+def decode(buf: Any, pos: int) -> Tuple[Row, int]:
+    """ 从 pos 开始解码一行，返回 (行, 下一行的位置) """
+    length, = _LENGTH.unpack_from(buf, pos)
+    pos += 4
+    end = pos + length
+    row: List[Any] = []
+    while pos < end:
+        tag = buf[pos]
+        pos += 1
+        if tag == 78:  # N
+            row.append(None)
+        elif tag == 105:  # i
+            row.append(_INT.unpack_from(buf, pos)[0])
+            pos += 8
+        elif tag == 102:  # f
+            row.append(_FLOAT.unpack_from(buf, pos)[0])
+            pos += 8
+        elif tag == 101:  # e
+            days, seconds, microseconds = _TIMEDELTA.unpack_from(buf, pos)
+            row.append(datetime.timedelta(days, seconds, microseconds))
+            pos += 12
+        else:
+            n, = _LENGTH.unpack_from(buf, pos)
+            pos += 4
+            data = buf[pos:pos + n]
+            pos += n
+            if tag == 115:  # s
+                row.append(str(data, "utf8", "surrogateescape"))
+            elif tag == 98:  # b
+                row.append(bytes(data))
+            elif tag == 100:  # d
+                row.append(Decimal(str(data, "ascii")))
+            elif tag == 73:  # I
+                row.append(int(str(data, "ascii")))
+            elif tag == 84:  # T
+                row.append(datetime.datetime.fromisoformat(
+                    str(data, "ascii")))
+            elif tag == 68:  # D
+                row.append(datetime.date.fromisoformat(str(data, "ascii")))
+            elif tag == 116:  # t
+                row.append(datetime.time.fromisoformat(str(data, "ascii")))
+            else:
+                raise Exception("spill can't decode tag {}.".format(tag))
+    return tuple(row), end
+
+
+class Run(object):
+    """ 一个分表写到临时文件中的有序结果，由多个不跨行的 chunk 组成 """
+
+    __slots__ = ("spill", "chunks", "_buffer")
+
+    def __init__(self, spill: 'Spill'):
+        self.spill: Spill = spill
+        # (在文件中的位置, 长度)
+        self.chunks: List[Tuple[int, int]] = []
+        self._buffer: bytearray = bytearray()
+
+    async def write(self, row: Row):
+        encode(row, self._buffer)
+        if len(self._buffer) >= CHUNK_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer = bytearray()
+            self.chunks.append(await self.spill.append(data))
+
+    async def rows(self) -> AsyncIterator[Row]:
+        """ 通过 mmap 按顺序解码，只在读取到的时候才会从文件中加载 """
+        for offset, length in self.chunks:
+            view = self.spill.view()
+            pos = offset
+            end = offset + length
+            while pos < end:
+                row, pos = decode(view, pos)
+                yield row
+
+
+class Spill(object):
+    """
+    一个查询的内存预算。分表的结果读取到内存中，全部分表一共超过 budget
+    字节后，之后的分表结果写到临时文件中，作为有序的 run 通过 mmap 归并。
+    查询结束后调用 close 删除临时文件。
+
+    文件在线程池中创建和写入，不阻塞 event loop。每个 chunk 写入前先分配
+    文件中的位置，多个分表可以同时写入。
+    """
+
+    def __init__(self, budget: int, directory: Optional[str] = None):
+        self.budget: int = budget
+        self.used: int = 0
+        self.directory: Optional[str] = directory
+        self._file: Optional[Any] = None
+        self._size: int = 0
+        self._mmap: Optional[mmap.mmap] = None
+        # 文件变大后重新映射，之前的映射可能还有 run 在读取，close 时才关闭
+        self._old_maps: List[mmap.mmap] = []
+        self._lock: asyncio.Lock = asyncio.Lock()
+
+        metrics = Metrics.get_instance()
+        self.runs = metrics.counter("spill.runs")
+        self.bytes = metrics.counter("spill.bytes")
+
+    @classmethod
+    def new(cls, budget: int, directory: Optional[str] = None) -> 'Spill':
+        return cls(budget, directory)
+
+    async def read(self, r: result.StreamResultSet) -> result.Result:
+        """
+        读取一个分表的流式结果，没有超过预算时返回 ResultSet，
+        否则这个分表全部的行写到临时文件中，返回从文件读取的 StreamResultSet
+        """
+        rows: List[Row] = []
+        size = 0
+        run: Optional[Run] = None
+        try:
+            async for row in r:
+                if run is not None:
+                    await run.write(row)
+                    continue
+                n = estimate(row)
+                if self.used + n <= self.budget:
+                    self.used += n
+                    size += n
+                    rows.append(row)
+                    continue
+                run = Run(self)
+                self.used -= size
+                for i in rows:
+                    await run.write(i)
+                await run.write(row)
+                rows = []
+        finally:
+            await r.close()
+        if run is None:
+            return result.ResultSet(r.field_count, r.descriptions, rows)
+        await run.flush()
+        self.runs.inc()
+        return result.StreamResultSet(r.field_count, r.descriptions,
+                                      run.rows())
+
+    async def append(self, data: bytes) -> Tuple[int, int]:
+        """ 写入一个 chunk，返回 (在文件中的位置, 长度) """
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            if self._file is None:
+                self._file = await loop.run_in_executor(
+                        None, functools.partial(
+                            tempfile.TemporaryFile, prefix="pidal_spill_",
+                            dir=self.directory))
+        offset = self._size
+        self._size += len(data)
+        await loop.run_in_executor(None, os.pwrite,
+                                   self._file.fileno(),  # type: ignore
+                                   data, offset)
+        self.bytes.inc(len(data))
+        return offset, len(data)
+
+    def view(self) -> mmap.mmap:
+        """ 读取的 chunk 都已经写完，文件可能比 _size 短（还在写入） """
+        if self._mmap is None or len(self._mmap) < self._size:
+            if self._mmap is not None:
+                self._old_maps.append(self._mmap)
+            self._mmap = mmap.mmap(self._file.fileno(), 0,  # type: ignore
+                                   access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def close(self):
+        for i in self._old_maps:
+            i.close()
+        self._old_maps = []
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
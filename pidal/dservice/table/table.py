@@ -1,16 +1,26 @@
 import abc
-from typing import List, Dict, Any
+import asyncio
+from typing import List, Dict, Any, Optional, Tuple
 
 from pidal.node.result import result
-from pidal.dservice.sqlparse.paser import DML
-from pidal.constant.db import DBTableType
+from pidal.dservice.sqlparse.paser import DML, Select
+from pidal.constant.db import DBTableType, ResultMode
 from pidal.constant.common import RuleStatus
 from pidal.meta.model import DBTable, DBTableStrategyBackend
 from pidal.dservice.zone_manager import ZoneManager
+from pidal.dservice.backend.backend_manager import BackendManager
+from pidal.dservice.table.scatter import Scatter
+from pidal.dservice.table.merge import merge_result_sets, unique_rows
+from pidal.dservice.table.aggregate import Aggregate
 
 
 class Table(metaclass=abc.ABCMeta):
     # TODO 启动后，分析表的主键和唯一性约束.
+    backend_manager: BackendManager
+    # 没有分片键的查询同时执行的分表数
+    scatter_concurrency: int = 16
+    # 跨分表 order by 的一个查询在内存中缓存的字节数，超过后写到临时文件
+    spill_budget: int = 64 << 20
 
     @classmethod
     @abc.abstractclassmethod
@@ -18,8 +28,22 @@ class Table(metaclass=abc.ABCMeta):
         pass
 
     @abc.abstractmethod
-    async def execute_dml(self, sql: DML, trans_id: int = 0) -> result.Result:
-        """ 如果是在事务中需要传入 trans_id """
+    async def execute_dml(self, sql: DML, trans_id: int = 0,
+                          mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
+        """
+        如果是在事务中需要传入 trans_id，
+        mode 为 ResultMode.STREAM 时查询可能返回 result.StreamResultSet，
+        为 ResultMode.RAW 时可能返回 result.RawResult
+        """
+        pass
+
+    @abc.abstractmethod
+    async def prepare(self, sql: DML) -> result.Result:
+        """
+        COM_STMT_PREPARE 时在一个分表上 prepare，得到参数和结果集的列，
+        sql 中的参数为 `?`，不能路由，使用第一个分表
+        """
         pass
 
     @abc.abstractmethod
@@ -57,3 +81,189 @@ class Table(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def get_pidal_c_v(self) -> int:
         pass
+
+    @staticmethod
+    def is_replica_read(sql: DML, trans_id: int) -> bool:
+        """ 事务外、不是 FOR UPDATE 的查询可以在 replica 上执行 """
+        return not trans_id and isinstance(sql, Select) and not sql.for_update
+
+    @staticmethod
+    def where_rows(sql: DML) -> List[Dict[str, Any]]:
+        """ where 中的等值条件，in 的每个值展开成一行，用于按行检查 zone """
+        rows = [sql.raw_where]
+        for c, values in sql.in_lists:
+            if c in sql.raw_where:
+                continue
+            rows = [{**r, c: v} for r in rows for v in values]
+        return rows
+
+    async def execute_scatter(self, sql: DML,
+                              nodes: List[DBTableStrategyBackend],
+                              trans_id: int = 0,
+                              mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
+        """
+        没有分片键的查询分发到 nodes 的全部分表，结果按完成的顺序拼接，
+        有 order by 时归并成全局有序，有聚合时合并每个分表的部分聚合结果
+        """
+        error = self.check_merge(sql, len(nodes))
+        if error is not None:
+            return error
+        order_by = getattr(sql, "order_by", None)
+        limit, aggregate = self.push_down(sql)
+        sqls = []
+        for node in nodes:
+            sql.modify_table(node.prefix + str(node.number))
+            sqls.append((node, sql.to_sql()))
+        scatter = Scatter.new(sqls, self.scatter_concurrency, trans_id,
+                              self.spill_budget,
+                              self.is_replica_read(sql, trans_id),
+                              getattr(sql, "distinct", False))
+        if aggregate is not None:
+            r = await scatter.execute()
+            if not isinstance(r, result.ResultSet):
+                return r
+            r = aggregate.combine(r, order_by)
+            if sql.distinct:  # type: ignore
+                r.rows = unique_rows(r.rows)  # type: ignore
+            return self.slice_result(r, limit)
+        if order_by:
+            return await scatter.execute_ordered(order_by, mode, limit)
+        return await scatter.execute(mode, limit)
+
+    @staticmethod
+    def prune_backends(sql: DML, algorithm: Any, args: Optional[List[Any]],
+                       columns: List[str],
+                       backends: Dict[int, DBTableStrategyBackend]) -> \
+            List[DBTableStrategyBackend]:
+        """
+        没有分片键的等值条件时，分片算法支持范围（如 range）的话按分片键的
+        范围条件裁剪需要查询的分表，否则返回全部的分表
+        """
+        nodes = list(backends.values())
+        prune = getattr(algorithm, "prune", None)
+        if prune is None or not sql.ranges or len(columns) != 1:
+            return nodes
+        conditions = [(op, v) for c, op, v in sql.ranges if c == columns[0]]
+        if not conditions:
+            return nodes
+        pruned = [backends[i] for i in prune(args or [], conditions)
+                  if i in backends]
+        return pruned or nodes
+
+    @staticmethod
+    def check_merge(sql: DML, shards: int) -> Optional[result.Error]:
+        """
+        查询在 shards 个分表上执行时，不能正确合并结果（如 having、
+        count(distinct)）的返回错误，不能把每个分表的结果直接拼接
+        """
+        if shards < 2 or not isinstance(sql, Select):
+            return None
+        unsupported = sql.unsupported
+        if unsupported is None and sql.select_items and \
+                Aggregate.new(sql) is None:
+            unsupported = "this aggregate"
+        if unsupported is None:
+            return None
+        return result.Error(
+                1235, "This version of PiDAL doesn't yet support '{} across "
+                "shards'".format(unsupported))
+
+    @staticmethod
+    def push_down(sql: DML) -> \
+            Tuple[Optional[Tuple[int, int]], Optional[Aggregate]]:
+        """
+        改写分发到多个分表的查询，返回原来 limit 的 (o, n) 和聚合。
+        没有聚合时 `LIMIT o, n` 改写成 `LIMIT o + n`；有聚合时 AVG 改写成
+        SUM 和 COUNT，分表上去掉 limit。合并后再取全局的第 o 到 o + n 行
+        """
+        if not isinstance(sql, Select):
+            return None, None
+        limit = sql.get_limit()
+        aggregate = Aggregate.new(sql)
+        if aggregate is not None:
+            sql.select_list = aggregate.select_list
+            sql.limit = None
+        elif limit is not None:
+            sql.limit = ("0", str(limit[0] + limit[1]))
+        return limit, aggregate
+
+    @staticmethod
+    def slice_result(r: result.ResultSet,
+                     limit: Optional[Tuple[int, int]]) -> result.ResultSet:
+        if limit is None:
+            return r
+        offset, count = limit
+        return result.ResultSet(r.field_count, r.descriptions,
+                                r.rows[offset:offset + count])
+
+    async def execute_batch(
+            self, sqls: List[Tuple[DBTableStrategyBackend, DML]],
+            trans_id: int = 0) -> List[result.Result]:
+        """
+        在多个分表上执行 SQL，与 Scatter 一样同时执行的不超过
+        scatter_concurrency 个；事务中同一个 node 只有一个连接，
+        同一个 node 上的依次执行。返回的结果与 sqls 的顺序一致
+        """
+        nodes: Dict[Any, List[int]] = {}
+        for i, (node, _) in enumerate(sqls):
+            nodes.setdefault(node.node if trans_id else i, []).append(i)
+        r: List[Optional[result.Result]] = [None] * len(sqls)
+        semaphore = asyncio.Semaphore(max(1, self.scatter_concurrency))
+
+        async def _execute(indexes: List[int]):
+            for i in indexes:
+                node, sql = sqls[i]
+                async with semaphore:
+                    r[i] = await self.backend_manager.query(
+                            node.node, sql.to_sql(), trans_id,
+                            ResultMode.BUFFERED,
+                            self.is_replica_read(sql, trans_id))
+
+        await asyncio.gather(*[_execute(i) for i in nodes.values()])
+        return r  # type: ignore
+
+    @classmethod
+    def merge_result(cls, results: List[result.Result], sql: DML) -> \
+            result.Result:
+        """
+        合并 sql 在多个分表（已经 push_down）的结果，结果集按顺序拼接，
+        有 order by 时归并，有聚合时合并部分聚合结果，distinct 时去掉重复的
+        行，有 limit 时取合并后的第 offset 到 offset + count 行。有错误时返回
+        第一个错误
+        """
+        for i in results:
+            if isinstance(i, result.Error):
+                return i
+        if not isinstance(results[0], result.ResultSet) or \
+                not isinstance(sql, Select):
+            return cls.merge_ok(results)
+        aggregate = Aggregate.new(sql)
+        if aggregate is not None:
+            r = aggregate.combine(Scatter.concat(results),  # type: ignore
+                                  sql.order_by)
+        elif sql.order_by:
+            r = merge_result_sets(results, sql.order_by)  # type: ignore
+        else:
+            r = Scatter.concat(results)  # type: ignore
+        if sql.distinct:
+            r.rows = unique_rows(r.rows)  # type: ignore
+        return cls.slice_result(r, sql.get_limit())  # type: ignore
+
+    @staticmethod
+    def merge_ok(results: List[result.Result]) -> result.Result:
+        """ 合并多个分表的写入结果，有错误时返回第一个错误 """
+        affected_rows = 0
+        insert_id = 0
+        server_status = 0
+        warning_count = 0
+        for i in results:
+            if not isinstance(i, result.OK):
+                return i
+            affected_rows += i.affected_rows
+            warning_count += i.warning_count
+            server_status = i.server_status
+            if not insert_id:
+                insert_id = i.insert_id
+        return result.OK(affected_rows, insert_id, server_status,
+                         warning_count, "", False)
@@ -2,8 +2,6 @@ import asyncio
 
 from typing import Any, Dict, List, Optional, Union
 
-import sqlparse
-
 import pidal.node.result as result
 
 from pidal.logging import logger
@@ -13,11 +11,11 @@ from pidal.dservice.transaction.a2pc.client.constant import A2PCOperation,\
         A2PCStatus
 from pidal.dservice.transaction.a2pc.client.client import A2PCResponse,\
         A2PClient
-from pidal.constant.db import TransStatus
+from pidal.constant.db import ResultMode, TransStatus
 from pidal.dservice.backend.backend_manager import BackendManager
 from pidal.dservice.database.database import Database
 from pidal.dservice.sqlparse.paser import DML, Delete, Insert, SQL, Select,\
-        TCL, Update, DMLW
+        TCL, Update, DMLW, Parser
 from pidal.dservice.transaction.trans import Trans
 from pidal.dservice.transaction.a2pc.reundo.reundo_log import ReUnDoLog
 from pidal.dservice.transaction.a2pc.reundo.factory import \
@@ -69,16 +67,18 @@ class A2PC(Trans):
         else:
             return result.Error(r.status, r.msg)
 
-    async def execute_dml(self, sql: DML) -> result.Result:
+    async def execute_dml(self, sql: DML,
+                          mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         if not sql.table:
-            return await self.execute_other(sql)
+            return await self.execute_other(sql, mode)
         table = self.db.get_table(str(sql.table))
         if not table.is_allow_write_sql(sql):
             return result.Error(
                 1034, "current zone dont allowed execute this sql{}".format(
-                    str(sql.raw)))
+                    sql.to_sql()))
         if isinstance(sql, Select):
-            return await self.execute_select(sql)
+            return await self.execute_select(sql, mode)
         elif isinstance(sql, Insert):
             return await self.execute_insert(sql)
         elif isinstance(sql, Update):
@@ -86,12 +86,14 @@ class A2PC(Trans):
         elif isinstance(sql, Delete):
             return await self.execute_delete(sql)
         else:
-            return await self.execute_other(sql)
+            return await self.execute_other(sql, mode)
 
-    async def execute_select(self, sql: Select) -> result.Result:
+    async def execute_select(self, sql: Select,
+                             mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         table = self.db.get_table(str(sql.table))
         if not sql.is_for_update:
-            return await table.execute_dml(sql, self.xid)
+            return await table.execute_dml(sql, self.xid, mode)
         # 给数据上锁
         if not sql.raw_where:
             raise Exception("select must contain [where].")
@@ -104,9 +106,9 @@ class A2PC(Trans):
             lock_keys[i] = sql.raw_where[i]
         lock = await self.a2pc_client.acquire_lock(self.xid, node[0].node,
                                                    str(sql.table), lock_keys,
-                                                   str(sql.raw))
+                                                   sql.to_sql())
         if lock.status != 0:
-            raise Exception("{} acquire lock fail: {}", str(sql.raw), lock.msg)
+            raise Exception("{} acquire lock fail: {}", sql.to_sql(), lock.msg)
 
         r = await table.execute_dml(sql, self.xid)
         if isinstance(r, result.ResultSet):
@@ -178,12 +180,12 @@ class A2PC(Trans):
             if not reundo_sql:
                 raise Exception("can not get redo undo log.")
             before_sql = "begin;" + reundo_sql
-            c.append(self._execute_dml(i, before_sql, str(sql.raw)))
+            c.append(self._execute_dml(i, before_sql, sql.to_sql()))
 
             # 先计算好数据在上锁。减少锁定时间。
             lock_c = self.a2pc_client.acquire_lock(self.xid, node[0].node,
                                                    str(sql.table), lock_keys,
-                                                   str(sql.raw))
+                                                   sql.to_sql())
             c.append(lock_c)
         r = await asyncio.gather(*c)
         return await self._execute_ending(r, node, sql)  # type: ignore
@@ -217,11 +219,9 @@ class A2PC(Trans):
 
         if log is None:
             # 获取 undo log 并获取本地锁。
-            sl = sqlparse.parse("select * from {} ".format(
-                str(sql.table)))[0]
-            sl.insert_after(len(sl.tokens), sql.get_where())
-            sl.insert_after(len(sl.tokens), sqlparse.parse(" for update")[0])
-            old_raw = await table.execute_dml(Select(sl), self.xid)
+            sl = Parser.parse("SELECT * FROM {} {} FOR UPDATE".format(
+                str(sql.table), sql.get_where_sql()))[0]
+            old_raw = await table.execute_dml(sl, self.xid)
             if isinstance(old_raw, result.Error):
                 return old_raw
             elif not isinstance(old_raw, result.ResultSet):
@@ -245,6 +245,15 @@ class A2PC(Trans):
 
     async def execute_insert(self, sql: Insert) -> result.Result:
         table = self.db.get_table(str(sql.table))
+        if len(sql.rows) > 1:
+            # 每一行都需要单独的锁和 redo/undo log，按行依次执行
+            r = []
+            for i in range(len(sql.rows)):
+                ri = await self.execute_insert(sql.split([i]))
+                r.append(ri)
+                if not isinstance(ri, result.OK):
+                    break
+            return Table.merge_ok(r)
         lock_keys = {}
         node = table.get_node(sql)
         for i in table.get_lock_columns():
@@ -262,12 +271,12 @@ class A2PC(Trans):
             if not reundo_sql:
                 raise Exception("can not get redo undo log.")
             before_sql = "begin;" + reundo_sql
-            c.append(self._execute_dml(i, before_sql, str(sql.raw)))
+            c.append(self._execute_dml(i, before_sql, sql.to_sql()))
 
             # 先计算好数据在上锁。减少锁定时间。
             lock_c = self.a2pc_client.acquire_lock(self.xid, node[0].node,
                                                    str(sql.table), lock_keys,
-                                                   str(sql.raw))
+                                                   sql.to_sql())
             c.append(lock_c)
         r = await asyncio.gather(*c)
         return await self._execute_ending(r, node, sql)  # type: ignore
@@ -282,18 +291,18 @@ class A2PC(Trans):
         if not isinstance(lock, A2PCResponse):
             ending_sql = "ROLLBACK"
             return_v = result.Error(1000, "{} acquire lock fail: {}".format(
-                             str(sql.raw), str(lock)))
+                             sql.to_sql(), str(lock)))
         elif lock.status != 0:
             logger.warning("{} acquire lock fail: {}".format(
-                             str(sql.raw), lock.msg))
+                             sql.to_sql(), lock.msg))
             ending_sql = "ROLLBACK"
             return_v = result.Error(1000, "{} acquire lock fail: {}".format(
-                             str(sql.raw), lock.msg))
+                             sql.to_sql(), lock.msg))
         if any([isinstance(i, result.Error) for i in r]):
             errors = [i for i in r if isinstance(i, result.Error)]
             for i in errors:
                 logger.warning("{} error with code[{}],msg: {}".format(
-                                 str(sql.raw), i.error_code, i.message))
+                                 sql.to_sql(), i.error_code, i.message))
             ending_sql = "ROLLBACK"
             return_v = errors[0]
         c = []
@@ -346,12 +355,12 @@ class A2PC(Trans):
             if not reundo_sql:
                 raise Exception("can not get redo undo log.")
             before_sql = "begin;" + reundo_sql
-            c.append(self._execute_dml(i, before_sql, str(sql.raw)))
+            c.append(self._execute_dml(i, before_sql, sql.to_sql()))
 
             # 先计算好数据在上锁。减少锁定时间。
             lock_c = self.a2pc_client.acquire_lock(self.xid, node[0].node,
                                                    str(sql.table), lock_keys,
-                                                   str(sql.raw))
+                                                   sql.to_sql())
             c.append(lock_c)
         r = await asyncio.gather(*c)
         return await self._execute_ending(r, node, sql)  # type: ignore
@@ -368,11 +377,9 @@ class A2PC(Trans):
 
         if log is None:
             # 获取 undo log 并获取本地锁。
-            sl = sqlparse.parse("select * from {} ".format(
-                str(sql.table)))[0]
-            sl.insert_after(len(sl.tokens), sql.get_where())
-            sl.insert_after(len(sl.tokens), sqlparse.parse(" for update")[0])
-            old_raw = await table.execute_dml(Select(sl), self.xid)
+            sl = Parser.parse("SELECT * FROM {} {} FOR UPDATE".format(
+                str(sql.table), sql.get_where_sql()))[0]
+            old_raw = await table.execute_dml(sl, self.xid)
             if isinstance(old_raw, result.Error):
                 return old_raw
             elif not isinstance(old_raw, result.ResultSet):
@@ -382,8 +389,10 @@ class A2PC(Trans):
             log = self._reundo_log[table_name][str(lock_keys)]
         log.set_redo(None, A2PCOperation.DELETE)
 
-    async def execute_other(self, sql: SQL) -> result.Result:
-        return await self.db.execute_other(sql)
+    async def execute_other(self, sql: SQL,
+                            mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
+        return await self.db.execute_other(sql, mode)
 
     async def close(self):
         if self.status is not TransStatus.END:
@@ -6,10 +6,10 @@ from typing import Optional
 import pidal.node.result as result
 
 from pidal.logging import logger
-from pidal.constant.db import TransStatus
+from pidal.constant.db import ResultMode, TransStatus
 from pidal.dservice.backend.backend_manager import BackendManager
 from pidal.dservice.database.database import Database
-from pidal.dservice.sqlparse.paser import DML, SQL, Select, TCL
+from pidal.dservice.sqlparse.paser import DML, SQL, TCL
 from pidal.dservice.transaction.trans import Trans
 from pidal.lib.snowflake import generator as snowflake
 
@@ -20,6 +20,8 @@ class Simple(Trans):
     start transaction node1 node2
     Q：为什么需要 指定 node？
     A：因为是使用 backend 自身的本地事务机制，所以如果能提前知道用那些 node 最好。
+    没有指定的 node 在事务中第一次使用时执行 BEGIN（多行 insert、in、
+    没有分片键的查询都可能用到多个 node），提交和回滚时包括全部用到的 node。
     """
 
     @classmethod
@@ -39,6 +41,7 @@ class Simple(Trans):
 
     async def begin(self, sql: TCL) -> Optional[result.Result]:
         self.status = TransStatus.BEGINNING
+        self.backend_manager.lazy_begin.add(self.xid)
         if self.nodes:
             g = []
             for i in self.nodes:
@@ -47,16 +50,16 @@ class Simple(Trans):
         self.status = TransStatus.ACTIVE
 
     async def _begin(self, node: str):
-        b = await self.backend_manager.get_backend(node, self.xid)
-        try:
-            await b.begin()
-        except Exception as e:
-            # TODO 针对异常进行不同的处理
-            raise e
+        # 取得连接时执行 BEGIN
+        await self.backend_manager.get_backend(node, self.xid)
+
+    def _used_nodes(self):
+        self.nodes.update(self.backend_manager.trans.get(self.xid, {}))
+        return self.nodes
 
     async def commit(self, sql: TCL) -> Optional[result.Result]:
         self.status = TransStatus.COMMITING
-        if self.nodes:
+        if self._used_nodes():
             g = []
             for i in self.nodes:
                 g.append(self._commit(i))
@@ -74,7 +77,7 @@ class Simple(Trans):
 
     async def rollback(self, sql: TCL) -> Optional[result.Result]:
         self.status = TransStatus.ROLLBACKING
-        if self.nodes:
+        if self._used_nodes():
             g = []
             for i in self.nodes:
                 g.append(self._rollback(i))
@@ -91,24 +94,21 @@ class Simple(Trans):
             # TODO 针对异常进行不同的处理
             raise e
 
-    async def execute_dml(self, sql: DML) -> result.Result:
+    async def execute_dml(self, sql: DML,
+                          mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         logger.debug("xid: {} execute_dml".format(self.xid))
         if not sql.table:
-            return await self.execute_other(sql)
+            return await self.execute_other(sql, mode)
         table = self.db.get_table(str(sql.table))
-        nodes = table.get_node(sql)
-        # 查询只需要一个就可以， Table 负责筛选出合适的node
-        if isinstance(sql, Select):
-            nodes = nodes[:1]
-        for i in nodes:
-            if i not in self.nodes:
-                await self._begin(i.node)
-                self.nodes.add(i.node)
-        r = await table.execute_dml(sql, self.xid)
+        # Table 负责选出 node，新的 node 在取得连接时执行 BEGIN
+        r = await table.execute_dml(sql, self.xid, mode)
         return r
 
-    async def execute_other(self, sql: SQL) -> result.Result:
-        return await self.db.execute_other(sql)
+    async def execute_other(self, sql: SQL,
+                            mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
+        return await self.db.execute_other(sql, mode)
 
     async def close(self):
         if self.status is not TransStatus.END:
@@ -1,5 +1,5 @@
 import abc
-from pidal.constant.db import TransStatus
+from pidal.constant.db import ResultMode, TransStatus
 
 from typing import Optional
 
@@ -28,11 +28,15 @@ class Trans(metaclass=abc.ABCMeta):
         pass
 
     @abc.abstractmethod
-    async def execute_dml(self, sql: DML) -> result.Result:
+    async def execute_dml(self, sql: DML,
+                          mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         pass
 
     @abc.abstractmethod
-    async def execute_other(self, sql: SQL) -> result.Result:
+    async def execute_other(self, sql: SQL,
+                            mode: ResultMode = ResultMode.BUFFERED) -> \
+            result.Result:
         pass
 
     @abc.abstractmethod
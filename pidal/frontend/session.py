@@ -17,8 +17,6 @@ from pidal.connection_delegate import ConnectionDelegate
 from pidal.logging import logger
 from pidal.stream import IOStream
 
-MAX_PACKET_LEN = 2**24-1
-
 
 class Session(object):
 
@@ -55,7 +53,6 @@ class Session(object):
 
     async def start_serving(self):
         try:
-            i = 0
             while True:
                 packet = await mysql.PacketBytesReader.read_execute_packet(
                         self.stream)
@@ -63,13 +60,11 @@ class Session(object):
                                   Command(packet.command),
                                   packet.args, packet.query)
                 r = await self.dsession.execute(execute)
-                i += 1
-                num = int(i < 7)
-                if i > 6:
-                    num = 0
-                logger.info(r[0])
                 if r is not None:
-                    await mysql.ResultWriter.write(r, self.stream, num)
+                    # 响应的序号从请求的序号加一开始
+                    await mysql.ResultWriter.write(
+                            r, self.stream, packet.packet_number + 1,
+                            execute.command is Command.COM_STMT_EXECUTE)
         except torio.StreamClosedError:
             logger.warning("client has close with.")
             await self.close()
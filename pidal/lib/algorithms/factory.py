@@ -1,12 +1,187 @@
+import functools
+import hashlib
 import random
-from typing import Callable
+import zlib
+
+from bisect import bisect_left, bisect_right
+from decimal import Decimal, InvalidOperation
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pidal.dservice.sqlparse.literal import decode
+
+
+def _key(value: Any) -> bytes:
+    """
+    分片键转换成计算 hash 的 bytes。SQL 中的字面量在解析时已经转换成它表示
+    的值（见 sqlparse.literal），这里按字节计算，不考虑 collation（如大小写
+    不敏感）
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return str(value).encode("utf8", "surrogateescape")
+
+
+def _hash64(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          "big")
+
+
+class Mod(object):
+    """ algorithm_args 为 [N]，分片键对 N 取模 """
+
+    def __call__(self, v1: Any, v2: Any) -> int:
+        return int(v2) % int(v1)
+
+    @staticmethod
+    def bind(args: Tuple) -> Callable[[Any], int]:
+        n = int(args[0])
+        return lambda v: int(v) % n
+
+
+class Crc32(object):
+    """ algorithm_args 为 [N]，分片键的 crc32 对 N 取模 """
+
+    def __call__(self, v1: Any, v2: Any) -> int:
+        return zlib.crc32(_key(v2)) % int(v1)
+
+    @staticmethod
+    def bind(args: Tuple) -> Callable[[Any], int]:
+        n = int(args[0])
+        crc32 = zlib.crc32
+        return lambda v: crc32(_key(v)) % n
+
+
+class HashRing(object):
+    """
+    一致性 hash，algorithm_args 为 [分表数] 或者 [分表数, 每个分表的虚拟节点数]，
+    分表编号为 0 到分表数 - 1。虚拟节点预先计算成有序的数组，按 bisect 查找，
+    增加一个分表时只有约 1/N 的分片键会移动到新的分表。
+    """
+
+    VNODES = 160
+
+    def __init__(self):
+        # 参数 -> (有序的虚拟节点的 hash, 对应的分表编号)
+        self._rings: Dict[Tuple, Tuple[List[int], List[int]]] = {}
+
+    def __call__(self, *args: Any) -> int:
+        return self.bind(args[:-1])(args[-1])
+
+    def bind(self, args: Tuple) -> Callable[[Any], int]:
+        points, shards = self.ring(args)
+        last = len(points)
+
+        def route(value: Any) -> int:
+            i = bisect_right(points, _hash64(_key(value)))
+            return shards[i] if i < last else shards[0]
+        return route
+
+    def ring(self, args: Tuple) -> Tuple[List[int], List[int]]:
+        prepared = self._rings.get(args)
+        if prepared is not None:
+            return prepared
+        if not args:
+            raise Exception("hash ring algorithm need shard count.")
+        count = int(args[0])
+        vnodes = int(args[1]) if len(args) > 1 else self.VNODES
+        if count <= 0 or vnodes <= 0:
+            raise Exception("hash ring need shards and virtual nodes.")
+        nodes = sorted((_hash64("{}#{}".format(s, v).encode()), s)
+                       for s in range(count) for v in range(vnodes))
+        prepared = ([i[0] for i in nodes], [i[1] for i in nodes])
+        self._rings[args] = prepared
+        return prepared
+
+
+class Range(object):
+    """
+    按边界值分片，algorithm_args 为从小到大的边界，如 [1000, 2000] 时
+    小于 1000 的在 0 号分表，[1000, 2000) 的在 1 号分表，其余的在 2 号分表。
+    边界全部是数字时按数字比较，否则按字符串比较（如日期 "2020-01-01"）。
+    """
+
+    def __init__(self):
+        # 边界 -> (排好序的边界, 是否按数字比较)
+        self._bounds: Dict[Tuple, Tuple[List[Any], bool]] = {}
+
+    def __call__(self, *args: Any) -> int:
+        return self.bind(args[:-1])(args[-1])
+
+    def bind(self, args: Tuple) -> Callable[[Any], int]:
+        bounds, numeric = self.bounds(args)
+        convert = self._convert
+
+        def route(value: Any) -> int:
+            v = convert(value, numeric)
+            if v is None:
+                raise Exception("range sharding key [{}] is not comparable."
+                                .format(value))
+            return bisect_right(bounds, v)
+        return route
+
+    def bounds(self, args: Tuple) -> Tuple[List[Any], bool]:
+        prepared = self._bounds.get(args)
+        if prepared is not None:
+            return prepared
+        if not args:
+            raise Exception("range algorithm need boundaries.")
+        numeric = all(isinstance(i, (int, float)) for i in args)
+        bounds = [self._convert(i, numeric) for i in args]
+        if any(a >= b for a, b in zip(bounds, bounds[1:])):
+            raise Exception("range boundaries must be ascending.")
+        prepared = (bounds, numeric)
+        self._bounds[args] = prepared
+        return prepared
+
+    @staticmethod
+    def _convert(value: Any, numeric: bool) -> Optional[Any]:
+        """ SQL 中的字面量转换成它表示的值，NULL 等不能比较的值返回 None """
+        if isinstance(value, str):
+            if value.upper() == "NULL":
+                return None
+            value = decode(value)
+        if not numeric:
+            return str(value)
+        if isinstance(value, (int, float, Decimal)):
+            return value
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            return None
+
+    def prune(self, args: List[Any],
+              conditions: List[Tuple[str, str]]) -> List[int]:
+        """
+        conditions 为分片键的范围条件 (比较符, 值的字面量)，
+        返回可能有数据的分表编号
+        """
+        bounds, numeric = self.bounds(tuple(args))
+        first, last = 0, len(bounds)
+        for op, literal in conditions:
+            value = self._convert(literal, numeric)
+            if value is None:
+                continue
+            if op in (">", ">="):
+                first = max(first, bisect_right(bounds, value))
+            elif op == "<=":
+                last = min(last, bisect_right(bounds, value))
+            elif op == "<":
+                # 值正好是边界时，以它开始的分表没有小于它的数据
+                last = min(last, bisect_left(bounds, value))
+        if first > last:
+            # 条件没有交集，查一个分表得到空的结果
+            return [first]
+        return list(range(first, last + 1))
 
 
 class Factory(object):
 
     algorithms = {
-            "mod": lambda v1, v2: int(v2) % int(v1),
+            "mod": Mod(),
             "random": lambda: random.randint(0, 100),
+            "range": Range(),
+            "crc32": Crc32(),
+            "hash_ring": HashRing(),
             }
 
     @classmethod
@@ -15,3 +190,18 @@ class Factory(object):
         if not a:
             raise Exception("unkonwn algorithm [{}].".format(algorithm))
         return a
+
+    @classmethod
+    def bind(cls, algorithm: str, args: Optional[List[Any]]) -> Callable:
+        """
+        把 algorithm_args 绑定到算法上，返回只需要传入分片键的函数，
+        边界、虚拟节点等在这里预先计算好
+        """
+        a = cls.new(algorithm)
+        args = tuple(args or ())
+        bind = getattr(a, "bind", None)
+        if bind is not None:
+            return bind(args)
+        if not args:
+            return a
+        return functools.partial(a, *args)
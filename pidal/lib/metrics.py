@@ -0,0 +1,72 @@
+from typing import Dict, Optional, Union
+
+
+class Counter(object):
+    """ 只增加的计数 """
+
+    __slots__ = ("name", "value")
+
+    def __init__(self, name: str):
+        self.name: str = name
+        self.value: int = 0
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+
+class Gauge(object):
+    """ 当前值，可以增加也可以减少 """
+
+    __slots__ = ("name", "value")
+
+    def __init__(self, name: str):
+        self.name: str = name
+        self.value: Union[int, float] = 0
+
+    def set(self, v: Union[int, float]):
+        self.value = v
+
+    def inc(self, n: Union[int, float] = 1):
+        self.value += n
+
+    def dec(self, n: Union[int, float] = 1):
+        self.value -= n
+
+
+class Metrics(object):
+    """
+    进程内的指标，名字相同的指标只会创建一次，snapshot 返回当前的全部值。
+    """
+    _instance: Optional['Metrics'] = None
+
+    @classmethod
+    def get_instance(cls) -> 'Metrics':
+        if not cls._instance:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.counters: Dict[str, Counter] = {}
+        self.gauges: Dict[str, Gauge] = {}
+
+    def counter(self, name: str) -> Counter:
+        c = self.counters.get(name, None)
+        if c is None:
+            c = Counter(name)
+            self.counters[name] = c
+        return c
+
+    def gauge(self, name: str) -> Gauge:
+        g = self.gauges.get(name, None)
+        if g is None:
+            g = Gauge(name)
+            self.gauges[name] = g
+        return g
+
+    def snapshot(self) -> Dict[str, Union[int, float]]:
+        r: Dict[str, Union[int, float]] = {}
+        for k, c in self.counters.items():
+            r[k] = c.value
+        for k, g in self.gauges.items():
+            r[k] = g.value
+        return r
@@ -55,7 +55,12 @@ class DBConfig(object):
                  algorithm: str,
                  algorithm_args: Optional[List[Any]] = None,
                  transaction_mod: str = "simple",
-                 idle_in_transaction_session_timeout: int = 5000):
+                 idle_in_transaction_session_timeout: int = 5000,
+                 stream_result: bool = False,
+                 raw_result: bool = False,
+                 plan_cache_size: int = 1024,
+                 max_lag: float = 0,
+                 lag_check_interval: float = 1):
         self.name: str = name
         self.source_replica_enable: bool = source_replica_enable
         self.algorithm = algorithm
@@ -69,16 +74,36 @@ class DBConfig(object):
         self.idle_in_transaction_session_timeout: int \
             = idle_in_transaction_session_timeout
 
+        # 查询结果是否边从 backend 读取边返回给客户端，大结果集可以减少内存占用
+        self.stream_result: bool = stream_result
+
+        # 不需要合并或者改写结果的语句，直接转发 backend 返回的 packet
+        self.raw_result: bool = raw_result
+
+        # 按 SQL 指纹缓存解析结果的个数，0 表示不使用缓存
+        self.plan_cache_size: int = plan_cache_size
+
+        # replica 的复制延迟超过 max_lag 秒时不执行只读查询，0 表示不检查
+        self.max_lag: float = max_lag
+        self.lag_check_interval: float = lag_check_interval
+
     @classmethod
     def new_from_dict(cls, conf: dict) -> 'DBConfig':
         transaction_mod = str(conf.get("transaction_mod", "simple"))
         idle_in_transaction_session_timeout = conf.get(
                 "idle_in_transaction_session_timeout", 0)
+        stream_result = bool(conf.get("stream_result", False))
+        raw_result = bool(conf.get("raw_result", False))
+        plan_cache_size = int(conf.get("plan_cache_size", 1024))
+        source_replica = conf["source_replica"]
         dbc = cls(conf["name"],
-                  conf["source_replica"]["enable"],
-                  conf["source_replica"]["algorithm"],
-                  conf["source_replica"]["algorithm_args"],
-                  transaction_mod, idle_in_transaction_session_timeout)
+                  source_replica["enable"],
+                  source_replica["algorithm"],
+                  source_replica["algorithm_args"],
+                  transaction_mod, idle_in_transaction_session_timeout,
+                  stream_result, raw_result, plan_cache_size,
+                  float(source_replica.get("max_lag", 0)),
+                  float(source_replica.get("lag_check_interval", 1)))
 
         for i in conf["nodes"]:
             node = DBNode.new_from_dict(i)
@@ -134,7 +159,9 @@ class DBTable(object):
     def __init__(self, type: DBTableType, name: str,
                  status: RuleStatus, zskeys: List[str], zs_algorithm: str,
                  zs_algorithm_args: Optional[List[Any]], lock_key: str,
-                 strategies: List['DBTableStrategy']):
+                 strategies: List['DBTableStrategy'],
+                 scatter_concurrency: int = 16,
+                 spill_budget: int = 64 << 20):
         self.type: DBTableType = type
         self.name: str = name
         self.status: RuleStatus = status
@@ -145,6 +172,10 @@ class DBTable(object):
         # SHOW KEYS FROM table where Non_unique = 0 and Key_name = "PRIMARY";
         self.lock_key: str = lock_key
         self.strategies: List[DBTableStrategy] = strategies
+        # 没有分片键的查询分发到全部分表时，一个查询同时执行的分表数
+        self.scatter_concurrency: int = scatter_concurrency
+        # 跨分表 order by 的一个查询在内存中缓存的字节数，0 为不限制
+        self.spill_budget: int = spill_budget
 
     @classmethod
     def new_from_dict(cls, conf: dict) -> 'DBTable':
@@ -162,7 +193,9 @@ class DBTable(object):
             status = RuleStatus.name2value(conf["status"])
         dbt = cls(type, conf["name"], status, conf["zskeys"],
                   conf["zs_algorithm"], conf["zs_algorithm_args"],
-                  conf["lock_key"], strategies)
+                  conf["lock_key"], strategies,
+                  int(conf.get("scatter_concurrency", 16)),
+                  int(conf.get("spill_budget", 64 << 20)))
 
         return dbt
 
@@ -40,10 +40,37 @@ class Connection(abc.ABC):
     async def query(self, sql: str) -> result.Result:
         pass
 
+    @abc.abstractmethod
+    async def query_stream(self, sql: str) -> result.Result:
+        """ 结果集以 result.StreamResultSet 的形式返回，使用完需要 close """
+        pass
+
+    @abc.abstractmethod
+    async def query_raw(self, sql: str) -> result.Result:
+        """ 以 result.RawResult 返回 backend 的原始响应，使用完需要 close """
+        pass
+
     @abc.abstractmethod
     async def execute(self, sql: str) -> result.Result:
         pass
 
+    async def prepare(self, sql: str) -> result.Result:
+        """
+        在 backend 上 prepare sql，返回 result.Prepare，其中有参数和结果集
+        的列。驱动不支持时返回错误
+        """
+        return result.Error(
+                1295, "This command is not supported in the prepared "
+                "statement protocol yet")
+
+    def take_gtids(self) -> Optional[str]:
+        """
+        返回并清空上次调用之后这个连接提交的事务的 GTID，来自 OK 中
+        session_track_gtids = OWN_GTID 的 session state，没有提交时为空字符串。
+        backend 不支持（或者没有开启 GTID）时为 None
+        """
+        return None
+
     @abc.abstractmethod
     def close(self):
         pass
@@ -1,14 +1,24 @@
-from typing import Type
+from typing import Optional, Type
 
 from pidal.node.connection import Connection
 from pidal.node.platform.platform import Platform
 from pidal.node.platform.mysql.aiomysql import AIOMySQL
+from pidal.node.platform.mysql.native import NativeMySQL
 
+drivers = {
+    "aiomysql": AIOMySQL,
+    "native": NativeMySQL,
+}
 
-def get_connector(platform: Platform) -> Type[Connection]:
-    if platform is Platform.MySQL:
-        return AIOMySQL
-    elif platform is Platform.MariaDB:
-        return AIOMySQL
+
+def get_connector(platform: Platform,
+                  driver: Optional[str] = None) -> Type[Connection]:
+    if platform is Platform.MySQL or platform is Platform.MariaDB:
+        if not driver:
+            return AIOMySQL
+        connector = drivers.get(driver, None)
+        if connector is None:
+            raise Exception("Unknown driver [{}]".format(driver))
+        return connector
 
     raise Exception("Unknown platform [{}]".format(platform))
@@ -9,6 +9,7 @@ class DSN(object):
     def __init__(self, dsn: str):
         self.dsn = dsn
         self.platform: Platform
+        self.driver: Optional[str] = None
         self.hostname: Optional[str]
         self.port: Optional[int]
         self.username: Optional[str]
@@ -42,8 +43,11 @@ class DSN(object):
             self.args[k] = self.args_type_conver(v)
 
     def parse_scheme(self, scheme: str):
+        # mysql+native://... 中 + 后面的部分是使用的驱动
         scheme_info = scheme.split("+")
         self.platform = Platform.name2value(scheme_info[0])
+        if len(scheme_info) > 1:
+            self.driver = scheme_info[1].lower()
 
     def args_type_conver(self, values: List[str]) -> object:
         value = values[0]
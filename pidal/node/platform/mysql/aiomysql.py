@@ -1,19 +1,30 @@
 import time
 import traceback
 
-from typing import Optional, Union
+from typing import Any, AsyncIterator, List, Optional, Tuple, Union
 
 import aiomysql
 
 from aiomysql.connection import MySQLResult
 from aiomysql.cursors import DictCursor
 from pymysql.err import MySQLError
-from pymysql.constants import CLIENT
+from pymysql.constants import CLIENT, COMMAND
 
 import pidal.node.result as result
 
 from pidal.node.platform.dsn import DSN
 from pidal.node.connection import Connection
+from pidal.protocol.mysql import PacketBytesReader
+
+
+class RawPacket(object):
+    """ 给 aiomysql 的 _read_packet 使用，Error packet 也原样返回不抛出异常 """
+
+    def __init__(self, data: bytes, encoding: str):
+        self.payload = data
+
+    def is_error_packet(self) -> bool:
+        return False
 
 
 class AIOMySQL(Connection):
@@ -81,6 +92,60 @@ class AIOMySQL(Connection):
         except MySQLError as e:
             return result.Error(e.args[0], e.args[1])
 
+    async def query_stream(self, sql) -> result.Result:
+        try:
+            await self._ensure_connected()
+            await self._conn.query(sql, unbuffered=True)
+            self._result = self._conn._result
+        except MySQLError as e:
+            return result.Error(e.args[0], e.args[1])
+        if self._result.description is None:
+            return self.read_result()
+        return result.StreamResultSet(self._result.field_count,
+                                      self.read_descriptions(self._result),
+                                      self._read_rows(self._result),
+                                      self._finish_stream)
+
+    async def _read_rows(self, _result: MySQLResult) -> \
+            AsyncIterator[Tuple[Any, ...]]:
+        while True:
+            row = await _result._read_rowdata_packet_unbuffered()
+            if row is None:
+                return
+            yield row
+
+    async def _finish_stream(self):
+        # 客户端没有读完的数据也需要从 backend 读掉，否则连接不能复用
+        _result = self._conn._result
+        if _result is None:
+            return
+        if _result.unbuffered_active:
+            await _result._finish_unbuffered_query()
+        while self._conn._result.has_next:
+            await self._conn.next_result()
+
+    async def query_raw(self, sql) -> result.Result:
+        try:
+            await self._ensure_connected()
+            if isinstance(sql, str):
+                sql = sql.encode(self._conn.encoding, 'surrogateescape')
+            await self._conn._execute_command(COMMAND.COM_QUERY, sql)
+        except MySQLError as e:
+            return result.Error(e.args[0], e.args[1])
+        self._result = None
+        packets = PacketBytesReader.read_response(self._read_raw_packet)
+
+        async def finish():
+            # 没有转发完的 packet 也需要读掉，否则连接不能复用
+            async for _ in packets:
+                pass
+
+        return result.RawResult(packets, finish)
+
+    async def _read_raw_packet(self) -> bytes:
+        packet = await self._conn._read_packet(RawPacket)
+        return packet.payload
+
     async def execute(self, sql) -> result.Result:
         return await self.query(sql)
 
@@ -97,6 +162,13 @@ class AIOMySQL(Connection):
                           _result.has_next)  # type: ignore
             return r
 
+        return result.ResultSet(_result.field_count,
+                                self.read_descriptions(_result),
+                                list(_result.rows))  # type: ignore
+
+    @staticmethod
+    def read_descriptions(_result: MySQLResult) -> \
+            List[result.ResultDescription]:
         descriptions = []
         for i in _result.fields:
             desc = result.ResultDescription(
@@ -112,8 +184,7 @@ class AIOMySQL(Connection):
                         i.flags,
                         i.scale)
             descriptions.append(desc)
-        return result.ResultSet(_result.field_count, descriptions,
-                                list(_result.rows))  # type: ignore
+        return descriptions
 
     def close(self):
         if self._conn is not None:
@@ -0,0 +1,422 @@
+import asyncio
+import struct
+import time
+
+from typing import Any, AsyncIterator, Callable, List, Optional, Tuple
+
+import pidal.err as err
+import pidal.node.result as result
+
+from pidal.logging import logger
+from pidal.stream import AsyncIOStream
+from pidal.node.platform.dsn import DSN
+from pidal.node.connection import Connection
+from pidal.protocol.mysql import Capability, Command, PacketBytesReader, \
+    PacketWriter, PrepareOK, ResultSetField, OK, EOF, Error
+from pidal.protocol.mysql.auth import CACHING_SHA2_PASSWORD, CHARSETS, \
+    NATIVE_PASSWORD, Handshake, HandshakeResponse, scramble, sha2_rsa_encrypt
+from pidal.protocol.mysql.converter import decoders, through
+
+BINARY_CHARSET = 63
+
+
+class NativeMySQL(Connection):
+    """
+    直接基于 pidal.protocol 实现的 backend 连接，不依赖 aiomysql/PyMySQL，
+    query_raw 返回的 packet 可以原样转发给客户端。
+    """
+
+    client_flag = (Capability.LONG_PASSWORD | Capability.LONG_FLAG |
+                   Capability.PROTOCOL_41 | Capability.TRANSACTIONS |
+                   Capability.SECURE_CONNECTION |
+                   Capability.MULTI_STATEMENTS | Capability.MULTI_RESULTS |
+                   Capability.PLUGIN_AUTH |
+                   Capability.PLUGIN_AUTH_LENENC_CLIENT_DATA |
+                   Capability.SESSION_TRACK)
+
+    @classmethod
+    def new(cls, dsn: DSN) -> Connection:
+        c = cls(dsn)
+        return c
+
+    def __init__(self, dsn: DSN):
+        self.dsn = dsn
+        self.max_idle_time = dsn.max_idle_time
+        self._stream: Optional[AsyncIOStream] = None
+        self._next_seq_id: int = 0
+
+        self.closed = False  # connect close flag
+        self.last_usage = 0
+        self._last_use_time = 0.0
+        self.server_version: str = ""
+        self.connection_id: int = 0
+        # 与 server 协商后的 capability
+        self._capability: int = 0
+        # 开启了 session_track_gtids，OK 中会返回提交的 GTID
+        self._track_gtids: bool = False
+        self._gtids: str = ""
+        self._has_next: bool = False
+        self._pending: Optional[result.StreamResult] = None
+        self._result: Optional[result.Result] = None
+
+    async def connect(self):
+        if not self.closed:
+            self.close()
+        reader, writer = await asyncio.open_connection(
+                self.dsn.hostname or "127.0.0.1", self.dsn.port or 3306)
+        self._stream = AsyncIOStream(reader, writer)
+        self._next_seq_id = 0
+        try:
+            await self._handshake()
+        except BaseException:
+            self.close()
+            raise
+        self._has_next = False
+        self._pending = None
+        self.closed = False
+        self._last_use_time = time.time()
+        await self._query_ok("set @@session.autocommit=0;")
+        self._track_gtids = False
+        self._gtids = ""
+        if self._capability & Capability.SESSION_TRACK:
+            await self._track_own_gtids()
+
+    async def _track_own_gtids(self):
+        """
+        只在 gtid_mode 为 ON 时开启，这时 OK 中没有 GTID 说明没有提交事务；
+        server 不支持时不开启
+        """
+        r = await self.query("SELECT @@GLOBAL.gtid_mode")
+        if not isinstance(r, result.ResultSet) or not r.rows or \
+                str(r.rows[0][0]).upper() != "ON":
+            return
+        r = await self.query("SET @@SESSION.session_track_gtids = OWN_GTID")
+        self._track_gtids = isinstance(r, result.OK)
+
+    async def _handshake(self):
+        handshake = Handshake.decode(await self._read_packet())
+        if handshake.protocol_version != 10:
+            raise err.OperationalError(
+                    "unsupported protocol version {}.".format(
+                        handshake.protocol_version))
+        self.server_version = handshake.server_version
+        self.connection_id = handshake.connection_id
+
+        args = self.dsn.args or {}
+        charset = CHARSETS.get(args.get("charset", "utf8mb4"),
+                               CHARSETS["utf8mb4"])
+        plugin = handshake.auth_plugin_name
+        if plugin not in (NATIVE_PASSWORD, CACHING_SHA2_PASSWORD):
+            plugin = NATIVE_PASSWORD
+        salt = handshake.salt
+        self._capability = self.client_flag & handshake.capability
+        response = HandshakeResponse(
+                self._capability,
+                charset,
+                self.dsn.username or "",
+                scramble(plugin, self.dsn.password, salt),
+                self.dsn.database,
+                plugin)
+        await self._write_packet(response.encode())
+
+        while True:
+            payload = await self._read_packet()
+            first = payload[0]
+            if first == 0x00:
+                return
+            elif first == 0xff:
+                e = Error.decode(payload)
+                raise err.OperationalError(e.error_code, e.message)
+            elif first == 0xfe:
+                # AuthSwitchRequest: plugin name + 新的 salt
+                end = payload.index(b"\0", 1)
+                plugin = payload[1:end].decode()
+                salt = payload[end + 1:end + 21]
+                await self._write_packet(
+                        scramble(plugin, self.dsn.password, salt))
+            elif first == 0x01 and plugin == CACHING_SHA2_PASSWORD:
+                if payload[1:2] == b"\x03":  # fast auth 成功，后面是 OK
+                    continue
+                # 需要完整认证，先获取 server 的公钥
+                await self._write_packet(b"\x02")
+                public_key = (await self._read_packet())[1:]
+                await self._write_packet(
+                        sha2_rsa_encrypt(self.dsn.password, salt, public_key))
+            else:
+                raise err.OperationalError(
+                        "unknown auth packet {}.".format(first))
+
+    async def _ensure_connected(self):
+        if self.max_idle_time and (time.time() - self._last_use_time
+                                   > self.max_idle_time):
+            await self.connect()
+        self.last_usage = time.time()
+
+    async def _read_packet(self) -> bytes:
+        if self._stream is None:
+            raise err.OperationalError("connection has closed.")
+        try:
+            p_reader = await PacketBytesReader.read_packet(self._stream)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self.close()
+            raise err.OperationalError(
+                    "Lost connection to MySQL server: {}".format(e))
+        packet_number = p_reader.get_header().packet_number
+        if packet_number != self._next_seq_id:
+            self.close()
+            raise err.InternalError(
+                    "Packet sequence number wrong - got {} expected {}".format(
+                        packet_number, self._next_seq_id))
+        self._next_seq_id = (self._next_seq_id + p_reader.packet_count) % 256
+        return p_reader.get_payload()
+
+    async def _write_packet(self, payload: bytes):
+        if self._stream is None:
+            raise err.OperationalError("connection has closed.")
+        writer = PacketWriter(self._stream, self._next_seq_id)
+        writer.append(payload)
+        await writer.flush()
+        self._next_seq_id = writer.packet_number % 256
+
+    async def _execute_command(self, command: Command, sql: Any):
+        # 上一个流式结果没有读完时需要先读掉
+        if self._pending is not None:
+            if not self._pending.closed:
+                logger.warning("previous stream result was left incomplete.")
+                await self._pending.close()
+            self._pending = None
+        if self._has_next:
+            await self._skip_results()
+        if isinstance(sql, str):
+            sql = sql.encode("utf8", "surrogateescape")
+        self._next_seq_id = 0
+        await self._write_packet(bytes((command,)) + sql)
+
+    async def _query_ok(self, sql: str):
+        r = await self.query(sql)
+        if isinstance(r, result.Error):
+            raise err.OperationalError(r.error_code, r.message)
+
+    async def begin(self):
+        await self._ensure_connected()
+        await self._query_ok("BEGIN")
+
+    async def commit(self):
+        await self._ensure_connected()
+        await self._query_ok("COMMIT")
+
+    async def rollback(self):
+        await self._ensure_connected()
+        await self._query_ok("ROLLBACK")
+
+    async def batch(self, sql) -> result.Result:  # type: ignore
+        return await self.query(sql)
+
+    async def query(self, sql) -> result.Result:
+        """ 读取全部结果，多结果时返回第一个，后面的结果有错误时返回错误 """
+        try:
+            await self._ensure_connected()
+            await self._execute_command(Command.COM_QUERY, sql)
+            r = await self._read_buffered_result()
+            while self._has_next:
+                n = await self._read_buffered_result()
+                if isinstance(n, result.Error) and \
+                        not isinstance(r, result.Error):
+                    r = n
+        except err.Error as e:
+            return result.Error(*self._error_args(e))
+        self._result = r
+        return r
+
+    async def query_stream(self, sql) -> result.Result:
+        try:
+            await self._ensure_connected()
+            await self._execute_command(Command.COM_QUERY, sql)
+            r = await self._read_result()
+            if not isinstance(r, result.StreamResultSet) and self._has_next:
+                await self._skip_results()
+        except err.Error as e:
+            return result.Error(*self._error_args(e))
+        if isinstance(r, result.StreamResultSet):
+            self._pending = r
+        self._result = r
+        return r
+
+    async def query_raw(self, sql) -> result.Result:
+        try:
+            await self._ensure_connected()
+            await self._execute_command(Command.COM_QUERY, sql)
+        except err.Error as e:
+            return result.Error(*self._error_args(e))
+        packets = PacketBytesReader.read_response(
+                self._read_packet,
+                self._decode_ok if self._capability & Capability.SESSION_TRACK
+                else None)
+
+        async def finish():
+            # 没有转发完的 packet 也需要读掉，否则连接不能复用
+            async for _ in packets:
+                pass
+
+        r = result.RawResult(packets, finish)
+        self._pending = r
+        self._result = r
+        return r
+
+    async def prepare(self, sql) -> result.Result:
+        """
+        backend 上 prepare 后马上 close，只需要参数和结果集的列，
+        statement 不在 backend 上执行
+        """
+        try:
+            await self._ensure_connected()
+            await self._execute_command(Command.COM_STMT_PREPARE, sql)
+            payload = await self._read_packet()
+            if payload[0] == 0xff:
+                e = Error.decode(payload)
+                return result.Error(e.error_code, e.message)
+            ok = PrepareOK.decode(payload)
+            params = await self._read_fields(ok.num_params)
+            columns = await self._read_fields(ok.num_columns)
+            # COM_STMT_CLOSE 没有响应
+            await self._execute_command(Command.COM_STMT_CLOSE,
+                                        struct.pack("<I", ok.statement_id))
+        except err.Error as e:
+            return result.Error(*self._error_args(e))
+        return result.Prepare(ok.statement_id, ok.num_params, ok.num_columns,
+                              params, columns)
+
+    async def _read_result(self) -> result.Result:
+        """ 读取下一个结果，结果集的行数据通过 StreamResultSet 边读边返回 """
+        payload = await self._read_packet()
+        first = payload[0]
+        if first == 0x00:
+            ok = self._read_ok(payload)
+            self._has_next = ok.has_next
+            return result.OK(ok.affected_rows, ok.insert_id, ok.server_status,
+                             ok.warning_count, ok.message, ok.has_next)
+        elif first == 0xff:
+            e = Error.decode(payload)
+            self._has_next = False
+            return result.Error(e.error_code, e.message)
+        elif first == 0xfb:
+            self.close()
+            raise err.OperationalError(
+                    "LOAD DATA LOCAL INFILE is not supported.")
+
+        field_count = PacketBytesReader(payload).read_length_encoded_integer()
+        descriptions = await self._read_fields(field_count)
+        rows = self._read_rows(self._converters(descriptions))
+
+        async def finish():
+            async for _ in rows:
+                pass
+
+        return result.StreamResultSet(field_count, descriptions, rows, finish)
+
+    async def _read_fields(self, count: int) -> \
+            List[result.ResultDescription]:
+        """ 读取 count 个列的定义和之后的 EOF，count 为 0 时没有 EOF """
+        descriptions = []
+        for _ in range(count):
+            f = ResultSetField.decode(await self._read_packet())
+            descriptions.append(result.ResultDescription(
+                f.catalog, f.db, f.table_name, f.org_table, f.name,
+                f.org_name, f.charsetnr, f.length, f.type_code, f.flags,
+                f.scale))
+        if count:
+            await self._read_packet()  # field 结束的 EOF
+        return descriptions
+
+    async def _read_buffered_result(self) -> result.Result:
+        r = await self._read_result()
+        if isinstance(r, result.StreamResultSet):
+            return await r.fetchall()
+        return r
+
+    async def _read_rows(self, converters: List[Callable[[Any], Any]]) -> \
+            AsyncIterator[Tuple[Any, ...]]:
+        while True:
+            payload = await self._read_packet()
+            if payload[0] == 0xfe and len(payload) < 9:
+                self._has_next = EOF.decode(payload).has_next
+                return
+            if payload[0] == 0xff:
+                self._has_next = False
+                e = Error.decode(payload)
+                raise err.OperationalError(e.error_code, e.message)
+            p_reader = PacketBytesReader(payload)
+            row = []
+            for convert in converters:
+                v = p_reader.read_length_coded_view()
+                row.append(None if v is None else convert(v))
+            yield tuple(row)
+
+    async def _skip_results(self):
+        while self._has_next:
+            r = await self._read_result()
+            if isinstance(r, result.StreamResultSet):
+                await r.close()
+
+    def _read_ok(self, payload: bytes) -> OK:
+        ok = OK.decode(payload,
+                       bool(self._capability & Capability.SESSION_TRACK))
+        if ok.gtids:
+            self._gtids = ok.gtids if not self._gtids else \
+                self._gtids + "," + ok.gtids
+        return ok
+
+    def _decode_ok(self, payload: bytes) -> bytes:
+        """ 转发的 OK 去掉 session state，与 PiDAL 生成的 OK 格式一致 """
+        return self._read_ok(payload).encode()
+
+    def take_gtids(self) -> Optional[str]:
+        if not self._track_gtids:
+            return None
+        gtids, self._gtids = self._gtids, ""
+        return gtids
+
+    @staticmethod
+    def _converters(descriptions: List[result.ResultDescription]) -> \
+            List[Callable[[Any], Any]]:
+        """ 与 PyMySQL 一样把 text protocol 的值转换成 Python 类型 """
+        converters: List[Callable[[Any], Any]] = []
+        for d in descriptions:
+            decoder = decoders.get(d.type_code, through)
+            if decoder is through:
+                if d.charsetnr == BINARY_CHARSET:
+                    converters.append(bytes)
+                else:
+                    converters.append(NativeMySQL._to_str)
+            else:
+                converters.append(
+                        lambda v, decoder=decoder: decoder(str(v, "utf8")))
+        return converters
+
+    @staticmethod
+    def _to_str(v: memoryview) -> str:
+        return str(v, "utf8")
+
+    @staticmethod
+    def _error_args(e: Exception) -> Tuple[int, str]:
+        if len(e.args) >= 2:
+            return e.args[0], e.args[1]
+        return 2013, str(e)
+
+    async def execute(self, sql) -> result.Result:
+        return await self.query(sql)
+
+    def read_result(self, _result: Optional[Any] = None) -> \
+            result.Result:
+        if _result is not None:
+            return _result
+        return self._result  # type: ignore
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+            self.closed = True
+
+    def is_closed(self) -> bool:
+        return self.closed
@@ -1 +1,2 @@
-from .result import Result, ResultSet, ResultDescription, Execute, OK, EOF, Error
+from .result import Result, ResultSet, ResultDescription, Execute, OK, EOF, Error,\
+    StreamResult, StreamResultSet, RawResult, Prepare
@@ -1,6 +1,7 @@
 import abc
 
-from typing import Any, Dict, List, Tuple, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, \
+    Tuple, Optional
 
 from pidal.node.result.command import Command
 
@@ -68,6 +69,106 @@ class ResultSet(Result):
         pass
 
 
+class StreamResult(Result):
+    """
+    需要边读取边返回的结果，读取完成或者放弃读取后必须调用 close，close 会处理
+    backend 上剩余的数据并执行 done callback（如把连接还给 Pool）。
+    处理剩余数据时出错或者被取消，drained 为 False，连接上可能还有没有读完的
+    数据，不能再使用。
+    """
+
+    def __init__(self, finish: Optional[Callable[[], Awaitable[None]]] = None):
+        self._finish = finish
+        self._callbacks: List[Callable[[], Any]] = []
+        self.closed: bool = False
+        # close 时剩余的数据都已经读掉，连接可以继续使用
+        self.drained: bool = False
+
+    def add_done_callback(self, callback: Callable[[], Any]):
+        if self.closed:
+            callback()
+            return
+        self._callbacks.append(callback)
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._finish is not None:
+                await self._finish()
+            self.drained = True
+        finally:
+            for callback in self._callbacks:
+                callback()
+            self._callbacks = []
+
+
+class StreamResultSet(StreamResult):
+    """
+    流式结果集，rows 是一个异步迭代器，数据边从 backend 读取边写给客户端。
+    """
+
+    def __init__(self,
+                 field_count: int,
+                 descriptions: List[ResultDescription],
+                 rows: AsyncIterator[Tuple[Any, ...]],
+                 finish: Optional[Callable[[], Awaitable[None]]] = None):
+        super().__init__(finish)
+        self.field_count: int = field_count
+        self.descriptions: List[ResultDescription] = descriptions
+        self._rows: AsyncIterator[Tuple[Any, ...]] = rows
+        self._buffered: Optional[List[Tuple[Any, ...]]] = None
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[Any, ...]]:
+        if self._buffered is not None:
+            for row in self._buffered:
+                yield row
+            return
+        async for row in self._rows:
+            yield row
+
+    async def buffer(self):
+        """ 把剩余的数据全部读取到内存中，并提前释放 backend """
+        if self._buffered is not None:
+            return
+        rows = []
+        try:
+            async for row in self._rows:
+                rows.append(row)
+        finally:
+            await self.close()
+        self._buffered = rows
+
+    async def fetchall(self) -> ResultSet:
+        await self.buffer()
+        return ResultSet(self.field_count, self.descriptions,
+                         self._buffered)  # type: ignore
+
+    def to_mysql(self):
+        pass
+
+
+class RawResult(StreamResult):
+    """
+    backend 对一个命令的全部响应 packet（不含 header），包括 OK、Error、
+    结果集以及多结果集，写给客户端时只需要重新编号。
+    """
+
+    def __init__(self,
+                 packets: AsyncIterator[bytes],
+                 finish: Optional[Callable[[], Awaitable[None]]] = None):
+        super().__init__(finish)
+        self._packets: AsyncIterator[bytes] = packets
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for packet in self._packets:
+            yield packet
+
+    def to_mysql(self):
+        pass
+
+
 class Execute(Result):
 
     def __init__(self, length: int, command: Command, args: bytes, query: str):
@@ -80,6 +181,26 @@ class Execute(Result):
         pass
 
 
+class Prepare(Result):
+    """
+    COM_STMT_PREPARE 成功后返回给客户端的 statement 信息，params、columns
+    为 backend prepare 得到的参数和结果集的列，没有时参数使用默认的定义
+    """
+
+    def __init__(self, statement_id: int, num_params: int,
+                 num_columns: int = 0,
+                 params: Optional[List[ResultDescription]] = None,
+                 columns: Optional[List[ResultDescription]] = None):
+        self.statement_id: int = statement_id
+        self.num_params: int = num_params
+        self.num_columns: int = num_columns
+        self.params: Optional[List[ResultDescription]] = params
+        self.columns: Optional[List[ResultDescription]] = columns
+
+    def to_mysql(self):
+        pass
+
+
 class OK(Result):
 
     def __init__(self, affected_rows: int, insert_id: int, server_status: int,
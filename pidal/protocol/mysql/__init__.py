@@ -1,4 +1,6 @@
 from .command import Command
 from .server_status import ServerStatus
+from .capability import Capability
 from .packet import PacketBytesReader, PacketBytesWriter, OK, EOF, Error,\
-    Execute, ResultSet, ResultSetField, PacketHeader, ResultWriter
+    Execute, ResultSet, ResultSetField, PacketHeader, ResultWriter, \
+    PacketWriter, TextRow, MAX_PACKET_LEN, StmtExecute, PrepareOK, BinaryValue
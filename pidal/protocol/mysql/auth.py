@@ -0,0 +1,146 @@
+import hashlib
+
+from typing import Optional
+
+from pidal.protocol.mysql.capability import Capability
+from pidal.protocol.mysql.packet import PacketBytesReader, PacketBytesWriter
+
+NATIVE_PASSWORD = "mysql_native_password"
+CACHING_SHA2_PASSWORD = "caching_sha2_password"
+
+# 常用字符集对应的 collation id
+CHARSETS = {
+    "latin1": 8,
+    "utf8": 33,
+    "binary": 63,
+    "utf8mb4": 45,
+}
+
+
+class Handshake(object):
+    """ Protocol::HandshakeV10，backend 建立连接后发送的第一个 packet """
+    protocol_version: int
+    server_version: str
+    connection_id: int
+    capability: int
+    character_set: int
+    status: int
+    salt: bytes
+    auth_plugin_name: str
+
+    @classmethod
+    def decode(cls, raw: bytes) -> 'Handshake':
+        p = cls()
+        p_reader = PacketBytesReader(raw)
+        p.protocol_version = p_reader.read_uint8()
+        end = raw.index(b"\0", 1)
+        p.server_version = raw[1:end].decode()
+        p_reader.advance(end)
+        p.connection_id = p_reader.read_uint32()
+        salt = p_reader.read(8)
+        p_reader.advance(1)
+        p.capability = p_reader.read_uint16()
+        p.character_set = 0
+        p.status = 0
+        p.auth_plugin_name = NATIVE_PASSWORD
+        salt_len = 0
+        if len(raw) > p_reader._position:
+            p.character_set = p_reader.read_uint8()
+            p.status = p_reader.read_uint16()
+            p.capability |= p_reader.read_uint16() << 16
+            salt_len = p_reader.read_uint8()
+            p_reader.advance(10)
+        if p.capability & Capability.SECURE_CONNECTION:
+            # 第二部分至少 13 个字节，最后一个字节是 \0
+            salt += p_reader.read(max(13, salt_len - 8))[:12]
+        p.salt = salt
+        if p.capability & Capability.PLUGIN_AUTH:
+            name = p_reader.read_all()
+            p.auth_plugin_name = name.split(b"\0", 1)[0].decode()
+        return p
+
+
+class HandshakeResponse(object):
+    """ Protocol::HandshakeResponse41 """
+
+    def __init__(self, capability: int, character_set: int, user: str,
+                 auth_data: bytes, database: Optional[str],
+                 auth_plugin_name: str, max_packet_size: int = 2**24-1):
+        self.capability = capability
+        self.character_set = character_set
+        self.user = user
+        self.auth_data = auth_data
+        self.database = database
+        self.auth_plugin_name = auth_plugin_name
+        self.max_packet_size = max_packet_size
+
+    def encode(self) -> bytes:
+        capability = self.capability
+        if self.database:
+            capability |= Capability.CONNECT_WITH_DB
+        r = PacketBytesWriter.write_struct("<IIB23x", capability,
+                                           self.max_packet_size,
+                                           self.character_set)
+        r += self.user.encode() + b"\0"
+        if capability & Capability.PLUGIN_AUTH_LENENC_CLIENT_DATA:
+            r += PacketBytesWriter.write_length_encoded_integer(
+                    len(self.auth_data)) + self.auth_data
+        else:
+            r += PacketBytesWriter.write_struct(
+                    "B", len(self.auth_data)) + self.auth_data
+        if self.database:
+            r += self.database.encode() + b"\0"
+        if capability & Capability.PLUGIN_AUTH:
+            r += self.auth_plugin_name.encode() + b"\0"
+        return r
+
+
+def _xor(a: bytes, b: bytes) -> bytes:
+    return bytes(x ^ y for x, y in zip(a, b))
+
+
+def scramble_native_password(password: Optional[str], salt: bytes) -> bytes:
+    if not password:
+        return b""
+    stage1 = hashlib.sha1(password.encode()).digest()
+    stage2 = hashlib.sha1(stage1).digest()
+    return _xor(stage1, hashlib.sha1(salt[:20] + stage2).digest())
+
+
+def scramble_caching_sha2(password: Optional[str], salt: bytes) -> bytes:
+    if not password:
+        return b""
+    p1 = hashlib.sha256(password.encode()).digest()
+    p2 = hashlib.sha256(p1).digest()
+    p3 = hashlib.sha256(p2 + salt[:20]).digest()
+    return _xor(p1, p3)
+
+
+def scramble(plugin: str, password: Optional[str], salt: bytes) -> bytes:
+    if plugin == NATIVE_PASSWORD:
+        return scramble_native_password(password, salt)
+    elif plugin == CACHING_SHA2_PASSWORD:
+        return scramble_caching_sha2(password, salt)
+    raise Exception("unsupported auth plugin [{}].".format(plugin))
+
+
+def sha2_rsa_encrypt(password: Optional[str], salt: bytes,
+                     public_key: bytes) -> bytes:
+    """
+    caching_sha2_password 在没有缓存时需要用 server 的公钥加密密码，
+    依赖 cryptography，没有安装的时候无法使用。
+    """
+    try:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization, hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+    except ImportError:
+        raise Exception("caching_sha2_password full authentication "
+                        "requires the cryptography package.")
+    message = _xor((password or "").encode() + b"\0",
+                   salt[:20] * (len(password or "") // 20 + 2))
+    key = serialization.load_pem_public_key(public_key, default_backend())
+    return key.encrypt(  # type: ignore
+            message,
+            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA1()),
+                         algorithm=hashes.SHA1(), label=None))
@@ -1,7 +1,7 @@
 import enum
 
 
-@enum.unique
+# CHAR 和 TINY、INTERVAL 和 ENUM 是同一个值的别名，不能使用 enum.unique
 class FieldType(enum.IntEnum):
     DECIMAL = 0
     TINY = 1
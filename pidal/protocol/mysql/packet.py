@@ -1,11 +1,15 @@
+import datetime
 import struct
 
-from typing import Any, Optional, Tuple, List
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, \
+    Dict, Iterator, Optional, Tuple, List, Union
 
 import pidal.err as err
 
 from pidal.logging import logger
 from pidal.protocol.mysql import Command, ServerStatus
+from pidal.protocol.mysql.field_type import FieldType
+from pidal.protocol.mysql.flag import Flag
 from pidal.protocol.util import byte2int, int2byte, dump_packet
 from pidal.stream import Stream
 from pidal.node.result import result
@@ -22,6 +26,28 @@ MAX_INT16_VALUE = 2 ** 16 - 1
 MAX_INT24_VALUE = 2 ** 24 - 1
 MAX_INT64_VALUE = 2 ** 64 - 1
 
+# PacketWriter 缓冲区超过这个大小就写入 stream
+WRITE_BUFFER_SIZE = 64 * 1024
+
+# 单个 packet payload 的最大长度，超过的需要拆成多个 packet
+MAX_PACKET_LEN = 2**24-1
+
+HEADER_STRUCT = struct.Struct("<I")
+UINT16_STRUCT = struct.Struct("<H")
+UINT24_STRUCT = struct.Struct("<HB")
+UINT64_STRUCT = struct.Struct("<Q")
+
+_structs: Dict[str, struct.Struct] = {}
+
+
+def get_struct(fmt: str) -> struct.Struct:
+    """ 编译好的 Struct 会被缓存下来，避免每次都重新创建 """
+    s = _structs.get(fmt)
+    if s is None:
+        s = struct.Struct(fmt)
+        _structs[fmt] = s
+    return s
+
 
 class PacketHeader(object):
     payload_length: int
@@ -43,27 +69,32 @@ class PacketHeader(object):
         return header
 
     def encode(self) -> bytes:
-        result = struct.pack("<I", self.payload_length)
-        result = result[:3]
-        result += struct.pack("<B", self.packet_number)
-        return result
+        return HEADER_STRUCT.pack(
+            self.payload_length | ((self.packet_number & 0xff) << 24))
 
 
 class PacketBytesReader(object):
+    """
+    packet payload 的读取工具，内部使用 memoryview，read_view、
+    read_length_coded_view 等方法返回的都是原始 buffer 上的切片，不会复制数据。
+    """
 
     def __init__(self, raw: bytes):
         self._header: PacketHeader
-        self._data: bytes = raw
+        self._raw: bytes = raw
+        self._data: memoryview = memoryview(raw)
         self._position: int = 0
+        # payload 超过 MAX_PACKET_LEN 时由多个 packet 组成
+        self.packet_count: int = 1
 
     def get_header(self) -> PacketHeader:
         return self._header
 
     def get_raw(self) -> bytes:
-        return self._header.encode() + self._data
+        return self._header.encode() + self._raw
 
     def get_payload(self) -> bytes:
-        return self._data
+        return self._raw
 
     def advance(self, length):
         new_position = self._position + length
@@ -82,12 +113,21 @@ class PacketBytesReader(object):
             raise Exception(error_msg)
         self._position = position
 
-    def read_all(self):
+    def has_remaining(self) -> bool:
+        return 0 <= self._position < len(self._data)
+
+    def read_all(self) -> bytes:
+        return bytes(self.read_all_view())
+
+    def read_all_view(self) -> memoryview:
         result = self._data[self._position:]
         self._position = -1  # ensure no subsequent read()
         return result
 
     def read(self, size) -> bytes:
+        return bytes(self.read_view(size))
+
+    def read_view(self, size) -> memoryview:
         result = self._data[self._position:(self._position+size)]
         if len(result) != size:
             error_msg = "Result length not requested length. \
@@ -105,22 +145,22 @@ class PacketBytesReader(object):
         return result
 
     def read_uint16(self) -> int:
-        result = struct.unpack_from('<H', self._data, self._position)[0]
+        result = UINT16_STRUCT.unpack_from(self._data, self._position)[0]
         self._position += 2
         return result
 
     def read_uint24(self) -> int:
-        low, high = struct.unpack_from('<HB', self._data, self._position)
+        low, high = UINT24_STRUCT.unpack_from(self._data, self._position)
         self._position += 3
         return low + (high << 16)
 
     def read_uint32(self) -> int:
-        result = struct.unpack_from('<I', self._data, self._position)[0]
+        result = HEADER_STRUCT.unpack_from(self._data, self._position)[0]
         self._position += 4
         return result
 
     def read_uint64(self) -> int:
-        result = struct.unpack_from('<Q', self._data, self._position)[0]
+        result = UINT64_STRUCT.unpack_from(self._data, self._position)[0]
         self._position += 8
         return result
 
@@ -137,87 +177,168 @@ class PacketBytesReader(object):
         logger.error("unknown length integer %s.", c)
         raise Exception("unknown length integer {}.".format(c))
 
-    def read_length_coded_string(self) -> Optional[str]:
+    def _read_length_coded_length(self) -> Optional[int]:
         c = self.read_uint8()
         if c == NULL_COLUMN:
             return None
-        length = 0
         if c < UNSIGNED_CHAR_COLUMN:
-            length = c
+            return c
         elif c == UNSIGNED_SHORT_COLUMN:
-            length = self.read_uint16()
+            return self.read_uint16()
         elif c == UNSIGNED_INT24_COLUMN:
-            length = self.read_uint24()
+            return self.read_uint24()
         elif c == UNSIGNED_INT64_COLUMN:
-            length = self.read_uint64()
-        return self.read(length).decode()
+            return self.read_uint64()
+        return 0
+
+    def read_length_coded_string(self) -> Optional[str]:
+        length = self._read_length_coded_length()
+        if length is None:
+            return None
+        return str(self.read_view(length), "utf8")
+
+    def read_length_coded_view(self) -> Optional[memoryview]:
+        length = self._read_length_coded_length()
+        if length is None:
+            return None
+        return self.read_view(length)
+
+    def skip_length_coded_string(self):
+        length = self._read_length_coded_length()
+        if length:
+            self.advance(length)
 
     def read_struct(self, fmt) -> Tuple[Any, ...]:
-        s = struct.Struct(fmt)
+        s = get_struct(fmt)
         result = s.unpack_from(self._data, self._position)
         self._position += s.size
         return result
 
     def is_ok_packet(self):
         # https://dev.mysql.com/doc/internals/en/packet-OK_Packet.html
-        return self._data[0:1] == b'\0' and len(self._data) >= 7
+        return self._raw[0:1] == b'\0' and len(self._raw) >= 7
 
     def is_eof_packet(self):
         # http://dev.mysql.com/doc/internals/en/generic-response-packets.html#packet-EOF_Packet
         # Caution: \xFE may be LengthEncodedInteger.
         # If \xFE is LengthEncodedInteger header, 8bytes followed.
-        return self._data[0:1] == b'\xfe' and len(self._data) < 9
+        return self._raw[0:1] == b'\xfe' and len(self._raw) < 9
 
     def is_auth_switch_request(self):
         # http://dev.mysql.com/doc/internals/en/connection-phase-packets.html#packet-Protocol::AuthSwitchRequest
-        return self._data[0:1] == b'\xfe'
+        return self._raw[0:1] == b'\xfe'
 
     def is_extra_auth_data(self):
         # https://dev.mysql.com/doc/internals/en/successful-authentication.html
-        return self._data[0:1] == b'\x01'
+        return self._raw[0:1] == b'\x01'
 
     def is_resultset_packet(self):
-        field_count = ord(self._data[0:1])
+        field_count = self._raw[0]
         return 1 <= field_count <= 250
 
     def is_error_packet(self):
-        return self._data[0:1] == b'\xff'
+        return self._raw[0:1] == b'\xff'
 
     @staticmethod
     async def read_packet(stream: Stream) -> 'PacketBytesReader':
+        """
+        读取一个完整的 payload，长度为 MAX_PACKET_LEN 的 packet 后面还有后续
+        packet，直到某个 packet 的长度小于 MAX_PACKET_LEN 为止。
+        返回的 header 中 payload_length 为总长度，packet_number 为第一个
+        packet 的序号。
+        """
         header_bytes = await stream.read_bytes(4)
         header = PacketHeader.decode(header_bytes)
         res = await stream.read_bytes(header.payload_length)
+        count = 1
+        if header.payload_length == MAX_PACKET_LEN:
+            chunks = [res]
+            packet_number = header.packet_number
+            while True:
+                next_header = PacketHeader.decode(await stream.read_bytes(4))
+                packet_number = (packet_number + 1) & 0xff
+                if next_header.packet_number != packet_number:
+                    raise err.InternalError(
+                        "Packet sequence number wrong - got {} expected {}"
+                        .format(next_header.packet_number, packet_number))
+                chunks.append(
+                        await stream.read_bytes(next_header.payload_length))
+                count += 1
+                if next_header.payload_length < MAX_PACKET_LEN:
+                    break
+            # 只在最后拼接一次，join 会按总长度一次分配好
+            res = b"".join(chunks)
+            header = PacketHeader.new(len(res), header.packet_number)
         p_reader = PacketBytesReader(res)
         p_reader._header = header
+        p_reader.packet_count = count
         return p_reader
 
     @staticmethod
     async def read_execute_packet(stream: Stream) -> 'Execute':
         p_reader = await PacketBytesReader.read_packet(stream)
-        return Execute.decode(p_reader.get_payload())
+        p = Execute.decode(p_reader.get_payload())
+        # 多个 packet 组成的请求，响应从最后一个 packet 的序号之后开始
+        p.packet_number = (p_reader.get_header().packet_number +
+                           p_reader.packet_count - 1) & 0xff
+        return p
+
+    @staticmethod
+    async def read_response(read: Callable[[], Awaitable[bytes]],
+                            ok: Optional[Callable[[bytes], bytes]] = None) \
+            -> AsyncIterator[bytes]:
+        """
+        按照 text protocol 的响应格式读取一个命令的全部响应 packet，
+        read 每次返回一个完整 packet 的 payload。ok 不为 None 时 OK packet
+        先经过 ok 改写再返回（如去掉 session state）。
+        """
+        while True:
+            payload = await read()
+            if ok is not None and payload[0] == 0x00:
+                payload = ok(payload)
+            yield payload
+            first = payload[0]
+            if first == 0xff:  # Error
+                return
+            if first == 0x00:  # OK
+                p_reader = PacketBytesReader(payload)
+                p_reader.advance(1)
+                p_reader.read_length_encoded_integer()  # affected_rows
+                p_reader.read_length_encoded_integer()  # insert_id
+                server_status = p_reader.read_uint16()
+            elif first == 0xfb:
+                raise Exception("LOAD DATA LOCAL INFILE is not supported.")
+            else:
+                field_count = PacketBytesReader(
+                        payload).read_length_encoded_integer()
+                for _ in range(field_count + 1):  # fields and EOF
+                    yield await read()
+                while True:
+                    payload = await read()
+                    yield payload
+                    if payload[0] == 0xff:
+                        return
+                    if payload[0] == 0xfe and len(payload) < 9:
+                        break
+                server_status = UINT16_STRUCT.unpack_from(payload, 3)[0]
+            if not server_status & ServerStatus.SERVER_MORE_RESULTS_EXISTS:
+                return
 
 
 class PacketBytesWriter(object):
 
     @staticmethod
     def write_length_encoded_integer(v: int) -> bytes:
-        r = bytes()
         if v <= MAX_INT8_VALUE:
             return int2byte(v)
         elif v <= MAX_INT16_VALUE:
-            r = int2byte(UNSIGNED_CHAR_COLUMN)
-            r += int2byte(v)
-            return r
+            return int2byte(UNSIGNED_SHORT_COLUMN) + UINT16_STRUCT.pack(v)
         elif v <= MAX_INT24_VALUE:
-            r = int2byte(UNSIGNED_INT24_COLUMN)
-            r += int2byte(v)
-            return r
+            return int2byte(UNSIGNED_INT24_COLUMN) + \
+                HEADER_STRUCT.pack(v)[:3]
         elif v <= MAX_INT64_VALUE:
-            r = int2byte(UNSIGNED_INT64_COLUMN)
-            r += int2byte(v)
-            return r
-        return r
+            return int2byte(UNSIGNED_INT64_COLUMN) + UINT64_STRUCT.pack(v)
+        return bytes()
 
     @staticmethod
     def write_length_coded_string(v: Optional[str]) -> bytes:
@@ -234,8 +355,165 @@ class PacketBytesWriter(object):
 
     @staticmethod
     def write_struct(fmt: str, *v: Any) -> bytes:
-        result = struct.pack(fmt, *v)
-        return result
+        return get_struct(fmt).pack(*v)
+
+
+class TextRow(object):
+    """
+    text protocol 的一行数据，只持有原始 payload，各列的偏移在第一次访问时
+    才计算，取值时才解码。写回客户端时可以直接复用原始 payload。
+    """
+
+    __slots__ = ("payload", "_count", "_offsets")
+
+    def __init__(self, payload: Union[bytes, memoryview], count: int):
+        self.payload: Union[bytes, memoryview] = payload
+        self._count: int = count
+        self._offsets: Optional[List[Tuple[int, int]]] = None
+
+    def _scan(self) -> List[Tuple[int, int]]:
+        offsets = []
+        p_reader = PacketBytesReader(self.payload)  # type: ignore
+        for _ in range(self._count):
+            length = p_reader._read_length_coded_length()
+            if length is None:
+                offsets.append((-1, 0))
+                continue
+            offsets.append((p_reader._position, length))
+            p_reader.advance(length)
+        self._offsets = offsets
+        return offsets
+
+    def get_view(self, index: int) -> Optional[memoryview]:
+        offsets = self._offsets or self._scan()
+        start, length = offsets[index]
+        if start < 0:
+            return None
+        return memoryview(self.payload)[start:start + length]
+
+    def __getitem__(self, index: int) -> Optional[str]:
+        v = self.get_view(index)
+        if v is None:
+            return None
+        return str(v, "utf8")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[Optional[str]]:
+        for i in range(self._count):
+            yield self[i]
+
+    def __eq__(self, other) -> bool:
+        return tuple(self) == tuple(other)
+
+    def __repr__(self) -> str:
+        return repr(tuple(self))
+
+
+class PacketWriter(object):
+    """
+    把多个 packet 的 header 和 payload 合并写到同一个 bytearray 中，
+    超过 flush_size 或者结束时调用 flush 才一次性写入 stream。
+    """
+
+    def __init__(self, stream: Stream, packet_number: int = 0,
+                 flush_size: int = WRITE_BUFFER_SIZE):
+        self.packet_number: int = packet_number
+        self.flush_size: int = flush_size
+        self._stream: Stream = stream
+        self._buffer: bytearray = bytearray()
+
+    async def write(self, payload: bytes):
+        self.append(payload)
+        if len(self._buffer) >= self.flush_size:
+            await self.flush()
+
+    async def write_row(self, row: Tuple[Any, ...]):
+        self.append_row(row)
+        if len(self._buffer) >= self.flush_size:
+            await self.flush()
+
+    def append(self, payload: bytes):
+        buf = self._buffer
+        length = len(payload)
+        if length < MAX_PACKET_LEN:
+            buf += HEADER_STRUCT.pack(
+                length | ((self.packet_number & 0xff) << 24))
+            buf += payload
+            self.packet_number += 1
+            return
+        # 拆成多个 packet，刚好是 MAX_PACKET_LEN 整数倍时需要补一个空 packet
+        view = memoryview(payload)
+        for start in range(0, length + 1, MAX_PACKET_LEN):
+            chunk = view[start:start + MAX_PACKET_LEN]
+            buf += HEADER_STRUCT.pack(
+                len(chunk) | ((self.packet_number & 0xff) << 24))
+            buf += chunk
+            self.packet_number += 1
+
+    def append_row(self, row: Tuple[Any, ...]):
+        """ 直接把 text protocol 的一行数据编码到 buffer 中 """
+        if isinstance(row, TextRow):
+            # 原始 payload 直接拷贝，不需要解码再编码
+            self.append(row.payload)  # type: ignore
+            return
+        buf = self._buffer
+        start = len(buf)
+        buf += b"\0\0\0\0"
+        for i in row:
+            if i is None:
+                buf.append(NULL_COLUMN)
+                continue
+            if isinstance(i, str):
+                v = i.encode()
+            elif isinstance(i, (bytes, bytearray)):
+                v = i
+            else:
+                v = str(i).encode()
+            length = len(v)
+            if length <= MAX_INT8_VALUE:
+                buf.append(length)
+            else:
+                buf += PacketBytesWriter.write_length_encoded_integer(length)
+            buf += v
+        length = len(buf) - start - 4
+        if length >= MAX_PACKET_LEN:
+            payload = bytes(memoryview(buf)[start + 4:])
+            del buf[start:]
+            self.append(payload)
+            return
+        HEADER_STRUCT.pack_into(
+            buf, start, length | ((self.packet_number & 0xff) << 24))
+        self.packet_number += 1
+
+    async def write_binary_row(self, row: Tuple[Any, ...],
+                               fields: List['ResultSetField']):
+        self.append_binary_row(row, fields)
+        if len(self._buffer) >= self.flush_size:
+            await self.flush()
+
+    def append_binary_row(self, row: Tuple[Any, ...],
+                          fields: List['ResultSetField']):
+        """ binary protocol 的一行数据，COM_STMT_EXECUTE 的结果集使用 """
+        count = len(fields)
+        # null bitmap 从第 2 个 bit 开始
+        null_bitmap = bytearray((count + 9) // 8)
+        values = bytearray()
+        for i in range(count):
+            v = row[i]
+            if v is None:
+                null_bitmap[(i + 2) // 8] |= 1 << ((i + 2) % 8)
+                continue
+            values += BinaryValue.encode(fields[i].type_code, v)
+        self.append(b"\0" + null_bitmap + values)
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        # stream 可能会持有 buffer 的引用直到真正写出，所以这里换一个新的
+        data, self._buffer = self._buffer, bytearray()
+        await self._stream.write(data)
 
 
 class Execute(object):
@@ -243,7 +521,8 @@ class Execute(object):
     length: int
     command: Command
     args: bytes
-    query: str
+    query: str = ""
+    packet_number: int = 0
 
     @classmethod
     def decode(cls, raw: bytes) -> 'Execute':
@@ -258,11 +537,285 @@ class Execute(object):
                                         byte2int(raw[0])))
         finally:
             p.args = raw[1:]
-            if p.command is Command.COM_QUERY:
+            if p.command in (Command.COM_QUERY, Command.COM_STMT_PREPARE):
                 p.query = p.args.decode()
         return p
 
 
+class BinaryValue(object):
+    """ binary protocol 中参数和结果集的值的编码 """
+
+    _int_structs = {
+        FieldType.TINY: struct.Struct("<B"),
+        FieldType.SHORT: UINT16_STRUCT,
+        FieldType.YEAR: UINT16_STRUCT,
+        FieldType.LONG: struct.Struct("<I"),
+        FieldType.INT24: struct.Struct("<I"),
+        FieldType.LONGLONG: UINT64_STRUCT,
+    }
+    _signed_structs = {
+        FieldType.TINY: struct.Struct("<b"),
+        FieldType.SHORT: struct.Struct("<h"),
+        FieldType.YEAR: struct.Struct("<h"),
+        FieldType.LONG: struct.Struct("<i"),
+        FieldType.INT24: struct.Struct("<i"),
+        FieldType.LONGLONG: struct.Struct("<q"),
+    }
+    _masks = {
+        FieldType.TINY: 0xff,
+        FieldType.SHORT: 0xffff,
+        FieldType.YEAR: 0xffff,
+        FieldType.LONG: 0xffffffff,
+        FieldType.INT24: 0xffffffff,
+        FieldType.LONGLONG: 0xffffffffffffffff,
+    }
+    _date_types = (FieldType.DATE, FieldType.DATETIME, FieldType.TIMESTAMP)
+    _blob_types = (FieldType.TINY_BLOB, FieldType.MEDIUM_BLOB,
+                   FieldType.LONG_BLOB, FieldType.BLOB, FieldType.GEOMETRY)
+
+    @classmethod
+    def encode(cls, type_code: int, v: Any) -> bytes:
+        s = cls._int_structs.get(type_code)  # type: ignore
+        if s is not None:
+            return s.pack(int(v) & cls._masks[type_code])  # type: ignore
+        if type_code == FieldType.FLOAT:
+            return struct.pack("<f", float(v))
+        if type_code == FieldType.DOUBLE:
+            return struct.pack("<d", float(v))
+        if type_code in cls._date_types:
+            return cls._encode_datetime(v)
+        if type_code == FieldType.TIME:
+            return cls._encode_time(v)
+        if isinstance(v, str):
+            v = v.encode()
+        elif not isinstance(v, (bytes, bytearray)):
+            v = str(v).encode()
+        return PacketBytesWriter.write_length_encoded_integer(len(v)) + v
+
+    @staticmethod
+    def _encode_datetime(v: Any) -> bytes:
+        if isinstance(v, datetime.datetime):
+            t = (v.year, v.month, v.day, v.hour, v.minute, v.second,
+                 v.microsecond)
+        elif isinstance(v, datetime.date):
+            t = (v.year, v.month, v.day, 0, 0, 0, 0)
+        else:
+            # text protocol 的值: YYYY-MM-DD[ HH:MM:SS[.ffffff]]
+            date, _, time = str(v).partition(" ")
+            year, month, day = (int(i) for i in date.split("-"))
+            hour = minute = second = micro = 0
+            if time:
+                time, _, m = time.partition(".")
+                hour, minute, second = (int(i) for i in time.split(":"))
+                micro = int(m.ljust(6, "0")) if m else 0
+            t = (year, month, day, hour, minute, second, micro)
+        if t[6]:
+            return struct.pack("<BHBBBBBI", 11, *t)
+        if t[3] or t[4] or t[5]:
+            return struct.pack("<BHBBBBB", 7, *t[:6])
+        if t[0] or t[1] or t[2]:
+            return struct.pack("<BHBB", 4, *t[:3])
+        return b"\0"
+
+    @staticmethod
+    def _encode_time(v: Any) -> bytes:
+        if isinstance(v, datetime.timedelta):
+            negative = v < datetime.timedelta(0)
+            if negative:
+                v = -v
+            days, seconds, micro = v.days, v.seconds, v.microseconds
+            hour, minute, second = \
+                seconds // 3600, seconds // 60 % 60, seconds % 60
+        elif isinstance(v, datetime.time):
+            negative, days, micro = False, 0, v.microsecond
+            hour, minute, second = v.hour, v.minute, v.second
+        else:
+            # text protocol 的值: [-]HHH:MM:SS[.ffffff]
+            v = str(v)
+            negative = v.startswith("-")
+            v, _, m = v.lstrip("-").partition(".")
+            micro = int(m.ljust(6, "0")) if m else 0
+            hours, minute, second = (int(i) for i in v.split(":"))
+            days, hour = divmod(hours, 24)
+        if micro:
+            return struct.pack("<BBIBBBI", 12, negative, days, hour, minute,
+                               second, micro)
+        if days or hour or minute or second:
+            return struct.pack("<BBIBBB", 8, negative, days, hour, minute,
+                               second)
+        return b"\0"
+
+    @classmethod
+    def decode(cls, type_code: int, unsigned: bool,
+               p_reader: PacketBytesReader) -> Any:
+        if type_code == FieldType.NULL:
+            return None
+        structs = cls._int_structs if unsigned else cls._signed_structs
+        s = structs.get(type_code)  # type: ignore
+        if s is not None:
+            return s.unpack(p_reader.read(s.size))[0]
+        if type_code == FieldType.FLOAT:
+            return p_reader.read_struct("<f")[0]
+        if type_code == FieldType.DOUBLE:
+            return p_reader.read_struct("<d")[0]
+        if type_code in cls._date_types:
+            return cls._decode_datetime(type_code, p_reader)
+        if type_code == FieldType.TIME:
+            return cls._decode_time(p_reader)
+        length = p_reader.read_length_encoded_integer()
+        v = p_reader.read(length)
+        if type_code in cls._blob_types:
+            return v
+        return v.decode("utf8", "surrogateescape")
+
+    @staticmethod
+    def _decode_datetime(type_code: int, p_reader: PacketBytesReader) -> Any:
+        length = p_reader.read_uint8()
+        data = p_reader.read(length) + bytes(11 - length)
+        year, month, day, hour, minute, second, micro = \
+            struct.unpack("<HBBBBBI", data)
+        if type_code == FieldType.DATE:
+            return datetime.date(year, month, day)
+        return datetime.datetime(year, month, day, hour, minute, second,
+                                 micro)
+
+    @staticmethod
+    def _decode_time(p_reader: PacketBytesReader) -> datetime.timedelta:
+        length = p_reader.read_uint8()
+        data = p_reader.read(length) + bytes(12 - length)
+        negative, days, hour, minute, second, micro = \
+            struct.unpack("<BIBBBI", data)
+        v = datetime.timedelta(days=days, hours=hour, minutes=minute,
+                               seconds=second, microseconds=micro)
+        return -v if negative else v
+
+
+class StmtExecute(object):
+    """
+    COM_STMT_EXECUTE 的参数，需要知道 prepare 时的参数个数，参数类型只在
+    new_params_bound_flag 为 1 时发送，之后的执行沿用上一次的类型。
+    """
+
+    statement_id: int
+    flags: int
+    params: List[Any]
+    types: List[Tuple[int, bool]]
+
+    @staticmethod
+    def read_statement_id(args: bytes) -> int:
+        return HEADER_STRUCT.unpack_from(args)[0]
+
+    @classmethod
+    def decode(cls, args: bytes, num_params: int,
+               types: Optional[List[Tuple[int, bool]]] = None,
+               long_data: Optional[Dict[int, bytes]] = None) -> 'StmtExecute':
+        p = cls()
+        p_reader = PacketBytesReader(args)
+        p.statement_id = p_reader.read_uint32()
+        p.flags = p_reader.read_uint8()
+        p_reader.advance(4)  # iteration count 总是 1
+        p.params = []
+        p.types = types or []
+        if not num_params:
+            return p
+        null_bitmap = p_reader.read((num_params + 7) // 8)
+        if p_reader.read_uint8():
+            p.types = []
+            for _ in range(num_params):
+                type_code, flag = p_reader.read_struct("<BB")
+                p.types.append((type_code, bool(flag & 0x80)))
+        if len(p.types) != num_params:
+            raise err.ProgrammingError("statement parameters not bound.")
+        long_data = long_data or {}
+        for i, (type_code, unsigned) in enumerate(p.types):
+            if null_bitmap[i // 8] & (1 << (i % 8)):
+                p.params.append(None)
+            elif i in long_data:
+                v = long_data[i]
+                if type_code not in BinaryValue._blob_types:
+                    p.params.append(v.decode("utf8", "surrogateescape"))
+                else:
+                    p.params.append(v)
+            else:
+                p.params.append(
+                        BinaryValue.decode(type_code, unsigned, p_reader))
+        return p
+
+
+class PrepareOK(object):
+    """
+    COM_STMT_PREPARE 的响应。SELECT 的列来自 backend 上的 prepare，
+    没有 params 时参数使用 param_field 的定义。
+    """
+
+    def __init__(self, statement_id: int, num_params: int,
+                 num_columns: int = 0, warning_count: int = 0,
+                 params: Optional[List['ResultSetField']] = None,
+                 columns: Optional[List['ResultSetField']] = None):
+        self.statement_id: int = statement_id
+        self.num_params: int = num_params
+        self.num_columns: int = num_columns
+        self.warning_count: int = warning_count
+        self.params: Optional[List[ResultSetField]] = params
+        self.columns: Optional[List[ResultSetField]] = columns
+
+    @classmethod
+    def decode(cls, raw: bytes) -> 'PrepareOK':
+        """ 只解析第一个 packet，之后的参数和列需要另外读取 """
+        _, statement_id, num_columns, num_params, _, warning_count = \
+            struct.unpack_from("<BIHHBH", raw)
+        return cls(statement_id, num_params, num_columns, warning_count)
+
+    def encode(self) -> bytes:
+        return struct.pack("<BIHHBH", 0x00, self.statement_id,
+                           self.num_columns, self.num_params, 0,
+                           self.warning_count)
+
+    def write(self, writer: 'PacketWriter'):
+        writer.append(self.encode())
+        if self.num_params:
+            params = self.params or \
+                [self.param_field() for _ in range(self.num_params)]
+            for f in params:
+                writer.append(f.encode())
+            writer.append(EOF.new(self.warning_count, 0, False).encode())
+        if self.num_columns and self.columns:
+            for f in self.columns:
+                writer.append(f.encode())
+            writer.append(EOF.new(self.warning_count, 0, False).encode())
+
+    @staticmethod
+    def param_field() -> 'ResultSetField':
+        f = ResultSetField()
+        f.catalog = "def"
+        f.db = ""
+        f.table_name = ""
+        f.org_table = ""
+        f.name = "?"
+        f.org_name = ""
+        f.charsetnr = 63
+        f.length = 0
+        f.type_code = FieldType.VAR_STRING
+        f.flags = Flag.BINARY
+        f.scale = 0
+        return f
+
+    @classmethod
+    def new_from_result(cls, r: result.Prepare) -> 'PrepareOK':
+        params = None
+        if r.params is not None and len(r.params) == r.num_params:
+            params = [ResultSetField.new_from_result(i) for i in r.params]
+        columns = None
+        if r.columns is not None:
+            columns = [ResultSetField.new_from_result(i) for i in r.columns]
+        return cls(r.statement_id, r.num_params, r.num_columns,
+                   params=params, columns=columns)
+
+
+# session state 中 session_track_gtids 的类型
+SESSION_TRACK_GTIDS = 3
+
+
 class OK(object):
     affected_rows: int
     insert_id: int
@@ -270,9 +823,16 @@ class OK(object):
     warning_count: int
     message: str
     has_next: bool
+    # session_track_gtids 返回的 GTID，没有时为 None
+    gtids: Optional[str] = None
 
     @classmethod
-    def decode(cls, raw: bytes) -> 'OK':
+    def decode(cls, raw: bytes, session_track: bool = False) -> 'OK':
+        """
+        session_track 为 True 时连接开启了 CLIENT_SESSION_TRACK，message 之后
+        可能有 session state。session state 由 PiDAL 处理，解码后去掉
+        SERVER_SESSION_STATE_CHANGED，重新编码时不会转发给客户端
+        """
         p = cls()
         p_reader = PacketBytesReader(raw)
         p_reader.rewind()
@@ -281,11 +841,37 @@ class OK(object):
         p.affected_rows = p_reader.read_length_encoded_integer()
         p.insert_id = p_reader.read_length_encoded_integer()
         p.server_status, p.warning_count = p_reader.read_struct('<HH')
-        p.message = p_reader.read_all().decode()
+        if not session_track:
+            p.message = p_reader.read_all().decode()
+        else:
+            p.message = ""
+            if p_reader.has_remaining():
+                p.message = p_reader.read_length_coded_string() or ""
+            if p.server_status & ServerStatus.SERVER_SESSION_STATE_CHANGED:
+                p.server_status &= \
+                    ~ServerStatus.SERVER_SESSION_STATE_CHANGED
+                state = p_reader.read_length_coded_view()
+                if state is not None:
+                    p.gtids = cls._read_gtids(bytes(state))
         p.has_next = \
             bool(p.server_status & ServerStatus.SERVER_MORE_RESULTS_EXISTS)
         return p
 
+    @staticmethod
+    def _read_gtids(state: bytes) -> Optional[str]:
+        """ session state 由多个 `类型 + 数据` 组成 """
+        p_reader = PacketBytesReader(state)
+        while p_reader.has_remaining():
+            kind = p_reader.read_uint8()
+            data = p_reader.read_length_coded_view()
+            if kind != SESSION_TRACK_GTIDS or data is None:
+                continue
+            # 第一个字节是编码方式，之后是 GTID 集合
+            gtids = PacketBytesReader(bytes(data))
+            gtids.advance(1)
+            return gtids.read_length_coded_string()
+        return None
+
     def encode(self) -> bytes:
         r = PacketBytesWriter.write_struct('B', 0x00)
         r += PacketBytesWriter.write_length_encoded_integer(self.affected_rows)
@@ -296,8 +882,8 @@ class OK(object):
                 self.server_status | ServerStatus.SERVER_MORE_RESULTS_EXISTS
         r += PacketBytesWriter.write_struct(
                 '<HH',
-                self.warning_count,
-                server_status)
+                server_status,
+                self.warning_count)
         if isinstance(self.message, str):
             r += self.message.encode()
         else:
@@ -381,8 +967,20 @@ class Error(object):
         e.message = r.message
         return e
 
+    @classmethod
+    def new_from_exception(cls, e: Exception) -> 'Error':
+        """ backend 的错误保留错误码，其他的异常为 ER_UNKNOWN_ERROR """
+        if len(e.args) >= 2 and isinstance(e.args[0], int):
+            return cls.new_from_result(result.Error(e.args[0],
+                                                    str(e.args[1])))
+        return cls.new_from_result(result.Error(1105, str(e)))
+
 
 class ResultSetField(object):
+    """
+    decode 时只解析定长部分，catalog、name 等字符串字段在第一次访问时才从
+    原始 payload 中解码。
+    """
     catalog: Optional[str]
     db: Optional[str]
     table_name: Optional[str]
@@ -395,17 +993,30 @@ class ResultSetField(object):
     flags: int
     scale: int
 
+    _lazy_names = ("catalog", "db", "table_name", "org_table", "name",
+                   "org_name")
+
+    def __init__(self):
+        self._raw: Optional[bytes] = None
+
+    def __getattr__(self, name: str) -> Any:
+        # 只有在实例上没有这个属性的时候才会进入这里
+        raw = self.__dict__.get("_raw")
+        if raw is None or name not in ResultSetField._lazy_names:
+            raise AttributeError(name)
+        p_reader = PacketBytesReader(raw)
+        for n in ResultSetField._lazy_names:
+            self.__dict__[n] = p_reader.read_length_coded_string()
+        return self.__dict__[name]
+
     @classmethod
     def decode(cls, raw: bytes) -> 'ResultSetField':
         p = cls()
+        p._raw = raw
         p_reader = PacketBytesReader(raw)
         p_reader.rewind()
-        p.catalog = p_reader.read_length_coded_string()
-        p.db = p_reader.read_length_coded_string()
-        p.table_name = p_reader.read_length_coded_string()
-        p.org_table = p_reader.read_length_coded_string()
-        p.name = p_reader.read_length_coded_string()
-        p.org_name = p_reader.read_length_coded_string()
+        for _ in cls._lazy_names:
+            p_reader.skip_length_coded_string()
         p.charsetnr, p.length, p.type_code, p.flags, p.scale = (
             p_reader.read_struct('<xHIBHBxx'))
         # 'default' is a length coded binary and is still in the buffer?
@@ -413,6 +1024,8 @@ class ResultSetField(object):
         return p
 
     def encode(self) -> bytes:
+        if self._raw is not None:
+            return self._raw
         result = bytes()
         result += PacketBytesWriter.write_length_coded_string(self.catalog)
         result += PacketBytesWriter.write_length_coded_string(self.db)
@@ -480,85 +1093,150 @@ class ResultSet(object):
                 break
             self.rows.append(self._read_row(p_reader))
 
-    def _read_row(self, p_reader: PacketBytesReader) -> Tuple[Optional[str]]:
-        row: List[Optional[str]] = []
-        for _ in self.fields:
-            try:
-                data = p_reader.read_length_coded_string()
-            except IndexError:
-                break
-
-            row.append(data)
-        return tuple(row)
+    def _read_row(self, p_reader: PacketBytesReader) -> TextRow:
+        return TextRow(p_reader.get_payload(), len(self.fields))
 
     async def encode(self, warning_count: int, server_status: int,
-                     stream: Stream, packet_number=0):
+                     stream: Stream, packet_number=0, binary: bool = False):
 
         if not self.field_count:
             return
-        result = \
-            PacketBytesWriter.write_length_encoded_integer(self.field_count)
-        header = PacketHeader.new(len(result), packet_number).encode()
-        await stream.write(header + result)
-        packet_number += 1
+        writer = PacketWriter(stream, packet_number)
+        await self._encode_fields(warning_count, server_status, writer)
+
+        # row send
+        if binary:
+            for row in self.rows:
+                await writer.write_binary_row(row, self.fields)
+        else:
+            for row in self.rows:
+                await writer.write_row(row)
+
+        await self._encode_end(warning_count, server_status, writer)
+
+    async def encode_stream(self, rows: AsyncIterable[Tuple[Any, ...]],
+                            warning_count: int, server_status: int,
+                            stream: Stream, packet_number=0,
+                            binary: bool = False):
+        """
+        边从 backend 读取边发送给客户端。PacketWriter 超过 flush_size 才写入，
+        stream.write 在数据写入 socket 之后才会返回，客户端读取慢的时候会
+        反过来减慢从 backend 读取的速度，内存中最多只有一个 buffer 的数据。
+        """
+        if not self.field_count:
+            return
+        writer = PacketWriter(stream, packet_number)
+        await self._encode_fields(warning_count, server_status, writer)
+        errors: List[Exception] = []
+        if binary:
+            async for row in _until_error(rows, errors):
+                await writer.write_binary_row(row, self.fields)
+        else:
+            async for row in _until_error(rows, errors):
+                await writer.write_row(row)
+
+        if errors:
+            # backend 在结果集中途出错时（如查询被 kill），与 MySQL 一样用
+            # ERR 代替剩下的行
+            writer.append(Error.new_from_exception(errors[0]).encode())
+            return await writer.flush()
+        await self._encode_end(warning_count, server_status, writer)
+
+    async def _encode_fields(self, warning_count: int, server_status: int,
+                             writer: PacketWriter):
+        writer.append(
+            PacketBytesWriter.write_length_encoded_integer(self.field_count))
 
         # 发送 field
         for field in self.fields:
-            result = field.encode()
-            header = PacketHeader.new(len(result), packet_number).encode()
-            await stream.write(header)
-            await stream.write(result)
-            packet_number += 1
+            writer.append(field.encode())
 
         # field end
-        result = EOF.new(warning_count, server_status, True).encode()
-        header = PacketHeader.new(len(result), packet_number).encode()
-        await stream.write(header + result)
-        packet_number += 1
-
-        # row send
-        for row in self.rows:
-            result = bytes()
-            for i in row:
-                if i is None or isinstance(i, str) or isinstance(i, bytes):
-                    bi = i
-                else:
-                    bi = str(i)
-                result += PacketBytesWriter.write_length_coded_string(bi)
-
-            header = PacketHeader.new(len(result), packet_number).encode()
-            await stream.write(header + result)
-            packet_number += 1
+        await writer.write(
+            EOF.new(warning_count, server_status, True).encode())
 
+    @staticmethod
+    async def _encode_end(warning_count: int, server_status: int,
+                          writer: PacketWriter):
         # row end
-        result = EOF.new(warning_count, server_status, False).encode()
-
-        header = PacketHeader.new(len(result), packet_number).encode()
-        await stream.write(header + result)
+        writer.append(EOF.new(warning_count, server_status, False).encode())
+        await writer.flush()
 
     @classmethod
     def new_from_result(cls, r: result.ResultSet) -> 'ResultSet':
+        c = cls.new_from_descriptions(r.field_count, r.descriptions)
+        c.rows = r.rows
+        return c
+
+    @classmethod
+    def new_from_descriptions(
+            cls, field_count: int,
+            descriptions: List[result.ResultDescription]) -> 'ResultSet':
         c = cls()
         descs = []
-        for d in r.descriptions:
+        for d in descriptions:
             descs.append(ResultSetField.new_from_result(d))
-        c.field_count = r.field_count
+        c.field_count = field_count
         c.fields = descs
-        c.rows = r.rows
         return c
 
 
+async def _until_error(items: AsyncIterable[Any],
+                       errors: List[Exception]) -> AsyncIterator[Any]:
+    """
+    迭代 items，items 出错时把异常放到 errors 中并结束迭代；
+    写给客户端时的异常不受影响
+    """
+    try:
+        async for i in items:
+            yield i
+    except Exception as e:
+        errors.append(e)
+
+
 class ResultWriter(object):
 
     @staticmethod
     async def write(rs: List[result.Result], stream: Stream,
-                    packet_number: int):
+                    packet_number: int, binary: bool = False):
+        """ binary 为 True 时结果集使用 binary protocol（COM_STMT_EXECUTE）"""
         logger.info(rs)
+        try:
+            return await ResultWriter._write(rs, stream, packet_number,
+                                             binary)
+        finally:
+            # 流式结果集不管有没有发送都需要 close，以便释放 backend
+            for r in rs:
+                if isinstance(r, result.StreamResult):
+                    await r.close()
+
+    @staticmethod
+    async def _write(rs: List[result.Result], stream: Stream,
+                     packet_number: int, binary: bool = False):
         out = None
         for r in rs:
             if isinstance(r, result.ResultSet):
                 out = ResultSet.new_from_result(r)
-                return await out.encode(0, 32, stream, packet_number)
+                return await out.encode(0, 32, stream, packet_number, binary)
+            elif isinstance(r, result.StreamResultSet):
+                out = ResultSet.new_from_descriptions(r.field_count,
+                                                      r.descriptions)
+                return await out.encode_stream(r, 0, 32, stream,
+                                               packet_number, binary)
+            elif isinstance(r, result.Prepare):
+                writer = PacketWriter(stream, packet_number)
+                PrepareOK.new_from_result(r).write(writer)
+                return await writer.flush()
+            elif isinstance(r, result.RawResult):
+                writer = PacketWriter(stream, packet_number)
+                errors: List[Exception] = []
+                async for payload in _until_error(r, errors):
+                    await writer.write(payload)
+                if errors:
+                    # 转发到一半 backend 断开，序号接在已经转发的 packet 之后
+                    writer.append(
+                            Error.new_from_exception(errors[0]).encode())
+                return await writer.flush()
             elif isinstance(r, result.Error):
                 out = Error.new_from_result(r).encode()
                 header = PacketHeader.new(len(out), packet_number).encode()
@@ -1,4 +1,5 @@
 import abc
+import asyncio
 
 import tornado.iostream
 
@@ -24,3 +25,21 @@ class IOStream(Stream):
 
     async def write(self, data: bytes):
         return await self._stream.write(data)
+
+
+class AsyncIOStream(Stream):
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+
+    async def read_bytes(self, num_bytes: int) -> bytes:
+        return await self._reader.readexactly(num_bytes)
+
+    async def write(self, data: bytes):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def close(self):
+        self._writer.close()
@@ -0,0 +1,284 @@
+"""
+测试用的假 backend：连接不访问数据库，记录执行的 SQL，结果由 handler 生成。
+"""
+import asyncio
+import struct
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pidal.dservice.database.database as database
+import pidal.node.pool as pool
+
+from pidal.constant.db import ResultMode
+from pidal.dservice.backend.backend_manager import BackendManager
+from pidal.dservice.sqlparse.cache import PlanCache
+from pidal.dservice.table.double_sharding import DoubleSharding
+from pidal.dservice.table.router import Router
+from pidal.dservice.table.sharding import Sharding
+from pidal.lib.algorithms.factory import Factory as algorithms
+from pidal.node.pool import Pool
+from pidal.node.result import result
+from pidal.stream import Stream
+
+# (node, sql) -> 结果
+Handler = Callable[[str, str], result.Result]
+
+
+def description(name: str) -> result.ResultDescription:
+    return result.ResultDescription(None, None, None, None, name, name, 33,
+                                    0, 253, 0, 0)
+
+
+def default_handler(node: str, sql: str) -> result.Result:
+    if sql.lstrip().upper().startswith("SELECT"):
+        return result.ResultSet(1, [description("node")], [(node,)])
+    return result.OK(1, 0, 0, 0, "", False)
+
+
+class FakeConnection(object):
+
+    def __init__(self, backend: 'FakeBackend', node: str):
+        self.backend = backend
+        self.node = node
+        self.closed = False
+        # 执行过 BEGIN，还没有 COMMIT 或 ROLLBACK
+        self.in_trans = False
+        # 还没有取走的提交的 GTID
+        self.gtids = ""
+
+    async def connect(self):
+        pass
+
+    async def begin(self):
+        self.in_trans = True
+        self.backend.log.append((self.node, "BEGIN", True))
+
+    async def commit(self):
+        self.backend.log.append((self.node, "COMMIT", self.in_trans))
+        if self.in_trans:
+            self._commit()
+        self.in_trans = False
+
+    async def rollback(self):
+        self.backend.log.append((self.node, "ROLLBACK", self.in_trans))
+        self.in_trans = False
+
+    async def query(self, sql: str) -> result.Result:
+        self.backend.log.append((self.node, sql, self.in_trans))
+        if self.backend.delay:
+            await asyncio.sleep(self.backend.delay)
+        r = self.backend.handler(self.node, sql)
+        if not self.in_trans and isinstance(r, result.OK):
+            self._commit()
+        return r
+
+    def _commit(self):
+        """ 事务外的写入和 COMMIT 提交一个新的 GTID """
+        gtids = self.backend.gtids
+        if gtids is None or self.node not in gtids:
+            return
+        gtids[self.node] += 1
+        gtid = "{}:{}".format(self.node, gtids[self.node])
+        self.gtids = gtid if not self.gtids else self.gtids + "," + gtid
+
+    def take_gtids(self) -> Optional[str]:
+        if self.backend.gtids is None:
+            return None
+        gtids, self.gtids = self.gtids, ""
+        return gtids
+
+    async def prepare(self, sql: str) -> result.Result:
+        """ 结果集的列来自 handler 的结果，参数的个数为 `?` 的个数 """
+        self.backend.log.append((self.node, "PREPARE " + sql, self.in_trans))
+        r = self.backend.handler(self.node, sql)
+        if isinstance(r, result.Error):
+            return r
+        params = [description("?") for _ in range(sql.count("?"))]
+        if not isinstance(r, result.ResultSet):
+            return result.Prepare(1, len(params), 0, params, [])
+        return result.Prepare(1, len(params), r.field_count, params,
+                              r.descriptions)
+
+    async def query_stream(self, sql: str) -> result.Result:
+        """ rows 中的异常在读到时抛出，表示 backend 中途出错 """
+        r = await self.query(sql)
+        if not isinstance(r, result.ResultSet):
+            return r
+        rows = iter(r.rows)
+
+        async def _rows():
+            for row in rows:
+                if isinstance(row, BaseException):
+                    raise row
+                fetched = self.backend.fetched
+                fetched[self.node] = fetched.get(self.node, 0) + 1
+                yield row
+
+        async def finish():
+            # 与真实的连接一样，close 时读掉没有读完的行
+            for row in rows:
+                if isinstance(row, BaseException):
+                    raise row
+        return result.StreamResultSet(r.field_count, r.descriptions,
+                                      _rows(), finish)
+
+    async def query_raw(self, sql: str) -> result.Result:
+        raise NotImplementedError()
+
+    def close(self):
+        self.closed = True
+
+    def is_closed(self) -> bool:
+        return self.closed
+
+
+class FakeBackend(object):
+    """ 替换 Pool 的 connector，连接的 hostname 就是 node 的名字 """
+
+    def __init__(self, handler: Optional[Handler] = None, delay: float = 0):
+        self.handler: Handler = handler or default_handler
+        self.delay: float = delay
+        # (node, sql, 是否在 BEGIN 之后执行)
+        self.log: List[Tuple[str, str, bool]] = []
+        # 支持 session_track_gtids 时为 node -> 最后提交的事务的序号，
+        # GTID 为 `node:序号`；为 None 时连接不返回 GTID
+        self.gtids: Optional[Dict[str, int]] = None
+        # node -> 流式结果集中读取了的行数
+        self.fetched: Dict[str, int] = {}
+
+    def new(self, dsn: Any) -> FakeConnection:
+        return FakeConnection(self, dsn.hostname)
+
+    def statements(self, node: Optional[str] = None) -> List[str]:
+        return [i[1] for i in self.log if node is None or i[0] == node]
+
+
+def backend_manager(monkeypatch: Any, nodes: List[str],
+                    backend: FakeBackend, maxsize: int = 10) -> BackendManager:
+    """ 新的 BackendManager，每个 node 一个使用 backend 的 Pool """
+    monkeypatch.setattr(pool, "get_connector", lambda *args: backend)
+    monkeypatch.setattr(BackendManager, "_instance", None)
+    bm = BackendManager.new()
+    for i in nodes:
+        bm.backends[i] = Pool(0, maxsize, "mysql://u:p@{}:3306/db".format(i),
+                              name=i)
+    return bm
+
+
+class Database(database.Database):
+    """ 只有一个表的 Database，不读取配置 """
+
+    def __init__(self, bm: BackendManager, table: Any,
+                 mode: ResultMode = ResultMode.BUFFERED):
+        self.backend_manager = bm
+        self.tables = {table.get_name(): table}
+        self.plan_cache = PlanCache(16)
+        self.result_mode = mode
+        self.default_trans_mod = "simple"
+
+
+class Backend(object):
+    """ 分表，与 DBTableStrategyBackend 一样有 node、number、prefix """
+
+    def __init__(self, node: str, number: int, prefix: str = "t_"):
+        self.node = node
+        self.number = number
+        self.prefix = prefix
+
+
+class Zone(object):
+
+    def get_pidal_c_v(self) -> int:
+        return 1
+
+    def is_allow(self, zsid: int) -> bool:
+        return True
+
+
+def sharding(bm: BackendManager, column: str, algorithm: str,
+             args: List[Any], backends: Dict[int, Backend]) -> Sharding:
+    """ 不读取 backend 上的表结构，直接创建 Sharding 表 """
+    t = Sharding.__new__(Sharding)
+    t.name = "t"
+    t.zone_manager = Zone()
+    t.zskeys = [column]
+    t.zone_router = Router.new([column], "mod", [1])
+    t.sharding_columns = [column]
+    t.sharding_algorithm = algorithms.new(algorithm)
+    t.sharding_algorithm_args = args
+    t.backends = backends  # type: ignore
+    t.router = Router.new([column], algorithm, args, backends)  # type: ignore
+    t.scatter_concurrency = Sharding.scatter_concurrency
+    t.spill_budget = Sharding.spill_budget
+    t.backend_manager = bm
+    return t
+
+
+def double_sharding(bm: BackendManager, columns: List[str], algorithm: str,
+                    args: List[List[Any]],
+                    backends: List[Dict[int, Backend]]) -> DoubleSharding:
+    t = DoubleSharding.__new__(DoubleSharding)
+    t.name = "t"
+    t.zone_manager = Zone()
+    t.zskeys = [columns[0]]
+    t.zone_router = Router.new([columns[0]], "mod", [1])
+    t.sharding_columns = [[i] for i in columns]
+    t.sharding_algorithm = [algorithms.new(algorithm)] * 2
+    t.sharding_algorithm_args = args
+    t.backends = backends  # type: ignore
+    t.routers = [Router.new([c], algorithm, a, b)  # type: ignore
+                 for c, a, b in zip(columns, args, backends)]
+    t.scatter_concurrency = DoubleSharding.scatter_concurrency
+    t.spill_budget = DoubleSharding.spill_budget
+    t.backend_manager = bm
+    return t
+
+
+def packets(*payloads: bytes, seq: int = 1) -> bytes:
+    """ 连续的 packet，序号从 seq 开始 """
+    r = b""
+    for i, payload in enumerate(payloads):
+        r += struct.pack("<I", len(payload))[:3] + bytes(((seq + i) % 256,))
+        r += payload
+    return r
+
+
+class ScriptedStream(Stream):
+    """
+    按顺序返回录制的 server 响应，记录写入的 packet。
+    写入 fail_after 次之后再写入时抛出 ConnectionResetError，表示对方断开
+    """
+
+    def __init__(self, data: bytes = b"", fail_after: Optional[int] = None):
+        self.data = bytearray(data)
+        self.position = 0
+        self.fail_after = fail_after
+        self.writes = 0
+        # 写入的 packet 的 payload 和序号
+        self.written: List[bytes] = []
+        self.sequences: List[int] = []
+
+    def feed(self, data: bytes):
+        self.data += data
+
+    async def read_bytes(self, num_bytes: int) -> bytes:
+        if self.position + num_bytes > len(self.data):
+            raise asyncio.IncompleteReadError(
+                    bytes(self.data[self.position:]), num_bytes)
+        start = self.position
+        self.position += num_bytes
+        return bytes(self.data[start:self.position])
+
+    async def write(self, data: bytes):
+        if self.fail_after is not None and self.writes >= self.fail_after:
+            raise ConnectionResetError("client has gone away")
+        self.writes += 1
+        # 每次写入都是完整的 packet
+        while data:
+            length = struct.unpack("<I", data[:3] + b"\x00")[0]
+            self.sequences.append(data[3])
+            self.written.append(data[4:4 + length])
+            data = data[4 + length:]
+
+    def close(self):
+        pass
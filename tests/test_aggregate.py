@@ -0,0 +1,95 @@
+import asyncio
+
+from decimal import Decimal
+
+from pidal.dservice.sqlparse.paser import Parser
+from pidal.dservice.table.aggregate import Aggregate
+from pidal.node.result import result
+
+from tests.fake import Backend, FakeBackend, backend_manager, description, \
+        sharding
+
+NODES = ["n0", "n1"]
+
+
+def aggregate(query):
+    sql = Parser.parse(query)[0]
+    return sql, Aggregate.new(sql)
+
+
+def partial(names, rows, scales=None):
+    """ 全部分表的部分聚合结果 """
+    descriptions = [description(i) for i in names]
+    for d, scale in zip(descriptions, scales or []):
+        d.scale = scale
+    return result.ResultSet(len(names), descriptions, rows)
+
+
+def test_count_sum_min_max():
+    sql, agg = aggregate(
+            "SELECT COUNT(*), SUM(a), MIN(a), MAX(a) FROM t")
+    assert agg.select_list == "COUNT(*), SUM(a), MIN(a), MAX(a)"
+    r = agg.combine(partial(["c", "s", "mi", "ma"],
+                            [(2, 5, 1, 4), (3, 9, 0, 7), (0, None, None, None)]))
+    assert r.rows == [(5, 14, 0, 7)]
+
+
+def test_avg_uses_sum_and_count():
+    sql, agg = aggregate("SELECT AVG(a) AS x FROM t")
+    assert agg.select_list == "SUM(a) AS `x`, COUNT(a)"
+    r = agg.combine(partial(["x", "c"],
+                            [(Decimal("1.5"), 1), (Decimal("3.0"), 3)],
+                            [1, 0]))
+    assert r.rows == [(Decimal("1.1250"),)]
+    assert r.descriptions[0].scale == 5
+    # 全部分表都没有行
+    r = agg.combine(partial(["x", "c"], [(None, 0), (None, 0)], [1, 0]))
+    assert r.rows == [(None,)]
+
+
+def test_group_by():
+    sql, agg = aggregate("SELECT b, COUNT(*) FROM t GROUP BY b")
+    r = agg.combine(partial(["b", "c"],
+                            [("y", 1), ("x", 2), ("y", 3), (None, 1)]))
+    # 没有 order by 时按分组列排序，NULL 在最前
+    assert r.rows == [(None, 1), ("x", 2), ("y", 4)]
+
+
+def test_group_by_column_not_selected():
+    sql, agg = aggregate("SELECT SUM(a) FROM t GROUP BY b ORDER BY 1 DESC")
+    assert agg.select_list == "SUM(a), b"
+    r = agg.combine(partial(["s", "b"], [(1, "x"), (5, "y"), (2, "x")]),
+                    sql.order_by)
+    assert r.field_count == 1
+    assert r.rows == [(5,), (3,)]
+
+
+def test_empty_shards():
+    sql, agg = aggregate("SELECT b, SUM(a) FROM t GROUP BY b")
+    r = agg.combine(partial(["b", "s"], []))
+    assert r.rows == []
+
+
+def test_not_aggregate():
+    assert aggregate("SELECT a, b FROM t")[1] is None
+
+
+def test_unsupported_across_shards(monkeypatch):
+    backend = FakeBackend()
+    bm = backend_manager(monkeypatch, NODES, backend)
+    table = sharding(bm, "id", "mod", [2],
+                     {i: Backend("n{}".format(i), i) for i in range(2)})
+    for query in ["SELECT COUNT(DISTINCT a) FROM t",
+                  "SELECT SUM(a) + 1 FROM t",
+                  "SELECT b, COUNT(*) FROM t GROUP BY b HAVING COUNT(*) > 1",
+                  "SELECT b, COUNT(*) FROM t GROUP BY b WITH ROLLUP",
+                  "SELECT COUNT(DISTINCT a) FROM t WHERE id IN (1, 2)"]:
+        r = asyncio.run(table.execute_dml(Parser.parse(query)[0]))
+        assert isinstance(r, result.Error) and r.error_code == 1235, query
+    assert backend.log == []
+    # 只在一个分表上执行时不需要合并
+    r = asyncio.run(table.execute_dml(Parser.parse(
+        "SELECT COUNT(DISTINCT a) FROM t WHERE id = 1")[0]))
+    assert isinstance(r, result.ResultSet)
+    assert backend.statements() == [
+            "SELECT COUNT(DISTINCT a) FROM t_1 WHERE id = 1"]
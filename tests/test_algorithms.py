@@ -0,0 +1,53 @@
+import pytest
+
+from pidal.lib.algorithms.factory import Factory
+
+
+def test_mod():
+    route = Factory.bind("mod", [4])
+    assert [route(i) for i in (0, 5, "7")] == [0, 1, 3]
+    assert Factory.new("mod")(4, 5) == 1
+
+
+def test_range():
+    route = Factory.bind("range", [1000, 2000])
+    assert [route(i) for i in (1, 999, 1000, "1999", 2000, 10 ** 6)] == \
+        [0, 0, 1, 1, 2, 2]
+    dates = Factory.bind("range", ["2020-01-01", "2021-01-01"])
+    assert dates("'2020-06-01'") == 1
+    with pytest.raises(Exception):
+        route("NULL")
+    with pytest.raises(Exception):
+        Factory.bind("range", [2000, 1000])
+
+
+@pytest.mark.parametrize("conditions,shards", [
+    ([(">=", "1500")], [1, 2]),
+    ([("<", "1000")], [0]),
+    ([("<=", "1000")], [0, 1]),
+    ([(">", "10"), ("<", "20")], [0]),
+    ([(">=", "1000"), ("<=", "1999")], [1]),
+    ([(">", "3000"), ("<", "10")], [2]),
+])
+def test_range_prune(conditions, shards):
+    range_ = Factory.new("range")
+    assert range_.prune([1000, 2000], conditions) == shards
+
+
+@pytest.mark.parametrize("name", ["crc32", "hash_ring"])
+def test_hash_is_stable(name):
+    route = Factory.bind(name, [8])
+    keys = ["order-{}".format(i) for i in range(2000)]
+    shards = [route(k) for k in keys]
+    assert set(shards) == set(range(8))
+    assert shards == [Factory.bind(name, [8])(k) for k in keys]
+    # 字符串与 prepare 时 bytes 类型的参数相同
+    assert route("AB") == route(b"AB")
+
+
+def test_hash_ring_moves_few_keys():
+    keys = ["order-{}".format(i) for i in range(20000)]
+    before = Factory.bind("hash_ring", [8])
+    after = Factory.bind("hash_ring", [9])
+    moved = sum(before(k) != after(k) for k in keys) / len(keys)
+    assert moved < 0.2
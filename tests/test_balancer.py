@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from collections import Counter
+
+from pidal.constant.db import DBNodeType
+from pidal.dservice.backend.balancer import BalancerFactory
+from pidal.meta.model import DBNode
+
+from tests.fake import FakeBackend, backend_manager
+
+REPLICAS = ["r0", "r1", "r2"]
+
+
+def setup(monkeypatch, algorithm, args=None):
+    backend = FakeBackend()
+    bm = backend_manager(monkeypatch, ["s0", "s1"] + REPLICAS, backend)
+    nodes = [DBNode(DBNodeType.SOURCE, "s0", "mysql://u:p@s0:3306/db"),
+             DBNode(DBNodeType.SOURCE, "s1", "mysql://u:p@s1:3306/db")]
+    nodes += [DBNode(DBNodeType.REPLICA, i, "mysql://u:p@{}:3306/db".format(
+        i), follow="s0") for i in REPLICAS]
+    bm.enable_replicas(nodes, algorithm, algorithm_args=args)
+    return backend, bm
+
+
+def reads(bm, n, node="s0"):
+    return [bm.read_node(node) for _ in range(n)]
+
+
+def test_round_robin(monkeypatch):
+    _, bm = setup(monkeypatch, "round_robin")
+    assert reads(bm, 6) == REPLICAS * 2
+    # 没有 replica 的 source 只在自己上执行
+    assert reads(bm, 2, "s1") == ["s1", "s1"]
+
+
+def test_weighted(monkeypatch):
+    _, bm = setup(monkeypatch, "weighted", [["r0", 3], ["r2", 0]])
+    r = reads(bm, 8)
+    assert Counter(r) == {"r0": 6, "r1": 2}
+    # 平滑的加权轮询，不会连续选择 r0 三次以上
+    assert r[:4] == ["r0", "r0", "r1", "r0"]
+
+
+def test_weighted_all_zero(monkeypatch):
+    _, bm = setup(monkeypatch, "weighted", [[i, 0] for i in REPLICAS])
+    assert Counter(reads(bm, 6)) == {i: 2 for i in REPLICAS}
+
+
+def test_least_outstanding(monkeypatch):
+    _, bm = setup(monkeypatch, "least_outstanding")
+    bm.outstanding.update(r0=3, r1=1, r2=2)
+    assert set(reads(bm, 10)) == {"r1"}
+    # 相同时从随机的位置开始，每个 replica 都会被选择
+    bm.outstanding.update(r0=0, r1=0, r2=0)
+    assert set(reads(bm, 100)) == set(REPLICAS)
+
+
+def test_least_outstanding_counts_running_queries(monkeypatch):
+    backend, bm = setup(monkeypatch, "least_outstanding")
+    backend.delay = 0.01
+
+    async def run():
+        return await asyncio.gather(*[
+            bm.query("s0", "SELECT 1", read=True) for _ in range(6)])
+
+    asyncio.run(run())
+    # 同时执行的查询平均分到每个 replica
+    assert Counter(i[0] for i in backend.log) == {i: 2 for i in REPLICAS}
+    assert bm.outstanding == {i: 0 for i in REPLICAS}
+
+
+def test_excluded_replicas(monkeypatch):
+    for algorithm, args in [("random", None), ("round_robin", None),
+                            ("least_outstanding", None),
+                            ("weighted", [["r0", 10]])]:
+        _, bm = setup(monkeypatch, algorithm, args)
+        # 延迟过大的 replica 不参与读
+        bm.excluded = {"r0"}
+        assert set(reads(bm, 30)) == {"r1", "r2"}, algorithm
+        # 全部被排除时在 source 上执行
+        bm.excluded = set(REPLICAS)
+        assert set(reads(bm, 10)) == {"s0"}, algorithm
+
+
+def test_reads_and_writes(monkeypatch):
+    backend, bm = setup(monkeypatch, "round_robin")
+
+    async def run():
+        for _ in range(3):
+            await bm.query("s0", "SELECT 1", read=True)
+        await bm.query("s0", "UPDATE t SET a = 1")
+
+    asyncio.run(run())
+    assert [i[0] for i in backend.log] == REPLICAS + ["s0"]
+
+
+def test_unknown_algorithm():
+    with pytest.raises(Exception, match="nope"):
+        BalancerFactory.new("nope")
+    with pytest.raises(Exception, match="r0"):
+        BalancerFactory.new("weighted", [["r0", -1]])
@@ -0,0 +1,55 @@
+import asyncio
+
+from pidal.dservice.sqlparse.paser import Parser
+from pidal.node.result import result
+
+from tests.fake import Backend, FakeBackend, backend_manager, double_sharding
+
+NODES = ["a0", "a1", "b0", "b1"]
+
+
+def setup(monkeypatch):
+    """ 第一个策略按 id、第二个策略按 user_id 分成两个分表 """
+    backend = FakeBackend()
+    bm = backend_manager(monkeypatch, NODES, backend)
+    table = double_sharding(
+            bm, ["id", "user_id"], "mod", [[2], [2]],
+            [{i: Backend("a{}".format(i), i) for i in range(2)},
+             {i: Backend("b{}".format(i), i, "u_") for i in range(2)}])
+    return backend, table
+
+
+def run(table, query):
+    return asyncio.run(table.execute_dml(Parser.parse(query)[0]))
+
+
+def by_node(backend):
+    return {node: sql for node, sql, _ in backend.log}
+
+
+def test_in_write_without_second_key_runs_on_every_backend(monkeypatch):
+    backend, table = setup(monkeypatch)
+    r = run(table, "DELETE FROM t WHERE id IN (1, 2, 3)")
+    assert isinstance(r, result.OK)
+    sqls = by_node(backend)
+    assert sorted(sqls) == NODES
+    assert "t_0" in sqls["a0"] and "(2)" in sqls["a0"]
+    assert "t_1" in sqls["a1"] and "(1, 3)" in sqls["a1"]
+    # user_id 不在语句中，第二个策略的每个分表执行全部的值
+    for i in range(2):
+        assert "u_{}".format(i) in sqls["b{}".format(i)]
+        assert "(1, 2, 3)" in sqls["b{}".format(i)]
+
+
+def test_in_write_with_second_key_routes_second_strategy(monkeypatch):
+    backend, table = setup(monkeypatch)
+    r = run(table, "UPDATE t SET a = 1 WHERE id IN (1, 2) AND user_id = 3")
+    assert isinstance(r, result.OK)
+    assert sorted(by_node(backend)) == ["a0", "a1", "b1"]
+
+
+def test_in_select_uses_first_strategy(monkeypatch):
+    backend, table = setup(monkeypatch)
+    r = run(table, "SELECT * FROM t WHERE id IN (1, 2, 3)")
+    assert isinstance(r, result.ResultSet)
+    assert sorted(by_node(backend)) == ["a0", "a1"]
@@ -0,0 +1,97 @@
+import asyncio
+
+from pidal.dservice.backend.balancer import BalancerFactory
+from pidal.dservice.backend.lag import LagMonitor
+from pidal.lib.metrics import Metrics
+from pidal.node.result import result
+
+from tests.fake import FakeBackend, backend_manager, default_handler, \
+        description
+
+UUID = "3e11fa47-71ca-11e1-9e33-c80aa9429562"
+REPLICAS = ["r0", "r1", "r2", "r3"]
+
+
+def setup(monkeypatch):
+    """ replica 的延迟由 lags 决定，值为异常时检查失败 """
+    bm = backend_manager(monkeypatch, ["s0"] + REPLICAS, FakeBackend())
+    bm.replicas = {"s0": list(REPLICAS)}
+    bm.balancer = BalancerFactory.new("round_robin")
+    bm.excluded = set(REPLICAS)
+    lags = {}
+
+    async def probe(node):
+        lag = lags[node]
+        if isinstance(lag, Exception):
+            raise lag
+        return lag
+
+    return bm, lags, LagMonitor.new(bm, 5, 1, probe)
+
+
+def gauges(*nodes):
+    metrics = Metrics.get_instance()
+    return [metrics.gauge("replica.lag." + i).value for i in nodes]
+
+
+def read_nodes(bm, n=8):
+    return {bm.read_node("s0") for _ in range(n)}
+
+
+def test_excludes_lagging_failed_and_stopped_replicas(monkeypatch):
+    bm, lags, monitor = setup(monkeypatch)
+    # 第一次检查前都不参与读
+    assert read_nodes(bm) == {"s0"}
+    lags.update(r0=0.5, r1=10, r2=Exception("gone"), r3=None)
+    asyncio.run(monitor.check())
+    assert bm.excluded == {"r1", "r2", "r3"}
+    assert read_nodes(bm) == {"r0"}
+    assert gauges(*REPLICAS) == [0.5, 10, -1, -1]
+    assert monitor.lags == {"r0": 0.5, "r1": 10, "r2": None, "r3": None}
+
+
+def test_readmits_recovered_replicas(monkeypatch):
+    bm, lags, monitor = setup(monkeypatch)
+    lags.update(r0=10, r1=10, r2=None, r3=Exception("gone"))
+    asyncio.run(monitor.check())
+    assert read_nodes(bm) == {"s0"}
+
+    lags.update(r0=0, r1=5, r2=1, r3=2)
+    asyncio.run(monitor.check())
+    assert bm.excluded == set()
+    assert read_nodes(bm) == set(REPLICAS)
+    assert gauges(*REPLICAS) == [0, 5, 1, 2]
+
+    lags["r1"] = 5.5
+    asyncio.run(monitor.check())
+    assert bm.excluded == {"r1"}
+    assert gauges("r1") == [5.5]
+
+
+def test_replica_status(monkeypatch):
+    def handler(node, sql):
+        if node == "r0" and sql == "SHOW REPLICA STATUS":
+            return result.ResultSet(
+                    2, [description("Seconds_Behind_Source"),
+                        description("Executed_Gtid_Set")],
+                    [("3", UUID + ":1-5")])
+        if node == "r1" and sql == "SHOW REPLICA STATUS":
+            # 8.0.22 之前的版本
+            return result.Error(1064, "syntax error")
+        if node == "r1" and sql == "SHOW SLAVE STATUS":
+            return result.ResultSet(
+                    1, [description("Seconds_Behind_Master")], [(None,)])
+        if node == "r2":
+            # 不是 replica
+            return result.ResultSet(0, [], [])
+        return default_handler(node, sql)
+
+    bm = backend_manager(monkeypatch, REPLICAS[:3], FakeBackend(handler))
+    bm.replicas = {"s0": REPLICAS[:3]}
+    monitor = LagMonitor.new(bm, 5, 1)
+    asyncio.run(monitor.check())
+    assert monitor.lags == {"r0": 3.0, "r1": None, "r2": None}
+    assert bm.excluded == {"r1", "r2"}
+    assert str(monitor.gtids["r0"]) == UUID + ":1-5"
+    assert gauges("r0", "r1", "r2") == [3.0, -1, -1]
+    assert "r1" in monitor._legacy
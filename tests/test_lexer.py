@@ -0,0 +1,49 @@
+import pytest
+
+from pidal.dservice.sqlparse.lexer import Lexer
+from pidal.dservice.sqlparse.paser import Parser
+
+
+QUERIES = [
+    "select id, name from a where id = {} and name = 'n{}'",
+    "update a set `name` = \"dd{}\", age = age + 1 where id = {}",
+    "insert into a (id, name) values ({}, 'x{}')",
+    "insert into a (id, name) values ({0}, 'x'), ({1}, \"y{0}\")",
+    "delete from a where id = {} and status = {}",
+    "SELECT * FROM a WHERE id = {} AND name = \"{}\" FOR UPDATE",
+    "select * from a where b = {} limit {}",
+    "select * from a limit {}, {} for update",
+    "select * from a where id = {} limit 10 offset {}",
+    "select distinct name from a where b = {} limit {}",
+]
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_lexer_same_as_sqlparse(query):
+    sql = query.format(1, 2)
+    a = Lexer.parse(sql)
+    b = Parser.parse(sql)[0]
+    assert a is not None and type(a) is type(b)
+    for attr in ("column", "raw_where", "new_value", "for_update", "rows",
+                 "row_texts", "limit", "distinct"):
+        assert getattr(a, attr, None) == getattr(b, attr, None), attr
+    assert a.table == str(b.table)
+    for i in (a, b):
+        i.add_pidal(100)
+        # 没有改写时 sqlparse 保留原文，`LIMIT n OFFSET o` 改写后一致
+        i.modify_table("a_1")
+    assert a.to_sql().upper() == b.to_sql().upper()
+
+
+def test_attrs_not_shared_between_instances():
+    parsed = [Lexer.parse("select * from a where b = 1 order by c"),
+              Parser.parse("select * from a where b = 1 order by c")[0],
+              Parser.parse("select * from a where b in (1, 2)")[0],
+              Parser.parse("commit")[0]]
+    for name in ("params", "in_lists", "ranges", "_in_tokens", "order_by",
+                 "select_items", "group_by"):
+        values = [getattr(i, name) for i in parsed if hasattr(i, name)]
+        assert len({id(i) for i in values}) == len(values), name
+        for i in parsed:
+            # 都是实例的属性，不会修改到类上的默认值
+            assert name not in type(i).__dict__, name
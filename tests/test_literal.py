@@ -0,0 +1,83 @@
+import pytest
+import sqlparse
+import sqlparse.tokens as ttypes
+
+from pidal.dservice.sqlparse.cache import PlanCache
+from pidal.dservice.sqlparse.lexer import Lexer
+from pidal.dservice.sqlparse.literal import decode
+from pidal.dservice.sqlparse.paser import Parser
+from pidal.dservice.sqlparse.plan import Plan
+from pidal.lib.algorithms.factory import Factory
+
+
+@pytest.mark.parametrize("literal,value", [
+    ("'O\\'Brien'", "O'Brien"),
+    ("'O''Brien'", "O'Brien"),
+    ('"O""Brien"', 'O"Brien'),
+    ("'a\"\"b'", 'a""b'),
+    ("'a\\\\b'", "a\\b"),
+    ("'\\0\\n\\t\\Z\\x'", "\0\n\t\x1ax"),
+    ("'50\\%\\_'", "50\\%\\_"),
+    ("0x4142", "AB"),
+    ("X'4142'", "AB"),
+    ("x'0'", "\0"),
+    ("12", "12"),
+    ("NULL", "NULL"),
+])
+def test_decode(literal, value):
+    assert decode(literal) == value
+
+
+@pytest.mark.parametrize("query,value", [
+    ("SELECT * FROM a WHERE name = {}", "O'Brien"),
+    ("DELETE FROM a WHERE name = {} AND id = 1", "O'Brien"),
+    ("UPDATE a SET name = {} WHERE name = {}", "O'Brien"),
+    ("INSERT INTO a (name, id) VALUES ({}, 1), ({}, 2)", "O'Brien"),
+    ("SELECT * FROM a WHERE name = {}", "AB"),
+    ("INSERT INTO a (name, id) VALUES ({}, 1), ({}, 2)", "AB"),
+])
+@pytest.mark.parametrize("form", [0, 1])
+def test_parsers_agree(query, value, form):
+    literals = {"O'Brien": ("'O\\'Brien'", "'O''Brien'"),
+                "AB": ("0x4142", "X'4142'")}[value]
+    sql = query.format(*literals[form:] + literals[:form])
+    a = Lexer.parse(sql)
+    b = Parser.parse(sql)[0]
+    assert a is not None
+    for attr in ("column", "new_value", "rows"):
+        assert getattr(a, attr, None) == getattr(b, attr, None), attr
+    assert b.column["name"] == value
+    if getattr(b, "rows", None):
+        assert [i["name"] for i in b.rows] == [value, value]
+
+
+def test_in_lists_route_same_as_bind():
+    route = Factory.bind("crc32", [8])
+    sql = Parser.parse(
+            "SELECT * FROM a WHERE name IN ('O\\'Brien', 'O''Brien', "
+            "X'4142', 0x4142)")[0]
+    values = [decode(i) for i in sql.in_lists[0][1]]
+    assert values == ["O'Brien", "O'Brien", "AB", "AB"]
+    bound = Plan.compile("SELECT * FROM a WHERE name = ?").bind(["O'Brien"])
+    assert bound.column["name"] == "O'Brien"
+    assert route(values[0]) == route(bound.column["name"])
+    assert sql.split_in(0, sql.in_lists[0][1][2:]).column["name"] == "AB"
+
+
+@pytest.mark.parametrize("literal", ["'O\\'Brien'", "'O''Brien'", "0x4142",
+                                     "X'4142'"])
+def test_cached_plan_decodes_literals(literal):
+    cache = PlanCache(16)
+    sqls = ["SELECT * FROM a WHERE name = {} AND id = {}".format(literal, i)
+            for i in range(3)]
+    parsed = [cache.parse(i)[0] for i in sqls]
+    assert cache.stats()["size"] == 1
+    assert parsed[-1].column == Parser.parse(sqls[-1])[0].column
+
+
+def test_default_sqlparse_lexer_unchanged():
+    # 十六进制只在 Parser 自己的 Lexer 中作为 Number
+    assert Parser.parse("select * from a where b = X'41'")[0].column == \
+        {"b": "A"}
+    tokens = list(sqlparse.parse("select X'41'")[0].flatten())
+    assert tokens[2].ttype is not ttypes.Number
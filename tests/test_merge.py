@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from pidal.dservice.table.merge import SortKey, distinct_rows, limit_rows, \
+        merge, merge_result_sets, unique_rows
+from pidal.node.result import result
+
+from tests.fake import description
+
+
+def key(*order_by):
+    return SortKey.new(list(order_by), [description("a"), description("b")])
+
+
+async def rows_of(rows, read=None):
+    for row in rows:
+        if read is not None:
+            read.append(row)
+        yield row
+
+
+def collect(rows):
+    async def run():
+        return [row async for row in rows]
+    return asyncio.run(run())
+
+
+def test_k_way_order():
+    streams = [[(1, 0), (4, 0), (7, 0)], [(2, 0), (5, 0)], [],
+               [(3, 0), (6, 0)]]
+    r = collect(merge([rows_of(i) for i in streams], key(("a", False))))
+    assert r == [(i, 0) for i in range(1, 8)]
+
+
+def test_equal_keys_keep_stream_order():
+    streams = [[(1, "x"), (2, "x")], [(1, "y"), (2, "y")]]
+    r = collect(merge([rows_of(i) for i in streams], key(("a", False))))
+    assert r == [(1, "x"), (1, "y"), (2, "x"), (2, "y")]
+
+
+def test_asc_desc():
+    # a 升序，a 相同时 b 降序
+    streams = [[(1, 3), (2, 2)], [(1, 5), (1, 1), (3, 0)]]
+    r = collect(merge([rows_of(i) for i in streams],
+                      key(("a", False), ("b", True))))
+    assert r == [(1, 5), (1, 3), (1, 1), (2, 2), (3, 0)]
+    # 按位置 desc
+    streams = [[(3, 0), (1, 0)], [(2, 0)]]
+    r = collect(merge([rows_of(i) for i in streams], key(("1", True))))
+    assert r == [(3, 0), (2, 0), (1, 0)]
+
+
+def test_nulls():
+    # 与 MySQL 一致，NULL 升序时在最前，降序时在最后
+    streams = [[(None, 0), (2, 0)], [(None, 1), (1, 1)]]
+    r = collect(merge([rows_of(i) for i in streams], key(("a", False))))
+    assert r == [(None, 0), (None, 1), (1, 1), (2, 0)]
+    streams = [[(2, 0), (None, 0)], [(1, 1), (None, 1)]]
+    r = collect(merge([rows_of(i) for i in streams], key(("a", True))))
+    assert r == [(2, 0), (1, 1), (None, 0), (None, 1)]
+
+
+def test_offset_limit():
+    read = []
+    streams = [rows_of([(i, 0) for i in range(0, 100, 2)], read),
+               rows_of([(i, 0) for i in range(1, 100, 2)], read)]
+    r = collect(limit_rows(merge(streams, key(("a", False))), 3, 4))
+    assert r == [(i, 0) for i in range(3, 7)]
+    # 取够之后不再读取，每个流最多多读一行
+    assert len(read) <= 3 + 4 + 2
+    assert collect(limit_rows(rows_of([(1, 0)]), 0, 0)) == []
+    assert collect(limit_rows(rows_of([(1, 0)]), 5, 1)) == []
+
+
+def test_order_by_column_must_be_selected():
+    with pytest.raises(Exception):
+        key(("c", False))
+
+
+def test_merge_result_sets():
+    rs = [result.ResultSet(2, [description("a"), description("b")], rows)
+          for rows in ([(1, 0), (3, 0)], [(2, 0)], [])]
+    r = merge_result_sets(rs, [("a", False)])
+    assert r.rows == [(1, 0), (2, 0), (3, 0)]
+
+
+def test_distinct():
+    rows = [(1, None), (2, 0), (1, None), (2, 1), (2, 0)]
+    assert collect(distinct_rows(rows_of(rows))) == \
+        [(1, None), (2, 0), (2, 1)]
+    assert unique_rows(rows) == [(1, None), (2, 0), (2, 1)]
+    # 按全部的列排序后重复的行相邻
+    rows = sorted(rows, key=key(("a", False), ("b", False)))
+    assert collect(distinct_rows(rows_of(rows), True)) == \
+        [(1, None), (2, 0), (2, 1)]
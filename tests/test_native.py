@@ -0,0 +1,405 @@
+import asyncio
+import datetime
+import hashlib
+import struct
+import time
+
+from decimal import Decimal
+from typing import Any
+
+import pytest
+
+import pidal.err as err
+import pidal.node.platform.mysql.native as native
+
+from pidal.node.platform.dsn import DSN
+from pidal.node.platform.mysql.native import NativeMySQL
+from pidal.node.result import result
+from pidal.protocol.mysql import Capability, Command, ServerStatus
+from pidal.protocol.mysql.auth import CACHING_SHA2_PASSWORD, \
+        NATIVE_PASSWORD
+from pidal.protocol.mysql.field_type import FieldType
+from pidal.protocol.mysql.packet import EOF, OK, Error, PacketBytesWriter, \
+        PrepareOK, ResultSetField, ResultWriter
+from tests.fake import ScriptedStream, description, packets
+
+SALT = bytes(range(1, 21))
+
+
+def field(name: str) -> bytes:
+    return ResultSetField.new_from_result(description(name)).encode()
+
+
+def column(name: str, type_code: int, charsetnr: int = 33) -> bytes:
+    return ResultSetField.new_from_result(result.ResultDescription(
+        None, None, None, None, name, name, charsetnr, 0, type_code, 0,
+        0)).encode()
+
+
+def eof(has_next: bool = False) -> bytes:
+    return EOF.new(0, 0, has_next).encode()
+
+
+def ok(affected_rows: int = 0, has_next: bool = False) -> bytes:
+    return OK.new_from_result(result.OK(
+        affected_rows, 0, ServerStatus.SERVER_STATUS_AUTOCOMMIT, 0, "",
+        has_next)).encode()
+
+
+def error(code: int, message: str) -> bytes:
+    return Error.new_from_result(result.Error(code, message)).encode()
+
+
+def row(*values: Any) -> bytes:
+    return b"".join(PacketBytesWriter.write_length_coded_string(i)
+                    for i in values)
+
+
+def result_set(*rows: bytes, has_next: bool = False, seq: int = 1) -> bytes:
+    """ 一列 `a` 的结果集，占用 seq 到 seq + 行数 + 3 的序号 """
+    return packets(b"\x01", field("a"), eof(), *rows, eof(has_next),
+                   seq=seq)
+
+
+def connected(stream: ScriptedStream) -> NativeMySQL:
+    """ 跳过握手，直接使用 stream 的连接 """
+    conn = NativeMySQL(DSN("mysql://u:p@127.0.0.1:3306/db"))
+    conn._stream = stream  # type: ignore
+    conn._last_use_time = time.time()
+    return conn
+
+
+def handshake(plugin: str, capability: int = NativeMySQL.client_flag) -> \
+        bytes:
+    """ Protocol::HandshakeV10 """
+    r = b"\x0a" + b"8.0.30\0" + struct.pack("<I", 42) + SALT[:8] + b"\0"
+    r += struct.pack("<HBHHB", capability & 0xffff, 45, 2,
+                     capability >> 16, 21) + bytes(10)
+    return r + SALT[8:] + b"\0" + plugin.encode() + b"\0"
+
+
+def handshake_response(payload: bytes):
+    """ 返回 (capability, user, auth_data, database, plugin) """
+    capability = struct.unpack_from("<I", payload)[0]
+    rest = payload[32:]
+    user, rest = rest.split(b"\0", 1)
+    n = rest[0]
+    auth_data, rest = rest[1:1 + n], rest[1 + n:]
+    database, plugin, _ = rest.split(b"\0")
+    return capability, user.decode(), auth_data, database.decode(), \
+        plugin.decode()
+
+
+def native_password(password: bytes, salt: bytes) -> bytes:
+    """ SHA1(password) XOR SHA1(salt + SHA1(SHA1(password))) """
+    stage1 = hashlib.sha1(password).digest()
+    stage2 = hashlib.sha1(salt + hashlib.sha1(stage1).digest()).digest()
+    return bytes(a ^ b for a, b in zip(stage1, stage2))
+
+
+def connect(monkeypatch, stream: ScriptedStream) -> NativeMySQL:
+    async def open_connection(host, port):
+        assert (host, port) == ("127.0.0.1", 3306)
+        return None, None
+
+    monkeypatch.setattr(asyncio, "open_connection", open_connection)
+    monkeypatch.setattr(native, "AsyncIOStream", lambda r, w: stream)
+    conn = NativeMySQL(DSN("mysql://u:p@127.0.0.1:3306/db"))
+    asyncio.run(conn.connect())
+    return conn
+
+
+def test_handshake_native_password(monkeypatch):
+    capability = NativeMySQL.client_flag & ~Capability.SESSION_TRACK
+    stream = ScriptedStream(
+            packets(handshake(NATIVE_PASSWORD, capability), seq=0) +
+            packets(ok(), seq=2) +
+            # set autocommit
+            packets(ok()))
+    conn = connect(monkeypatch, stream)
+    assert not conn.is_closed()
+    assert (conn.server_version, conn.connection_id) == ("8.0.30", 42)
+    flag, user, auth_data, database, plugin = handshake_response(
+            stream.written[0])
+    # 只使用 server 支持的 capability
+    assert flag & ~Capability.CONNECT_WITH_DB == capability
+    assert (user, database, plugin) == ("u", "db", NATIVE_PASSWORD)
+    assert auth_data == native_password(b"p", SALT)
+    assert stream.written[1] == bytes((Command.COM_QUERY,)) + \
+        b"set @@session.autocommit=0;"
+    assert stream.position == len(stream.data)
+    # 没有 SESSION_TRACK 时不读取 GTID
+    assert conn.take_gtids() is None
+
+
+def test_handshake_tracks_own_gtids(monkeypatch):
+    on = packets(b"\x01", field("gtid_mode"), eof(), row("ON"), eof())
+    stream = ScriptedStream(
+            packets(handshake(NATIVE_PASSWORD), seq=0) +
+            packets(ok(), seq=2) + packets(ok()) + on + packets(ok()))
+    conn = connect(monkeypatch, stream)
+    assert [i[1:] for i in stream.written[1:]] == [
+        b"set @@session.autocommit=0;",
+        b"SELECT @@GLOBAL.gtid_mode",
+        b"SET @@SESSION.session_track_gtids = OWN_GTID"]
+    assert conn.take_gtids() == ""
+
+
+def test_auth_switch(monkeypatch):
+    salt = bytes(range(100, 120))
+    stream = ScriptedStream(
+            packets(handshake(CACHING_SHA2_PASSWORD,
+                              NativeMySQL.client_flag &
+                              ~Capability.SESSION_TRACK), seq=0) +
+            packets(b"\xfe" + NATIVE_PASSWORD.encode() + b"\0" + salt +
+                    b"\0", seq=2) +
+            packets(ok(), seq=4) + packets(ok()))
+    connect(monkeypatch, stream)
+    # 切换后用新的 salt 计算
+    assert stream.written[1] == native_password(b"p", salt)
+
+
+def test_caching_sha2_fast_auth(monkeypatch):
+    capability = NativeMySQL.client_flag & ~Capability.SESSION_TRACK
+    stream = ScriptedStream(
+            packets(handshake(CACHING_SHA2_PASSWORD, capability), seq=0) +
+            packets(b"\x01\x03", ok(), seq=2) + packets(ok()))
+    connect(monkeypatch, stream)
+    _, _, auth_data, _, plugin = handshake_response(stream.written[0])
+    assert plugin == CACHING_SHA2_PASSWORD
+    # XOR(SHA256(password), SHA256(SHA256(SHA256(password)) + salt))
+    p1 = hashlib.sha256(b"p").digest()
+    p3 = hashlib.sha256(hashlib.sha256(p1).digest() + SALT).digest()
+    assert auth_data == bytes(a ^ b for a, b in zip(p1, p3))
+    assert len(stream.written) == 2
+
+
+def test_caching_sha2_full_auth(monkeypatch):
+    capability = NativeMySQL.client_flag & ~Capability.SESSION_TRACK
+    stream = ScriptedStream(
+            packets(handshake(CACHING_SHA2_PASSWORD, capability), seq=0) +
+            packets(b"\x01\x04", seq=2) +
+            packets(b"\x01-----PUBLIC KEY-----", seq=4) +
+            packets(ok(), seq=6) + packets(ok()))
+    keys = []
+
+    def encrypt(password, salt, public_key):
+        keys.append((password, salt, public_key))
+        return b"encrypted"
+
+    monkeypatch.setattr(native, "sha2_rsa_encrypt", encrypt)
+    connect(monkeypatch, stream)
+    # 请求公钥，然后发送加密后的密码
+    assert stream.written[1:3] == [b"\x02", b"encrypted"]
+    assert keys == [("p", SALT, b"-----PUBLIC KEY-----")]
+
+
+def test_auth_error(monkeypatch):
+    stream = ScriptedStream(
+            packets(handshake(NATIVE_PASSWORD), seq=0) +
+            packets(error(1045, "Access denied"), seq=2))
+    with pytest.raises(err.OperationalError) as e:
+        connect(monkeypatch, stream)
+    assert e.value.args == (1045, "Access denied")
+
+
+def test_column_decoding():
+    columns = [column("i", FieldType.LONGLONG),
+               column("s", FieldType.VAR_STRING),
+               column("d", FieldType.NEWDECIMAL),
+               column("t", FieldType.DATETIME),
+               column("b", FieldType.BLOB, 63),
+               column("f", FieldType.DOUBLE),
+               column("n", FieldType.LONG)]
+    stream = ScriptedStream(packets(
+        b"\x07", *columns, eof(),
+        row("-12", "中文", "3.10", "2021-02-08 10:01:02", b"\xff\x00", "1.5",
+            None),
+        eof()))
+    conn = connected(stream)
+    r = asyncio.run(conn.query("SELECT * FROM t"))
+    assert isinstance(r, result.ResultSet)
+    assert [i.name for i in r.descriptions] == list("isdtbfn")
+    assert r.rows == [(-12, "中文", Decimal("3.10"),
+                       datetime.datetime(2021, 2, 8, 10, 1, 2), b"\xff\x00",
+                       1.5, None)]
+
+
+def test_multi_results():
+    stream = ScriptedStream(
+            result_set(row("1"), has_next=True) +
+            packets(ok(2, has_next=True), seq=6) +
+            result_set(row("3"), seq=7))
+    conn = connected(stream)
+    r = asyncio.run(conn.query("SELECT 1; UPDATE t SET a = 1; SELECT 3"))
+    # 返回第一个结果，其余的结果都读完
+    assert isinstance(r, result.ResultSet) and r.rows == [("1",)]
+    assert stream.position == len(stream.data)
+
+
+def test_multi_results_error():
+    stream = ScriptedStream(
+            result_set(row("1"), has_next=True) +
+            packets(error(1146, "Table 'db.nope' doesn't exist"), seq=6))
+    conn = connected(stream)
+    r = asyncio.run(conn.query("SELECT 1; SELECT * FROM nope"))
+    assert isinstance(r, result.Error) and r.error_code == 1146
+    assert stream.position == len(stream.data)
+
+
+def test_stream_skips_remaining_results():
+    stream = ScriptedStream(
+            result_set(row("1"), row("2"), has_next=True) +
+            result_set(row("3"), seq=7))
+    conn = connected(stream)
+
+    async def run():
+        r = await conn.query_stream("SELECT 1 UNION SELECT 2; SELECT 3")
+        rows = [i async for i in r]
+        await r.close()
+        stream.feed(result_set(row("4"), seq=1))
+        # 下一个命令之前读掉剩下的结果
+        return rows, await conn.query("SELECT 4")
+
+    rows, r = asyncio.run(run())
+    assert rows == [("1",), ("2",)]
+    assert r.rows == [("4",)]
+    assert stream.position == len(stream.data)
+
+
+def test_wrong_sequence_closes_connection():
+    stream = ScriptedStream(packets(ok(), seq=3))
+    conn = connected(stream)
+    r = asyncio.run(conn.query("DO 1"))
+    assert isinstance(r, result.Error)
+    assert "sequence" in r.message
+    assert conn.is_closed()
+
+
+def test_prepare_reads_params_and_columns():
+    stream = ScriptedStream(packets(
+        PrepareOK(7, 1, 2).encode(),
+        PrepareOK.param_field().encode(), eof(),
+        field("id"), field("name"), eof()))
+    conn = connected(stream)
+    r = asyncio.run(conn.prepare("SELECT id, name FROM t WHERE id = ?"))
+    assert isinstance(r, result.Prepare)
+    assert (r.num_params, r.num_columns) == (1, 2)
+    assert [i.name for i in r.columns] == ["id", "name"]
+    assert r.params[0].name == "?"
+    # prepare 之后马上 close backend 上的 statement
+    assert stream.written == [
+        bytes((Command.COM_STMT_PREPARE,)) +
+        b"SELECT id, name FROM t WHERE id = ?",
+        bytes((Command.COM_STMT_CLOSE,)) + struct.pack("<I", 7)]
+    assert stream.position == len(stream.data)
+
+
+def test_prepare_error():
+    error = Error.new_from_result(result.Error(1054, "Unknown column 'nope'"))
+    stream = ScriptedStream(packets(error.encode()))
+    conn = connected(stream)
+    r = asyncio.run(conn.prepare("SELECT nope FROM t"))
+    assert isinstance(r, result.Error) and r.error_code == 1054
+    assert len(stream.written) == 1
+
+
+def test_raw_relay_renumbers_packets():
+    payloads = [b"\x01", field("a"), eof(), row("1"), row("2"), eof(True),
+                ok(1)]
+    for packet_number in (1, 3, 255):
+        stream = ScriptedStream(packets(*payloads))
+        conn = connected(stream)
+        client = ScriptedStream()
+
+        async def run():
+            r = await conn.query_raw("SELECT a FROM t; DO 1")
+            await ResultWriter.write([r], client, packet_number)
+            return r
+
+        r = asyncio.run(run())
+        # backend 的 packet 原样转发，序号从客户端请求的序号之后开始
+        assert client.written == payloads
+        assert client.sequences == [(packet_number + i) % 256
+                                    for i in range(7)]
+        assert r.closed and r.drained
+        assert stream.position == len(stream.data)
+
+
+def test_raw_relay_abandoned_is_drained():
+    rows = [row("x" * 1000) for _ in range(200)]
+    stream = ScriptedStream(result_set(*rows))
+    conn = connected(stream)
+    client = ScriptedStream(fail_after=0)
+
+    async def run():
+        r = await conn.query_raw("SELECT a FROM t")
+        with pytest.raises(ConnectionResetError):
+            await ResultWriter.write([r], client, 1)
+        assert r.closed and r.drained
+        # 剩下的 packet 已经读掉，连接可以继续使用
+        stream.feed(packets(ok()))
+        return await conn.query("DO 1")
+
+    assert isinstance(asyncio.run(run()), result.OK)
+    assert not conn.is_closed()
+    assert stream.position == len(stream.data)
+
+
+def test_raw_relay_backend_lost():
+    data = result_set(row("1"), row("2"))
+    stream = ScriptedStream(data[:-6])
+    conn = connected(stream)
+    client = ScriptedStream()
+
+    async def run():
+        r = await conn.query_raw("SELECT a FROM t")
+        await ResultWriter.write([r], client, 1)
+
+    asyncio.run(run())
+    # 已经转发的 packet 之后是 ERR，序号连续
+    assert client.sequences == [1, 2, 3, 4, 5, 6]
+    e = Error.decode(client.written[-1])
+    assert e.error_code == 1105 and "Lost connection" in e.message
+    assert conn.is_closed()
+
+
+def test_stream_abandoned_is_drained():
+    rows = [row(str(i)) for i in range(10)]
+    stream = ScriptedStream(result_set(*rows))
+    conn = connected(stream)
+
+    async def run():
+        r = await conn.query_stream("SELECT a FROM t")
+        async for _ in r:
+            break
+        await r.close()
+        stream.feed(packets(ok()))
+        return r, await conn.query("DO 1")
+
+    r, ok_ = asyncio.run(run())
+    assert r.drained and isinstance(ok_, result.OK)
+    assert stream.position == len(stream.data)
+
+
+def test_stream_error_midway():
+    stream = ScriptedStream(packets(
+        b"\x01", field("a"), eof(), row("1"),
+        error(1317, "Query execution was interrupted")))
+    conn = connected(stream)
+    client = ScriptedStream()
+
+    async def run():
+        r = await conn.query_stream("SELECT a FROM t")
+        await ResultWriter.write([r], client, 1)
+        assert r.drained
+        stream.feed(packets(ok()))
+        return await conn.query("DO 1")
+
+    # 客户端收到已经读到的行和 ERR，backend 的连接可以继续使用
+    assert isinstance(asyncio.run(run()), result.OK)
+    assert client.sequences == [1, 2, 3, 4, 5]
+    assert client.written[3] == row("1")
+    e = Error.decode(client.written[-1])
+    assert (e.error_code, e.message) == \
+        (1317, "Query execution was interrupted")
@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+from pidal.protocol.mysql.command import Command
+from pidal.protocol.mysql.packet import MAX_PACKET_LEN, OK, \
+        PacketBytesReader, PacketBytesWriter, PacketWriter, Stream, TextRow
+from pidal.protocol.mysql.server_status import ServerStatus
+
+
+class MemoryStream(Stream):
+
+    def __init__(self):
+        self.data = bytearray()
+        self.position = 0
+
+    async def read_bytes(self, num_bytes: int) -> bytes:
+        start = self.position
+        self.position += num_bytes
+        return bytes(self.data[start:self.position])
+
+    async def write(self, data: bytes):
+        self.data += data
+
+
+@pytest.mark.parametrize("size", [40 * 1024 * 1024, MAX_PACKET_LEN * 2,
+                                  MAX_PACKET_LEN, 100])
+def test_large_payload_split_and_reassembly(size):
+    payload = bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+    stream = MemoryStream()
+
+    async def run():
+        writer = PacketWriter(stream, 3)
+        writer.append(payload)
+        await writer.flush()
+        return writer, await PacketBytesReader.read_packet(stream)
+
+    writer, p_reader = asyncio.run(run())
+    # 刚好是 MAX_PACKET_LEN 的整数倍时后面还有一个空 packet
+    packets = size // MAX_PACKET_LEN + 1
+    assert writer.packet_number == 3 + packets
+    assert len(stream.data) == size + 4 * packets
+    assert p_reader.get_payload() == payload
+    assert p_reader.packet_count == packets
+    assert p_reader.get_header().packet_number == 3
+    assert stream.position == len(stream.data)
+
+
+def test_row_larger_than_max_packet():
+    stream = MemoryStream()
+    row = ("a" * (20 * 1024 * 1024), None, 1)
+
+    async def run():
+        writer = PacketWriter(stream)
+        writer.append_row(row)
+        writer.append(b"\xfe\x00\x00\x02\x00")
+        await writer.flush()
+        return (await PacketBytesReader.read_packet(stream),
+                await PacketBytesReader.read_packet(stream))
+
+    p_reader, eof = asyncio.run(run())
+    assert tuple(TextRow(p_reader.get_payload(), 3)) == (row[0], None, "1")
+    assert eof.is_eof_packet()
+
+
+def test_multi_packet_query():
+    stream = MemoryStream()
+    query = "insert into t values ('{}')".format("b" * 40 * 1024 * 1024)
+
+    async def run():
+        writer = PacketWriter(stream)
+        writer.append(bytes((Command.COM_QUERY,)) + query.encode())
+        await writer.flush()
+        return await PacketBytesReader.read_execute_packet(stream)
+
+    execute = asyncio.run(run())
+    assert execute.command is Command.COM_QUERY
+    assert execute.query == query
+    assert execute.packet_number == 2
+
+
+def lenenc(data: bytes) -> bytes:
+    return PacketBytesWriter.write_length_encoded_integer(len(data)) + data
+
+
+def ok_with_gtids(gtids: bytes, message: bytes = b"") -> bytes:
+    """ CLIENT_SESSION_TRACK 的 OK，session state 中有一个未知的类型和 GTID """
+    status = ServerStatus.SERVER_STATUS_AUTOCOMMIT | \
+        ServerStatus.SERVER_SESSION_STATE_CHANGED
+    state = b"\x00" + lenenc(lenenc(b"autocommit") + lenenc(b"ON"))
+    state += b"\x03" + lenenc(b"\x00" + lenenc(gtids))
+    return b"\x00\x01\x00" + PacketBytesWriter.write_struct(
+            "<HH", status, 0) + lenenc(message) + lenenc(state)
+
+
+def test_ok_session_track_gtids():
+    gtids = b"3e11fa47-71ca-11e1-9e33-c80aa9429562:23"
+    ok = OK.decode(ok_with_gtids(gtids, b"Rows matched: 1"), True)
+    assert ok.gtids == gtids.decode()
+    assert ok.affected_rows == 1
+    assert ok.message == "Rows matched: 1"
+    # 转发给客户端时去掉 session state
+    assert ok.server_status == ServerStatus.SERVER_STATUS_AUTOCOMMIT
+    assert OK.decode(ok.encode()).message == "Rows matched: 1"
+
+    ok = OK.decode(b"\x00\x00\x00\x02\x00\x00\x00", True)
+    assert ok.gtids is None and ok.message == ""
+
+
+def test_read_response_rewrites_ok():
+    packets = [ok_with_gtids(b"s0:1")]
+    seen = []
+
+    async def read():
+        return packets.pop(0)
+
+    def rewrite(payload):
+        ok = OK.decode(payload, True)
+        seen.append(ok.gtids)
+        return ok.encode()
+
+    async def run():
+        return [p async for p in PacketBytesReader.read_response(
+            read, rewrite)]
+
+    r = asyncio.run(run())
+    assert seen == ["s0:1"]
+    assert r == [b"\x00\x01\x00\x02\x00\x00\x00"]
@@ -0,0 +1,156 @@
+import asyncio
+import struct
+
+import pytest
+
+from pidal.dservice.dsession import DSession
+from pidal.dservice.sqlparse.cache import PlanCache
+from pidal.dservice.sqlparse.paser import Insert, Parser
+from pidal.dservice.sqlparse.plan import Plan
+from pidal.node.result import result
+from pidal.node.result.command import Command
+from pidal.protocol.mysql.field_type import FieldType
+from pidal.protocol.mysql.packet import PrepareOK, ResultSetField, \
+        StmtExecute
+
+from tests.fake import Backend, Database, FakeBackend, backend_manager, \
+        default_handler, sharding
+
+
+PREPARED = [
+    ("SELECT id, name FROM a WHERE id = ? AND name = ?", (3, "xy")),
+    ("UPDATE a SET `name` = ?, age = age + ? WHERE id = ?", ("dd", 1, 1)),
+    ("INSERT INTO a (id, name) VALUES (?, ?)", (1, None)),
+    ("INSERT INTO a (id, name) VALUES (?, 'a'), (?, ?)", (1, 2, "b")),
+    ("DELETE FROM a WHERE id = ? AND status = 0", (3,)),
+    ("SELECT * FROM a WHERE id IN (?, ?, 7) AND b = 1", (5, 6)),
+    ("SELECT * FROM a WHERE b = ? ORDER BY c LIMIT ?, ?", (1, 10, 5)),
+    ("SELECT c, COUNT(*), AVG(d) AS e FROM a WHERE b = ? GROUP BY c", (1,)),
+    ("SELECT * FROM a WHERE id >= ? AND id < ?", (10, 20)),
+]
+
+
+@pytest.mark.parametrize("query,params", PREPARED)
+def test_bind_same_as_parse(query, params):
+    plan = Plan.compile(query)
+    sql = plan.bind(params)
+    # 与直接解析绑定后 SQL 的结果一致
+    text = Parser.parse(sql.to_sql())[0]
+    assert sql.to_sql() == text.to_sql()
+    assert plan.same(sql, text)
+    for i in (sql, text):
+        i.add_pidal(100)
+        i.modify_table("a_22")
+    assert sql.to_sql() == text.to_sql()
+    if isinstance(sql, Insert):
+        assert sql.rows == text.rows
+
+
+def test_bind_checks_param_count():
+    plan = Plan.compile("SELECT * FROM a WHERE id = ?")
+    with pytest.raises(Exception):
+        plan.bind(())
+
+
+def test_bind_escapes_params():
+    plan = Plan.compile("SELECT * FROM a WHERE id = ? AND name = ?")
+    sql = plan.bind((1, "x' OR 1=1 -- "))
+    assert sql.to_sql() == \
+        "SELECT * FROM a WHERE id = 1 AND name = 'x\\' OR 1=1 -- '"
+    assert sql.column["name"] == "x' OR 1=1 -- "
+
+
+def test_stmt_execute_decode_and_bind():
+    plan = Plan.compile("SELECT * FROM a WHERE id = ? AND name = ?")
+    name = "n1".encode()
+    args = struct.pack("<IBI", 1, 0, 1) + b"\x00" + b"\x01" + \
+        struct.pack("<BBBB", FieldType.LONGLONG, 0, FieldType.VAR_STRING, 0) + \
+        struct.pack("<q", 42) + bytes((len(name),)) + name
+    execute = StmtExecute.decode(args, plan.num_params)
+    assert execute.statement_id == 1
+    assert execute.params == [42, "n1"]
+    sql = plan.bind(execute.params)
+    assert sql.column == {"id": "42", "name": "n1"}
+    # 之后的执行沿用第一次的参数类型
+    args = struct.pack("<IBI", 1, 0, 1) + b"\x02" + b"\x00" + \
+        struct.pack("<q", 7)
+    execute = StmtExecute.decode(args, plan.num_params, execute.types)
+    assert execute.params == [7, None]
+
+
+def test_prepare_select_on_backend(monkeypatch):
+    def handler(node, sql):
+        if "nope" in sql:
+            return result.Error(1054, "Unknown column 'nope'")
+        return default_handler(node, sql)
+
+    backend = FakeBackend(handler)
+    bm = backend_manager(monkeypatch, ["n0", "n1"], backend)
+    table = sharding(bm, "id", "mod", [2],
+                     {i: Backend("n{}".format(i), i) for i in range(2)})
+    session = DSession(Database(bm, table))
+
+    def command(command, args=b"", query=""):
+        return asyncio.run(session.execute(
+            result.Execute(0, command, args, query)))[0]
+
+    query = "SELECT * FROM t WHERE id = ?"
+    r = command(Command.COM_STMT_PREPARE, query=query)
+    assert isinstance(r, result.Prepare)
+    assert (r.num_params, r.num_columns) == (1, 1)
+    # 参数不能路由，在第一个分表上 prepare
+    assert backend.statements() == ["PREPARE SELECT * FROM t_0 WHERE id = ?"]
+    ok = PrepareOK.new_from_result(r)
+    packets = []
+    ok.write(packets)  # type: ignore
+    # PREPARE_OK、参数和 EOF、列和 EOF
+    assert len(packets) == 5
+    assert ResultSetField.decode(packets[3]).name == "node"
+
+    # 同样的 SQL 使用和 Plan 一起缓存的结果
+    again = command(Command.COM_STMT_PREPARE, query=query)
+    assert again.statement_id == r.statement_id + 1
+    assert again.num_columns == 1
+    assert len(backend.statements()) == 1
+
+    args = struct.pack("<IBI", r.statement_id, 0, 1) + b"\x00" + b"\x01" + \
+        struct.pack("<BB", FieldType.LONGLONG, 0) + struct.pack("<q", 3)
+    rs = command(Command.COM_STMT_EXECUTE, args)
+    assert isinstance(rs, result.ResultSet) and rs.rows == [("n1",)]
+    assert backend.statements()[-1] == "SELECT * FROM t_1 WHERE id = 3"
+
+    r = command(Command.COM_STMT_PREPARE,
+                query="SELECT nope FROM t WHERE id = ?")
+    assert isinstance(r, result.Error) and r.error_code == 1054
+    # 没有结果集的语句不需要在 backend 上 prepare
+    r = command(Command.COM_STMT_PREPARE,
+                query="UPDATE t SET name = ? WHERE id = ?")
+    assert isinstance(r, result.Prepare)
+    assert (r.num_params, r.num_columns) == (2, 0)
+    assert len(backend.statements()) == 3
+
+
+CACHED = [
+    "select id, name from a where id = {} and name = 'n{}'",
+    "update a set `name` = \"dd{}\", age = age + 1 where id = {}",
+    "insert into a (id, name) values ({}, 'x{}')",
+    "insert into a (id, name) values ({0}, 'x'), ({1}, \"y{0}\")",
+    "delete from a where id = {} and status = {}",
+    "SELECT * FROM a WHERE id = {} AND name = \"{}\" FOR UPDATE",
+]
+
+
+@pytest.mark.parametrize("query", CACHED)
+def test_plan_cache_same_as_parse(query):
+    cache = PlanCache(16)
+    for i in range(3):
+        sql = query.format(i, i * 7)
+        a = cache.parse(sql)[0]
+        b = Parser.parse(sql)[0]
+        # Lexer 不会把关键字转换成大写
+        assert a.to_sql().upper() == b.to_sql().upper()
+        for j in (a, b):
+            j.add_pidal(100)
+            j.modify_table("a_1")
+        assert a.to_sql().upper() == b.to_sql().upper()
+    assert cache.stats()["size"] == 1
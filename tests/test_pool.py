@@ -0,0 +1,211 @@
+import asyncio
+import time
+
+import pytest
+
+import pidal.node.pool as pool
+
+from pidal.lib.metrics import Metrics
+from pidal.node.pool import Pool
+
+from tests.fake import FakeBackend
+
+
+def new_pool(monkeypatch, minsize=0, maxsize=1, **kwargs):
+    backend = FakeBackend()
+    monkeypatch.setattr(pool, "get_connector", lambda *args: backend)
+    return Pool(minsize, maxsize, "mysql://u:p@p0:3306/db", name="p0",
+                **kwargs)
+
+
+def test_waiters_are_served_in_order(monkeypatch):
+    p = new_pool(monkeypatch)
+    order = []
+
+    async def use(i):
+        conn = await p.acquire()
+        order.append(i)
+        await asyncio.sleep(0)
+        p.release(conn)
+
+    async def run():
+        conn = await p.acquire()
+        tasks = []
+        for i in range(5):
+            tasks.append(asyncio.ensure_future(use(i)))
+            # 保证按顺序开始排队
+            await asyncio.sleep(0)
+        p.release(conn)
+        await asyncio.gather(*tasks)
+        return conn
+
+    conn = asyncio.run(run())
+    assert order == [0, 1, 2, 3, 4]
+    # 连接依次交给等待者，没有创建新的连接
+    assert p.size == 1 and p._free[0][0] is conn
+    assert Metrics.get_instance().gauge("pool.in_use.p0").value == 0
+
+
+def test_new_acquire_does_not_jump_the_queue(monkeypatch):
+    p = new_pool(monkeypatch)
+    order = []
+
+    async def use(name):
+        conn = await p.acquire()
+        order.append(name)
+        p.release(conn)
+
+    async def run():
+        conn = await p.acquire()
+        waiter = asyncio.ensure_future(use("waiter"))
+        await asyncio.sleep(0)
+        # release 直接把连接交给等待者，之后的 acquire 排在它后面
+        p.release(conn)
+        await use("late")
+        await waiter
+
+    asyncio.run(run())
+    assert order == ["waiter", "late"]
+
+
+def test_cancelled_waiter_returns_handed_connection(monkeypatch):
+    p = new_pool(monkeypatch)
+
+    async def run():
+        conn = await p.acquire()
+        task = asyncio.ensure_future(p.acquire())
+        await asyncio.sleep(0)
+        # 连接已经交给等待者，等待者在拿到之前被取消
+        p.release(conn)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return conn, await p.acquire()
+
+    conn, again = asyncio.run(run())
+    assert again is conn
+    assert p.size == 1 and not p._waiters
+
+
+def test_cancelled_waiter_leaves_the_queue(monkeypatch):
+    p = new_pool(monkeypatch)
+
+    async def run():
+        conn = await p.acquire()
+        first = asyncio.ensure_future(p.acquire())
+        second = asyncio.ensure_future(p.acquire())
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        p.release(conn)
+        return conn, await second
+
+    conn, got = asyncio.run(run())
+    assert got is conn
+    assert p.size == 1 and not p._free
+
+
+def test_cancelled_waiter_passes_on_wakeup(monkeypatch):
+    p = new_pool(monkeypatch)
+
+    async def run():
+        conn = await p.acquire()
+        first = asyncio.ensure_future(p.acquire())
+        second = asyncio.ensure_future(p.acquire())
+        await asyncio.sleep(0)
+        # 断开的连接归还后，最早的等待者被唤醒去创建连接，但是被取消了
+        conn.close()
+        p.release(conn)
+        first.cancel()
+        return conn, await second
+
+    conn, got = asyncio.run(run())
+    assert got is not conn and not got.is_closed()
+    assert p.size == 1
+
+
+def test_timeout_does_not_leak(monkeypatch):
+    p = new_pool(monkeypatch, timeout=0.01)
+
+    async def run():
+        conn = await p.acquire()
+        with pytest.raises(asyncio.TimeoutError):
+            await p.acquire()
+        p.release(conn)
+        return await p.acquire()
+
+    asyncio.run(run())
+    assert p.size == 1 and not p._waiters
+
+
+def test_maxsize(monkeypatch):
+    p = new_pool(monkeypatch, maxsize=3)
+    in_use = Metrics.get_instance().gauge("pool.in_use.p0")
+    conns = set()
+    busy = []
+
+    async def use():
+        conn = await p.acquire()
+        conns.add(conn)
+        busy.append(in_use.value)
+        assert p.size <= 3
+        await asyncio.sleep(0.001)
+        p.release(conn)
+
+    async def run():
+        await asyncio.gather(*[use() for _ in range(20)])
+
+    asyncio.run(run())
+    assert len(conns) == 3
+    assert max(busy) == 3
+    assert p.size == 3 and in_use.value == 0
+
+
+def test_maintain_evicts_idle_connections(monkeypatch):
+    p = new_pool(monkeypatch, minsize=1, maxsize=5, idle_timeout=60)
+
+    async def run():
+        conns = [await p.acquire() for _ in range(3)]
+        for i in conns:
+            p.release(i)
+        return conns
+
+    conns = asyncio.run(run())
+    assert p.size == 3
+    now = time.monotonic()
+    monkeypatch.setattr(pool.time, "monotonic", lambda: now + 30)
+    p.maintain()
+    assert p.size == 3
+    monkeypatch.setattr(pool.time, "monotonic", lambda: now + 120)
+    p.maintain()
+    # 空闲最久的先关闭，保留 minsize 个
+    assert p.size == 1
+    assert [i.is_closed() for i in conns] == [True, True, False]
+    assert p._free[0][0] is conns[2]
+
+
+def test_maintain_keeps_used_connections_and_recycles(monkeypatch):
+    p = new_pool(monkeypatch, minsize=0, maxsize=5, recycle=10,
+                 idle_timeout=0)
+
+    async def run():
+        conns = [await p.acquire() for _ in range(3)]
+        p.release(conns[0])
+        p.release(conns[1])
+        return conns
+
+    conns = asyncio.run(run())
+    conns[1].close()
+    now = time.monotonic()
+    monkeypatch.setattr(pool.time, "monotonic", lambda: now + 20)
+    p.maintain()
+    # 断开的连接丢弃，空闲超过 recycle 的关闭，使用中的不受影响
+    assert not p._free
+    assert conns[0].is_closed() and not conns[2].is_closed()
+    assert p.size == 1
+
+
+def test_fill_free(monkeypatch):
+    p = new_pool(monkeypatch, minsize=2, maxsize=5)
+    asyncio.run(p.fill_free())
+    assert p.size == 2 and len(p._free) == 2
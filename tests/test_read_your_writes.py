@@ -0,0 +1,145 @@
+import asyncio
+
+from pidal.dservice.backend.balancer import BalancerFactory
+from pidal.dservice.backend.gtid import GtidSet
+from pidal.dservice.backend.lag import LagMonitor
+from pidal.dservice.dsession import DSession
+from pidal.lib.metrics import Metrics
+from pidal.node.result import result
+from pidal.node.result.command import Command
+
+from tests.fake import Backend, Database, FakeBackend, backend_manager, \
+        default_handler, description, sharding
+
+UUID = "3e11fa47-71ca-11e1-9e33-c80aa9429562"
+
+
+def setup(monkeypatch, monitor=True):
+    source = {"gtids": UUID + ":1-5"}
+
+    def handler(node, sql):
+        if "gtid_executed" in sql:
+            return result.ResultSet(1, [description("gtid")],
+                                    [(source["gtids"],)])
+        return default_handler(node, sql)
+
+    backend = FakeBackend(handler)
+    bm = backend_manager(monkeypatch, ["s0", "r0"], backend)
+    bm.replicas = {"s0": ["r0"]}
+    bm.balancer = BalancerFactory.new("round_robin")
+    if monitor:
+        bm.lag_monitor = LagMonitor.new(bm, 5, 1)
+        bm.lag_monitor.gtids["r0"] = GtidSet.parse(UUID + ":1-5")
+    table = sharding(bm, "id", "mod", [2],
+                     {i: Backend("s0", i) for i in range(2)})
+    return backend, bm, source, DSession(Database(bm, table))
+
+
+def run(session, *queries):
+    async def _run():
+        rs = []
+        for q in queries:
+            execute = result.Execute(len(q), Command.COM_QUERY, b"", q)
+            rs.extend(await session.execute(execute))
+        return rs
+    return asyncio.run(_run())
+
+
+def read_node(session):
+    return run(session, "SELECT * FROM t WHERE id = 1")[0].rows[0][0]
+
+
+def test_autocommit_write_is_fenced(monkeypatch):
+    backend, bm, source, session = setup(monkeypatch)
+    fenced = Metrics.get_instance().counter("replica.fenced_reads")
+    assert read_node(session) == "r0"
+
+    source["gtids"] = UUID + ":1-6"
+    r = run(session, "INSERT INTO t (id, a) VALUES (1, 1)")[0]
+    assert isinstance(r, result.OK)
+    assert "SELECT @@GLOBAL.gtid_executed" in backend.statements("s0")
+    before = fenced.value
+    # replica 还没有执行 6
+    assert read_node(session) == "s0"
+    assert fenced.value == before + 1
+    bm.lag_monitor.gtids["r0"] = GtidSet.parse(UUID + ":1-6")
+    assert read_node(session) == "r0"
+
+
+def test_commit_is_fenced(monkeypatch):
+    backend, bm, source, session = setup(monkeypatch)
+    source["gtids"] = UUID + ":1-7"
+    run(session, "START TRANSACTION", "UPDATE t SET a = 2 WHERE id = 1",
+        "COMMIT")
+    assert read_node(session) == "s0"
+    bm.lag_monitor.gtids["r0"] = GtidSet.parse(UUID + ":1-7")
+    assert read_node(session) == "r0"
+
+
+def test_read_only_transaction_is_not_fenced(monkeypatch):
+    backend, bm, source, session = setup(monkeypatch)
+    run(session, "START TRANSACTION", "SELECT * FROM t WHERE id = 1",
+        "COMMIT")
+    assert "SELECT @@GLOBAL.gtid_executed" not in backend.statements()
+    assert read_node(session) == "r0"
+
+
+def test_other_sessions_are_not_fenced(monkeypatch):
+    backend, bm, source, session = setup(monkeypatch)
+    other = DSession(session.db)
+    source["gtids"] = UUID + ":1-6"
+    run(session, "INSERT INTO t (id, a) VALUES (1, 1)")
+    assert read_node(session) == "s0"
+    assert read_node(other) == "r0"
+
+
+def test_without_lag_monitor_reads_source_after_write(monkeypatch):
+    backend, bm, source, session = setup(monkeypatch, monitor=False)
+    other = DSession(session.db)
+    assert read_node(session) == "r0"
+    run(session, "INSERT INTO t (id, a) VALUES (1, 1)")
+    # 不知道 replica 的进度，之后的读都在 source 上执行
+    assert "SELECT @@GLOBAL.gtid_executed" not in backend.statements()
+    assert read_node(session) == "s0"
+    assert read_node(session) == "s0"
+    assert read_node(other) == "r0"
+
+
+def test_own_gtid_from_ok(monkeypatch):
+    backend, bm, source, session = setup(monkeypatch)
+    backend.gtids = {"s0": 5}
+    bm.lag_monitor.gtids["r0"] = GtidSet.parse("s0:1-5")
+    run(session, "INSERT INTO t (id, a) VALUES (1, 1)")
+    # GTID 来自写入的 OK，不需要再查询 gtid_executed
+    assert "SELECT @@GLOBAL.gtid_executed" not in backend.statements()
+    assert str(session._fences["s0"].gtids) == "s0:6"
+    assert read_node(session) == "s0"
+    bm.lag_monitor.gtids["r0"] = GtidSet.parse("s0:1-6")
+    assert read_node(session) == "r0"
+
+
+def test_commit_uses_own_gtid(monkeypatch):
+    backend, bm, source, session = setup(monkeypatch)
+    backend.gtids = {"s0": 7}
+    run(session, "START TRANSACTION", "UPDATE t SET a = 2 WHERE id = 1",
+        "COMMIT")
+    assert "SELECT @@GLOBAL.gtid_executed" not in backend.statements()
+    assert str(session._fences["s0"].gtids) == "s0:8"
+    assert read_node(session) == "s0"
+    bm.lag_monitor.gtids["r0"] = GtidSet.parse("s0:1-8")
+    assert read_node(session) == "r0"
+
+
+def test_no_fence_without_new_gtid(monkeypatch):
+    backend, bm, source, session = setup(monkeypatch)
+    backend.gtids = {"s0": 7}
+
+    def handler(node, sql):
+        return result.Error(1062, "Duplicate entry")
+
+    backend.handler = handler
+    run(session, "INSERT INTO t (id, a) VALUES (1, 1)")
+    backend.handler = default_handler
+    # 写入失败，没有提交新的事务
+    assert session._fences == {}
+    assert read_node(session) == "r0"
@@ -0,0 +1,214 @@
+import asyncio
+
+from pidal.constant.db import ResultMode
+from pidal.dservice.sqlparse import lexer
+from pidal.dservice.sqlparse.paser import Parser
+from pidal.dservice.table.scatter import Scatter
+from pidal.lib.metrics import Metrics
+from pidal.node.result import result
+
+from tests.fake import Backend, FakeBackend, backend_manager, description, \
+        sharding
+
+NODES = ["n0", "n1", "n2", "n3"]
+
+
+def setup(monkeypatch, delay=0.0, concurrency=2):
+    backend = FakeBackend(delay=delay)
+    bm = backend_manager(monkeypatch, NODES, backend)
+    table = sharding(bm, "id", "mod", [4],
+                     {i: Backend("n{}".format(i), i) for i in range(4)})
+    table.scatter_concurrency = concurrency
+    return backend, table
+
+
+def test_limit_skips_queued_shards_and_limits_connections(monkeypatch):
+    backend, table = setup(monkeypatch, delay=0.05, concurrency=1)
+    metrics = Metrics.get_instance()
+    queries = metrics.counter("scatter.queries")
+    skipped = metrics.counter("scatter.skipped")
+    in_use = [metrics.gauge("pool.in_use." + i) for i in NODES]
+    before = (queries.value, skipped.value)
+
+    async def run():
+        task = asyncio.ensure_future(table.execute_dml(
+            Parser.parse("SELECT * FROM t LIMIT 1")[0]))
+        await asyncio.sleep(0.01)
+        # 同时执行的分表不超过 scatter_concurrency
+        busy = [i.value for i in in_use]
+        r = await task
+        # 等待排队的分表看到 stop
+        await asyncio.sleep(0.1)
+        return busy, r
+
+    busy, r = asyncio.run(run())
+    assert busy == [1, 0, 0, 0]
+    assert isinstance(r, result.ResultSet) and len(r.rows) == 1
+    # 第一个分表归还 semaphore 时第二个分表已经开始，之后的分表不再查询
+    assert queries.value - before[0] == 2
+    assert skipped.value - before[1] == 2
+    assert [i.value for i in in_use] == [0, 0, 0, 0]
+    assert sorted(i[0] for i in backend.log) == ["n0", "n1"]
+
+
+def test_scatter_counts_every_shard(monkeypatch):
+    backend, table = setup(monkeypatch)
+    queries = Metrics.get_instance().counter("scatter.queries")
+    before = queries.value
+    r = asyncio.run(table.execute_dml(Parser.parse("SELECT * FROM t")[0]))
+    assert sorted(r.rows) == [(i,) for i in NODES]
+    assert queries.value - before == 4
+
+
+def test_limit_without_shards(monkeypatch):
+    setup(monkeypatch)
+
+    async def run():
+        scatter = Scatter.new([], 2)
+        return await scatter.execute(limit=(0, 10))
+
+    r = asyncio.run(run())
+    assert isinstance(r, result.ResultSet) and r.rows == []
+
+
+def test_batch_limits_concurrency(monkeypatch):
+    backend, table = setup(monkeypatch, delay=0.05, concurrency=1)
+    in_use = [Metrics.get_instance().gauge("pool.in_use." + i) for i in NODES]
+
+    async def run():
+        task = asyncio.ensure_future(table.execute_dml(
+            Parser.parse("DELETE FROM t WHERE id IN (0, 1, 2, 3)")[0]))
+        await asyncio.sleep(0.01)
+        busy = sum(i.value for i in in_use)
+        return busy, await task
+
+    busy, r = asyncio.run(run())
+    # 事务外每个分表一组，同时执行的仍然不超过 scatter_concurrency
+    assert busy == 1
+    assert isinstance(r, result.OK) and r.affected_rows == 4
+    assert sorted(i[0] for i in backend.log) == NODES
+
+
+def test_distinct_removes_duplicates_across_shards(monkeypatch):
+    def handler(node, sql):
+        # 每个分表都有 a = 1，n1 和 n2 还有 a = 2
+        rows = [(1,), (2,)] if node in ("n1", "n2") else [(1,)]
+        if "DESC" in sql:
+            rows.reverse()
+        return result.ResultSet(1, [description("a")], rows)
+
+    for query, mode, rows in [
+            ("SELECT DISTINCT a FROM t", ResultMode.BUFFERED, [(1,), (2,)]),
+            ("SELECT DISTINCT a FROM t", ResultMode.STREAM, [(1,), (2,)]),
+            ("SELECT DISTINCT a FROM t ORDER BY a DESC", ResultMode.STREAM,
+             [(2,), (1,)]),
+            ("SELECT DISTINCT a FROM t ORDER BY a LIMIT 1, 5",
+             ResultMode.BUFFERED, [(2,)]),
+            ("SELECT DISTINCT a FROM t LIMIT 2", ResultMode.BUFFERED,
+             [(1,), (2,)]),
+            ("SELECT DISTINCT a FROM t WHERE id IN (0, 1, 2, 3)",
+             ResultMode.BUFFERED, [(1,), (2,)])]:
+        bm = backend_manager(monkeypatch, NODES, FakeBackend(handler))
+        table = sharding(bm, "id", "mod", [4],
+                         {i: Backend("n{}".format(i), i) for i in range(4)})
+
+        async def run():
+            r = await table.execute_dml(Parser.parse(query)[0], mode=mode)
+            if isinstance(r, result.StreamResultSet):
+                r = [row async for row in r]
+            else:
+                r = r.rows
+            return r if "ORDER BY" in query else sorted(r)
+
+        assert asyncio.run(run()) == rows, query
+
+
+def test_ordered_scatter_limits_connections(monkeypatch):
+    def handler(node, sql):
+        # 每个分表的 a 为 n, n + 4, n + 8
+        n = NODES.index(node)
+        return result.ResultSet(1, [description("a")],
+                                [(n + i,) for i in range(0, 12, 4)])
+
+    for mode in (ResultMode.BUFFERED, ResultMode.STREAM):
+        backend = FakeBackend(handler, delay=0.01)
+        bm = backend_manager(monkeypatch, NODES, backend)
+        table = sharding(bm, "id", "mod", [4],
+                         {i: Backend("n{}".format(i), i) for i in range(4)})
+        table.scatter_concurrency = 2
+        in_use = [Metrics.get_instance().gauge("pool.in_use." + i)
+                  for i in NODES]
+        busy = []
+
+        async def watch():
+            while True:
+                busy.append(sum(i.value for i in in_use))
+                await asyncio.sleep(0.001)
+
+        async def run():
+            task = asyncio.ensure_future(watch())
+            r = await table.execute_dml(
+                    Parser.parse("SELECT a FROM t ORDER BY a")[0], mode=mode)
+            if isinstance(r, result.StreamResultSet):
+                rows = [row async for row in r]
+                await r.close()
+            else:
+                rows = r.rows
+            task.cancel()
+            return rows
+
+        assert asyncio.run(run()) == [(i,) for i in range(12)]
+        # 一个流一直占用连接，其余的分表依次使用另一个连接
+        assert max(busy) <= 2
+        assert [i.value for i in in_use] == [0, 0, 0, 0]
+
+
+def ordered_handler(node, sql):
+    """ 每个分表有 10 行，a 为 n, n + 4, ...，不处理 limit """
+    n = NODES.index(node)
+    return result.ResultSet(1, [description("a")],
+                            [(n + i,) for i in range(0, 40, 4)])
+
+
+def test_limit_pushed_down_without_offset(monkeypatch):
+    for query, shard in [
+            ("SELECT * FROM t LIMIT 2, 3", "SELECT * FROM t_{} LIMIT 5"),
+            ("SELECT * FROM t LIMIT 3 OFFSET 2",
+             "SELECT * FROM t_{} LIMIT 5"),
+            ("select * from t limit 3 offset 2",
+             "select * from t_{} LIMIT 5"),
+            ("SELECT a FROM t ORDER BY a LIMIT 2, 3",
+             "SELECT a FROM t_{} ORDER BY a LIMIT 5")]:
+        backend = FakeBackend(ordered_handler)
+        bm = backend_manager(monkeypatch, NODES, backend)
+        table = sharding(bm, "id", "mod", [4],
+                         {i: Backend("n{}".format(i), i) for i in range(4)})
+        sql = lexer.parse(query)[0]
+        r = asyncio.run(table.execute_dml(sql))
+        assert isinstance(r, result.ResultSet)
+        # 每个分表取 offset + count 行，offset 在合并后再跳过
+        assert sorted(backend.statements()) == \
+            [shard.format(i) for i in range(4)], query
+
+
+def test_limit_reads_at_most_offset_plus_count_per_shard(monkeypatch):
+    for mode in (ResultMode.BUFFERED, ResultMode.STREAM):
+        backend = FakeBackend(ordered_handler)
+        bm = backend_manager(monkeypatch, NODES, backend)
+        table = sharding(bm, "id", "mod", [4],
+                         {i: Backend("n{}".format(i), i) for i in range(4)})
+
+        async def run():
+            r = await table.execute_dml(
+                    Parser.parse("SELECT a FROM t ORDER BY a LIMIT 2, 3")[0],
+                    mode=mode)
+            if isinstance(r, result.StreamResultSet):
+                rows = [row async for row in r]
+                await r.close()
+                return rows
+            return r.rows
+
+        assert asyncio.run(run()) == [(2,), (3,), (4,)]
+        # 分表返回的行比 limit 多时也只读取 offset + count 行
+        assert sorted(backend.fetched) == NODES
+        assert max(backend.fetched.values()) <= 5
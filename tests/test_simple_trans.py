@@ -0,0 +1,101 @@
+import asyncio
+
+from pidal.dservice.sqlparse.paser import Parser
+from pidal.dservice.transaction.simple import Simple
+from pidal.node.result import result
+
+from tests.fake import Backend, FakeBackend, backend_manager, sharding
+
+NODES = ["n0", "n1", "n2", "n3"]
+
+
+class Database(object):
+
+    def __init__(self, table):
+        self.table = table
+
+    def get_table(self, name):
+        return self.table
+
+
+def setup(monkeypatch):
+    backend = FakeBackend()
+    bm = backend_manager(monkeypatch, NODES, backend)
+    table = sharding(bm, "id", "mod", [4],
+                     {i: Backend("n{}".format(i), i) for i in range(4)})
+    return backend, bm, Simple.new(Database(table))
+
+
+async def execute(trans, *queries):
+    await trans.begin(Parser.parse("START TRANSACTION")[0])
+    rs = []
+    for q in queries:
+        rs.append(await trans.execute_dml(Parser.parse(q)[0]))
+    return rs
+
+
+def statements(backend, prefix):
+    return [i for i in backend.log if i[1].upper().startswith(prefix)]
+
+
+def test_multi_row_insert_begins_every_node(monkeypatch):
+    backend, bm, trans = setup(monkeypatch)
+
+    async def run():
+        rs = await execute(
+                trans, "INSERT INTO t (id, a) VALUES (1, 1), (2, 2), (3, 3)")
+        await trans.commit(Parser.parse("COMMIT")[0])
+        return rs
+
+    rs = asyncio.run(run())
+    assert isinstance(rs[0], result.OK) and rs[0].affected_rows == 3
+    inserts = statements(backend, "INSERT")
+    assert sorted(i[0] for i in inserts) == ["n1", "n2", "n3"]
+    # 每个分表的写入都在 BEGIN 之后，提交时包括全部的 node
+    assert all(i[2] for i in inserts)
+    commits = [i for i in backend.log if i[1] == "COMMIT"]
+    assert sorted(i[0] for i in commits) == ["n1", "n2", "n3"]
+    assert all(i[2] for i in commits)
+    assert not bm.trans and not bm.lazy_begin
+
+
+def test_rollback_every_used_node(monkeypatch):
+    backend, bm, trans = setup(monkeypatch)
+
+    async def run():
+        await execute(trans, "INSERT INTO t (id, a) VALUES (0, 1), (2, 2)",
+                      "UPDATE t SET a = 1 WHERE id IN (1, 5)")
+        await trans.rollback(Parser.parse("ROLLBACK")[0])
+
+    asyncio.run(run())
+    rollbacks = [i for i in backend.log if i[1] == "ROLLBACK"]
+    assert sorted(i[0] for i in rollbacks) == ["n0", "n1", "n2"]
+    assert all(i[2] for i in rollbacks)
+
+
+def test_in_and_scatter_select_in_transaction(monkeypatch):
+    backend, bm, trans = setup(monkeypatch)
+
+    async def run():
+        rs = await execute(trans, "SELECT * FROM t WHERE id IN (1, 2)",
+                           "SELECT * FROM t WHERE a = 1")
+        await trans.commit(Parser.parse("COMMIT")[0])
+        return rs
+
+    rs = asyncio.run(run())
+    assert sorted(rs[0].rows) == [("n1",), ("n2",)]
+    assert sorted(rs[1].rows) == [(i,) for i in NODES]
+    assert all(i[2] for i in statements(backend, "SELECT"))
+
+
+def test_explicit_nodes_begin_once(monkeypatch):
+    backend, bm, trans = setup(monkeypatch)
+    trans.nodes = {"n1"}
+
+    async def run():
+        await execute(trans, "UPDATE t SET a = 1 WHERE id = 1")
+        await trans.commit(Parser.parse("COMMIT")[0])
+
+    asyncio.run(run())
+    assert [i[1] for i in backend.log if i[0] == "n1"][0] == "BEGIN"
+    assert len([i for i in backend.log if i[1] == "BEGIN"]) == 1
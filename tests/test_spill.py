@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+
+from decimal import Decimal
+
+import pytest
+
+import pidal.dservice.table.spill as spill
+
+from pidal.constant.db import ResultMode
+from pidal.dservice.sqlparse.paser import Parser
+from pidal.dservice.table.merge import SortKey, iter_rows, merge
+from pidal.dservice.table.spill import Spill, decode, encode
+from pidal.lib.metrics import Metrics
+from pidal.node.result import result
+
+from tests.fake import Backend, FakeBackend, backend_manager, description, \
+        sharding
+
+ROW = (None, 0, -2 ** 63, 2 ** 64 - 1, -2 ** 70, 1.5, "中文\udcff", b"\x00\xff",
+       Decimal("-12.340"), datetime.datetime(2020, 2, 29, 23, 59, 59, 12),
+       datetime.datetime(2020, 1, 1), datetime.date(1999, 12, 31),
+       datetime.time(1, 2, 3, 4), datetime.timedelta(-1, 5, 6),
+       datetime.timedelta(hours=838, minutes=59, seconds=59))
+
+
+def test_encode_decode():
+    out = bytearray()
+    encode(ROW, out)
+    encode((), out)
+    encode(("x",), out)
+    row, pos = decode(out, 0)
+    assert row == ROW
+    assert [type(i) for i in row] == [type(i) for i in ROW]
+    row, pos = decode(out, pos)
+    assert row == ()
+    row, pos = decode(memoryview(out), pos)
+    assert row == ("x",) and pos == len(out)
+
+
+@pytest.mark.parametrize("value", [True, [1], {"a": 1}, object()])
+def test_encode_unknown_type(value):
+    with pytest.raises(Exception):
+        encode((value,), bytearray())
+
+
+def stream(rows):
+    async def _rows():
+        for row in rows:
+            yield row
+    return result.StreamResultSet(2, [description("a"), description("b")],
+                                  _rows())
+
+
+def test_merge_spilled_runs(monkeypatch):
+    # 每个 chunk 只有几行，run 由多个 chunk 组成
+    monkeypatch.setattr(spill, "CHUNK_SIZE", 64)
+    runs = Metrics.get_instance().counter("spill.runs")
+    before = runs.value
+    shards = [[(i, "s{}".format(i)) for i in range(n, 300, 3)]
+              for n in range(3)]
+
+    async def run():
+        s = Spill.new(2500)
+        try:
+            results = [await s.read(stream(i)) for i in shards]
+            types = [type(i) for i in results]
+            key = SortKey.new([("a", False)], results[0].descriptions)
+            rows = [row async for row in merge(
+                [iter_rows(i) for i in results], key)]
+            return types, rows, s._file is not None
+        finally:
+            s.close()
+
+    types, rows, spilled = asyncio.run(run())
+    # 第一个分表在预算内，之后的分表写到临时文件中
+    assert types == [result.ResultSet, result.StreamResultSet,
+                     result.StreamResultSet]
+    assert spilled and runs.value - before == 2
+    assert rows == [(i, "s{}".format(i)) for i in range(300)]
+
+
+def test_buffered_ordered_scatter_spills(monkeypatch):
+    def handler(node, sql):
+        n = int(node[1:])
+        rows = [(i, "x" * 20) for i in range(n, 400, 4)]
+        if "DESC" in sql:
+            rows.reverse()
+        return result.ResultSet(2, [description("a"), description("b")],
+                                rows)
+
+    bm = backend_manager(monkeypatch, ["n0", "n1", "n2", "n3"],
+                         FakeBackend(handler))
+    table = sharding(bm, "id", "mod", [4],
+                     {i: Backend("n{}".format(i), i) for i in range(4)})
+    table.scatter_concurrency = 2
+    table.spill_budget = 1024
+    runs = Metrics.get_instance().counter("spill.runs")
+    before = runs.value
+    r = asyncio.run(table.execute_dml(
+        Parser.parse("SELECT a, b FROM t ORDER BY a DESC")[0],
+        mode=ResultMode.BUFFERED))
+    assert isinstance(r, result.ResultSet)
+    assert r.rows == [(i, "x" * 20) for i in range(399, -1, -1)]
+    # 一个分表流式读取，其余三个分表超过预算后写到临时文件中
+    assert runs.value - before == 3
@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+import pidal.err as err
+
+from pidal.constant.db import ResultMode
+from pidal.lib.metrics import Metrics
+from pidal.node.result import result
+from pidal.protocol.mysql.packet import Error, ResultWriter
+
+from tests.fake import FakeBackend, ScriptedStream, backend_manager, \
+        description
+
+
+def setup(monkeypatch, rows):
+    def handler(node, sql):
+        return result.ResultSet(1, [description("a")], list(rows))
+
+    backend = FakeBackend(handler)
+    bm = backend_manager(monkeypatch, ["n0"], backend)
+    return backend, bm, bm.backends["n0"]
+
+
+def test_abandoned_stream_is_drained(monkeypatch):
+    backend, bm, pool = setup(monkeypatch, [(i,) for i in range(10)])
+
+    async def run():
+        r = await bm.query("n0", "SELECT a FROM t", mode=ResultMode.STREAM)
+        async for _ in r:
+            break
+        await r.close()
+        return r
+
+    r = asyncio.run(run())
+    assert r.drained
+    # 剩下的行在 close 时读掉，连接还给 Pool 继续使用
+    conn = pool._free[0][0]
+    assert pool.size == 1 and not conn.is_closed()
+    assert backend.fetched == {"n0": 1}
+    assert Metrics.get_instance().gauge("pool.in_use.n0").value == 0
+
+
+def test_stream_not_drained_is_discarded(monkeypatch):
+    for e in (ConnectionResetError("lost"), asyncio.CancelledError()):
+        backend, bm, pool = setup(monkeypatch, [(1,), (2,), e, (3,)])
+
+        async def run():
+            r = await bm.query("n0", "SELECT a FROM t",
+                               mode=ResultMode.STREAM)
+            async for _ in r:
+                break
+            # 读掉剩余的行时出错或者被取消
+            with pytest.raises(type(e)):
+                await r.close()
+            return r
+
+        r = asyncio.run(run())
+        assert r.closed and not r.drained
+        # 连接上还有没有读完的数据，关闭后不会回到 Pool
+        assert pool.size == 0 and not pool._free
+        assert bm.outstanding["n0"] == 0
+
+
+def test_stream_not_drained_in_transaction(monkeypatch):
+    backend, bm, pool = setup(monkeypatch, [(1,), ConnectionResetError()])
+
+    async def run():
+        r = await bm.query("n0", "SELECT a FROM t", 1, ResultMode.STREAM)
+        with pytest.raises(ConnectionResetError):
+            await r.close()
+        return bm.trans[1]["n0"]
+
+    conn = asyncio.run(run())
+    # 事务中的连接不会还给 Pool，关闭后之后的查询会出错
+    assert conn.is_closed()
+
+
+def test_client_gone_midway(monkeypatch):
+    rows = [("x" * 1000,) for _ in range(1000)]
+    backend, bm, pool = setup(monkeypatch, rows)
+    # 第一次写入（约 64KB）之后客户端断开
+    client = ScriptedStream(fail_after=1)
+
+    async def run():
+        r = await bm.query("n0", "SELECT a FROM t", mode=ResultMode.STREAM)
+        with pytest.raises(ConnectionResetError):
+            await ResultWriter.write([r], client, 1)
+        return r
+
+    r = asyncio.run(run())
+    assert r.closed and r.drained
+    # 只读取了写入客户端的行，剩下的在 close 时读掉
+    assert 0 < backend.fetched["n0"] < len(rows)
+    assert pool.size == 1 and not pool._free[0][0].is_closed()
+
+
+def test_error_midway(monkeypatch):
+    e = err.OperationalError(1317, "Query execution was interrupted")
+    for binary in (False, True):
+        backend, bm, pool = setup(monkeypatch, [(1,), (2,), e])
+        client = ScriptedStream()
+
+        async def run():
+            r = await bm.query("n0", "SELECT a FROM t",
+                               mode=ResultMode.STREAM)
+            await ResultWriter.write([r], client, 1, binary)
+            return r
+
+        r = asyncio.run(run())
+        # 列数、列、EOF、两行之后是 ERR，序号连续
+        assert client.sequences == [1, 2, 3, 4, 5, 6]
+        error = Error.decode(client.written[-1])
+        assert (error.error_code, error.message) == \
+            (1317, "Query execution was interrupted")
+        # ERR 之后没有剩余的数据，连接可以继续使用
+        assert r.drained
+        assert pool.size == 1 and not pool._free[0][0].is_closed()
+
+
+def test_error_midway_unknown_exception(monkeypatch):
+    backend, bm, pool = setup(monkeypatch, [(1,), ValueError("bad row")])
+    client = ScriptedStream()
+
+    async def run():
+        r = await bm.query("n0", "SELECT a FROM t", mode=ResultMode.STREAM)
+        await ResultWriter.write([r], client, 1)
+
+    asyncio.run(run())
+    error = Error.decode(client.written[-1])
+    assert (error.error_code, error.message) == (1105, "bad row")